@@ -10,7 +10,8 @@ fi
 if [[ "${1-}" =~ ^-*h(elp)?$ ]]; then
     echo 'Usage: ./backup-database.sh
 
-This script dumps the mataroa postgres database and uploads it into an S3-compatible server.'
+This script dumps the mataroa postgres database and uploads it, along with the
+image files, into an S3-compatible server.'
     exit
 fi
 
@@ -28,6 +29,10 @@ main() {
 
     # upload using aws cli
     /usr/bin/rclone copy --progress /home/deploy/mataroa.dump scaleway:bucket/mataroa-backups/postgres-mataroa-"$(date --utc +%Y%m%d-%H%M%S)"/
+
+    # image files are content-addressed and never modified,
+    # so copying only uploads the new ones
+    /usr/bin/rclone copy --progress /var/www/mataroa/images scaleway:bucket/mataroa-images/
 }
 
 main "$@"
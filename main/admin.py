@@ -3,7 +3,7 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as DjUserAdmin
 from django.utils.html import format_html
 
-from main import models, util
+from main import caching, models, util
 
 
 @admin.action(description="Mark selected users as approved")
@@ -123,6 +123,16 @@ class ImageAdmin(admin.ModelAdmin):
     ordering = ["-id"]
 
 
+@admin.register(models.ImageUsage)
+class ImageUsageAdmin(admin.ModelAdmin):
+    list_display = (
+        "user",
+        "count",
+        "size_bytes",
+    )
+    ordering = ["-size_bytes"]
+
+
 @admin.register(models.AnalyticPage)
 class AnalyticPageAdmin(admin.ModelAdmin):
     list_display = (
@@ -144,6 +154,38 @@ class AnalyticPostAdmin(admin.ModelAdmin):
     ordering = ["-id"]
 
 
+@admin.register(models.AnalyticPageDay)
+class AnalyticPageDayAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "user",
+        "path",
+        "date",
+        "count",
+    )
+    ordering = ["-id"]
+
+
+@admin.register(models.AnalyticPostDay)
+class AnalyticPostDayAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "post",
+        "date",
+        "count",
+    )
+    ordering = ["-id"]
+
+
+@admin.action(description="Mark selected comments as approved")
+def approve_comments(modeladmin, request, queryset):
+    owner_ids = set(queryset.values_list("post__owner_id", flat=True))
+    queryset.update(is_approved=True)
+    # update() sends no post_save, so mark the blogs as changed here
+    for owner_id in owner_ids:
+        caching.touch_blog(owner_id)
+
+
 @admin.register(models.Comment)
 class CommentAdmin(admin.ModelAdmin):
     list_display = (
@@ -156,6 +198,7 @@ class CommentAdmin(admin.ModelAdmin):
         "created_at",
     )
     ordering = ["-id"]
+    actions = [approve_comments]
 
 
 @admin.register(models.Notification)
@@ -177,7 +220,10 @@ class NotificationRecordAdmin(admin.ModelAdmin):
         "sent_at",
         "notification",
         "post",
+        "status",
+        "attempts",
     )
+    list_filter = ("status",)
     ordering = ["-id"]
 
 
@@ -193,6 +239,21 @@ class ExportRecordAdmin(admin.ModelAdmin):
     ordering = ["-id"]
 
 
+@admin.register(models.ExportJob)
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "name",
+        "format",
+        "status",
+        "created_at",
+        "user",
+    )
+    list_display_links = ("id", "name")
+    list_filter = ("status", "format")
+    ordering = ["-id"]
+
+
 @admin.register(models.Snapshot)
 class SnapshotAdmin(admin.ModelAdmin):
     list_display = (
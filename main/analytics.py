@@ -0,0 +1,322 @@
+"""
+Analytics ingestion and daily rollups.
+
+Page and post hits are collected in a per-process buffer and inserted with
+one bulk_create per model once ANALYTICS_BUFFER_SIZE hits are pending or the
+oldest pending hit is ANALYTICS_BUFFER_MAX_AGE seconds old. A timer thread
+flushes the buffer at that age even if no further hit comes in, so a worker
+killed without warning loses at most the hits of the last
+ANALYTICS_BUFFER_MAX_AGE seconds. Hits still pending when the worker exits
+normally are flushed by an atexit handler.
+
+If a flush fails, its hits are kept for the next attempt, up to
+ANALYTICS_BUFFER_MAX_PENDING hits, beyond which the oldest are dropped.
+
+Raw hits are counted per day into AnalyticPostDay and AnalyticPageDay by the
+rollupanalytics command, after which they can be pruned. Dashboards read the
+rollups, and raw hits only for the days not rolled up yet.
+"""
+
+import atexit
+import logging
+import threading
+from collections import defaultdict
+from datetime import timedelta
+from timeit import default_timer as timer
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connection
+from django.db.models import Count, Max
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from main import models
+
+logger = logging.getLogger(__name__)
+
+
+class AnalyticsBuffer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pages = []
+        self.posts = []
+        self.oldest = None  # timer() of the oldest pending hit
+        self.retry_at = 0  # timer() before which no flush is attempted
+        self.flush_timer = None  # flushes pending hits once they are due
+        self.recorded = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.failures = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    def record_page(self, user_id, path):
+        max_length = models.AnalyticPage._meta.get_field("path").max_length
+        hit = models.AnalyticPage(
+            user_id=user_id, path=path[:max_length], created_at=timezone.now()
+        )
+        self._record(self.pages, hit)
+
+    def record_post(self, post_id):
+        hit = models.AnalyticPost(post_id=post_id, created_at=timezone.now())
+        self._record(self.posts, hit)
+
+    def _record(self, hits, hit):
+        now = timer()
+        with self.lock:
+            hits.append(hit)
+            self.recorded += 1
+            if self.oldest is None:
+                self.oldest = now
+            is_due = now >= self.retry_at and (
+                len(self.pages) + len(self.posts) >= settings.ANALYTICS_BUFFER_SIZE
+                or now - self.oldest >= settings.ANALYTICS_BUFFER_MAX_AGE
+            )
+            if not is_due:
+                self._schedule_flush()
+        if is_due:
+            self.flush()
+
+    def _schedule_flush(self):
+        """Start the flush timer unless it is running. Caller holds the lock."""
+        if self.flush_timer is None:
+            self.flush_timer = threading.Timer(
+                settings.ANALYTICS_BUFFER_MAX_AGE, self._flush_on_timer
+            )
+            self.flush_timer.daemon = True
+            self.flush_timer.start()
+
+    def _flush_on_timer(self):
+        try:
+            self.flush()
+        finally:
+            # the timer thread ends here, so do not leave its connection open
+            connection.close()
+
+    def flush(self):
+        """Write all pending hits. Safe to call from any thread."""
+        with self.lock:
+            pages, posts = self.pages, self.posts
+            self.pages, self.posts, self.oldest = [], [], None
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+        if not pages and not posts:
+            return
+
+        start = timer()
+        unwritten_pages = self._write(models.AnalyticPage, "user", pages)
+        unwritten_posts = self._write(models.AnalyticPost, "post", posts)
+        elapsed_ms = (timer() - start) * 1000
+
+        with self.lock:
+            self.flushes += 1
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            if unwritten_pages or unwritten_posts:
+                self.failures += 1
+                self.retry_at = timer() + settings.ANALYTICS_BUFFER_MAX_AGE
+                self._requeue(unwritten_pages, unwritten_posts)
+                self._schedule_flush()
+
+    def _write(self, model, fk_name, hits):
+        """Insert hits, returning the ones that could not be written."""
+        if not hits:
+            return []
+        try:
+            try:
+                model.objects.bulk_create(hits)
+            except IntegrityError:
+                # the post or blog of some hits was deleted since they were
+                # recorded, which fails the whole batch, so retry without them
+                hits = self._discard_orphans(model, fk_name, hits)
+                model.objects.bulk_create(hits)
+        except DatabaseError:
+            logger.exception("Failed to write %d %s hits", len(hits), model.__name__)
+            return hits
+        with self.lock:
+            self.flushed += len(hits)
+        return []
+
+    def _discard_orphans(self, model, fk_name, hits):
+        field = model._meta.get_field(fk_name)
+        existing_ids = set(
+            field.related_model.objects.filter(
+                id__in={getattr(h, field.attname) for h in hits}
+            ).values_list("id", flat=True)
+        )
+        kept = [h for h in hits if getattr(h, field.attname) in existing_ids]
+        with self.lock:
+            self.dropped += len(hits) - len(kept)
+        return kept
+
+    def _requeue(self, pages, posts):
+        """Put back unwritten hits ahead of new ones. Caller holds the lock."""
+        self.pages = pages + self.pages
+        self.posts = posts + self.posts
+        self.oldest = timer()
+
+        # over the cap, drop the oldest hits
+        pending = len(self.pages) + len(self.posts)
+        overflow = pending - settings.ANALYTICS_BUFFER_MAX_PENDING
+        if overflow > 0:
+            self.dropped += overflow
+            merged = sorted(self.pages + self.posts, key=lambda h: h.created_at)
+            kept = {id(h) for h in merged[overflow:]}
+            self.pages = [h for h in self.pages if id(h) in kept]
+            self.posts = [h for h in self.posts if id(h) in kept]
+
+    def info(self):
+        with self.lock:
+            return {
+                "recorded": self.recorded,
+                "flushed": self.flushed,
+                "dropped": self.dropped,
+                "pending": len(self.pages) + len(self.posts),
+                "flushes": self.flushes,
+                "failures": self.failures,
+                "last_flush_ms": self.last_flush_ms,
+                "max_flush_ms": self.max_flush_ms,
+            }
+
+
+buffer = AnalyticsBuffer()
+
+# gunicorn workers exit normally on graceful shutdown and restart
+atexit.register(buffer.flush)
+
+
+def record_hit(request, kind, *args):
+    """
+    Record a "page" hit (user_id, path) or a "post" hit (post_id) for the
+    request. The hit is also noted on the request when the page cache
+    renders it, to be recorded again whenever the page is served cached.
+    """
+    if kind == "page":
+        buffer.record_page(*args)
+    else:
+        buffer.record_post(*args)
+    if hasattr(request, "analytics_hits"):
+        request.analytics_hits.append((kind, *args))
+
+
+def rolled_up_until(day_model):
+    """
+    Return the latest date in a rollup table, or None if it is empty. That
+    day is likely partial, so hits from it on are read from the raw table.
+    """
+    return day_model.objects.aggregate(Max("date"))["date__max"]
+
+
+def count_per_day(raw_model, day_model, since, **lookups):
+    """
+    Return {date: hits} for the hits matching lookups from since on, read
+    from the daily rollup where available and from raw hits after it.
+    """
+    counts = defaultdict(int)
+    raw_hits = raw_model.objects.filter(created_at__gte=since, **lookups)
+
+    until = rolled_up_until(day_model)
+    if until:
+        day_counts = day_model.objects.filter(
+            date__gte=since, date__lt=until, **lookups
+        ).values_list("date", "count")
+        for date, count in day_counts:
+            counts[date] += count
+        raw_hits = raw_hits.filter(created_at__gte=until)
+
+    raw_counts = (
+        raw_hits.annotate(date=TruncDate("created_at"))
+        .values("date")
+        .annotate(count=Count("id"))
+        .order_by()
+    )
+    for item in raw_counts:
+        counts[item["date"]] += item["count"]
+    return counts
+
+
+def counts_on(raw_model, day_model, date, field):
+    """
+    Return {field value: hits} for the hits on date, read from the daily
+    rollup if that date is rolled up and from raw hits otherwise.
+    """
+    attname = raw_model._meta.get_field(field).attname
+    until = rolled_up_until(day_model)
+    if until and date < until:
+        rows = day_model.objects.filter(date=date).values_list(attname, "count")
+    else:
+        rows = (
+            raw_model.objects.filter(
+                created_at__gte=date, created_at__lt=date + timedelta(days=1)
+            )
+            .values(attname)
+            .annotate(count=Count("id"))
+            .order_by()
+            .values_list(attname, "count")
+        )
+
+    counts = defaultdict(int)
+    for key, count in rows:
+        counts[key] += count
+    return counts
+
+
+def rollup(raw_model, day_model, group_by, batch_size=1000):
+    """
+    Count raw hits per day and group_by fields into day_model, from the day
+    before the latest rolled up one on, to include hits written late. Whole
+    days are recounted, so it is safe to run repeatedly.
+
+    Returns the number of day rows written.
+    """
+    raw_hits = raw_model.objects.all()
+    until = rolled_up_until(day_model)
+    if until:
+        raw_hits = raw_hits.filter(created_at__gte=until - timedelta(days=1))
+
+    attnames = [raw_model._meta.get_field(name).attname for name in group_by]
+    day_counts = (
+        raw_hits.annotate(date=TruncDate("created_at"))
+        .values(*attnames, "date")
+        .annotate(count=Count("id"))
+        .order_by()
+    )
+
+    count_written = 0
+    batch = []
+    for item in day_counts.iterator(chunk_size=batch_size):
+        batch.append(day_model(**item))
+        if len(batch) >= batch_size:
+            count_written += _upsert_days(day_model, group_by, batch)
+            batch = []
+    if batch:
+        count_written += _upsert_days(day_model, group_by, batch)
+    return count_written
+
+
+def _upsert_days(day_model, group_by, days):
+    day_model.objects.bulk_create(
+        days,
+        update_conflicts=True,
+        unique_fields=[*group_by, "date"],
+        update_fields=["count"],
+    )
+    return len(days)
+
+
+def prune(raw_model, day_model, keep_days):
+    """
+    Delete raw hits older than keep_days days, as long as they are already
+    counted in day_model. Returns the number of hits deleted.
+    """
+    until = rolled_up_until(day_model)
+    if until is None:
+        return 0
+    before = min(
+        timezone.now().date() - timedelta(days=keep_days),
+        until - timedelta(days=1),  # the days rollup() recounts
+    )
+    count_deleted, _ = raw_model.objects.filter(created_at__lt=before).delete()
+    return count_deleted
@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class MainConfig(AppConfig):
     name = "main"
+
+    def ready(self):
+        # connect cache invalidation and image file cleanup signal receivers,
+        # and the export templates system check
+        from main import caching, export_templates, storage  # noqa: F401
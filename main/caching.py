@@ -0,0 +1,454 @@
+"""
+Caches for the blog request path, stored in the default Django cache.
+
+The default cache backend is per-process (see CACHES in settings), so
+signal-based invalidation only reaches the process that made the change.
+Entries therefore expire after a short timeout. Point CACHES to a shared
+backend to invalidate all workers at once.
+
+Rendered pages are the exception: they are kept in a per-process cache
+bounded in bytes, so that they cannot grow the process or evict the small
+entries above. Their versions stay in the default cache.
+"""
+
+import functools
+import hashlib
+import re
+import threading
+import time
+import uuid
+from calendar import timegm
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from main import analytics, models, util
+
+# fields needed by host_middleware to route a request without loading the user
+BLOG_HOST_FIELDS = [
+    "id",
+    "username",
+    "theme_zialucia",
+    "theme_sansserif",
+    "custom_domain",
+    "redirect_domain",
+    "blog_changed_at",
+]
+
+_MISSING = object()
+
+
+def _get_blog_host_key(kind, value):
+    # hash because host headers can contain characters invalid in cache keys
+    digest = hashlib.sha1(value.encode()).hexdigest()
+    return f"blog-host:{kind}:{digest}"
+
+
+def _get_blog_host(kind, value, **lookup):
+    key = _get_blog_host_key(kind, value)
+    blog_host = cache.get(key, _MISSING)
+    if blog_host is _MISSING:
+        blog_host = (
+            models.User.objects.filter(**lookup).values(*BLOG_HOST_FIELDS).first()
+        )
+        if blog_host:
+            cache.set(key, blog_host, settings.BLOG_HOST_CACHE_TIMEOUT)
+        else:
+            # negative caching for unknown hosts
+            cache.set(key, None, settings.BLOG_HOST_CACHE_NEGATIVE_TIMEOUT)
+    return blog_host
+
+
+def get_blog_host_by_username(username):
+    """Returns dict of BLOG_HOST_FIELDS for the blog, None if it doesn't exist."""
+    return _get_blog_host("username", username, username=username)
+
+
+def get_blog_host_by_domain(domain):
+    """Returns dict of BLOG_HOST_FIELDS for the blog, None if it doesn't exist."""
+    return _get_blog_host("domain", domain, custom_domain=domain)
+
+
+def invalidate_blog_host(username=None, custom_domain=None):
+    keys = []
+    if username:
+        keys.append(_get_blog_host_key("username", username))
+    if custom_domain:
+        keys.append(_get_blog_host_key("domain", custom_domain))
+    cache.delete_many(keys)
+
+
+class CustomDomainSet:
+    """
+    In-memory set of all custom domains, for answering whether a domain
+    belongs to a blog without a query per lookup. It is reloaded in one query
+    when older than CUSTOM_DOMAINS_REFRESH_INTERVAL, or after any user change
+    in this process. Unknown domains are denied from memory until then.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.domains = frozenset()
+        self.loaded_at = None
+        self.lookups = 0
+        self.found = 0
+        self.reloads = 0
+
+    def invalidate(self):
+        self.loaded_at = None
+
+    def reload_if_stale(self):
+        loaded_at = self.loaded_at
+        if (
+            loaded_at is not None
+            and time.monotonic() - loaded_at < settings.CUSTOM_DOMAINS_REFRESH_INTERVAL
+        ):
+            return
+        with self.lock:
+            if self.loaded_at is not loaded_at:
+                return  # another thread reloaded while we were waiting
+            self.domains = frozenset(
+                models.User.objects.exclude(custom_domain__isnull=True)
+                .exclude(custom_domain="")
+                .values_list("custom_domain", flat=True)
+            )
+            self.loaded_at = time.monotonic()
+            self.reloads += 1
+
+    def __contains__(self, domain):
+        self.reload_if_stale()
+        self.lookups += 1
+        if domain in self.domains:
+            self.found += 1
+            return True
+        return False
+
+    def info(self):
+        return {
+            "lookups": self.lookups,
+            "found": self.found,
+            "denied": self.lookups - self.found,
+            "reloads": self.reloads,
+            "domains": len(self.domains),
+        }
+
+
+custom_domains = CustomDomainSet()
+
+
+def has_pending_messages(request):
+    """Pages rendered with pending flash messages show them only once."""
+    if CookieStorage.cookie_name in request.COOKIES:
+        return True
+    if settings.SESSION_COOKIE_NAME in request.COOKIES:
+        return "_messages" in request.session
+    return False
+
+
+# the hidden input rendered by {% csrf_token %}
+CSRF_INPUT_RE = re.compile(rb'(name="csrfmiddlewaretoken" value=")[^"]*(")')
+
+
+class AnonymousPageCache:
+    """
+    Rendered blog pages for anonymous visitors, keyed by blog, host, theme,
+    path and the query parameters the view reads. Every entry carries the
+    blog's version and is ignored once any post, page, comment or setting of
+    that blog changes, which sets a new version. Entries expire after
+    PAGE_CACHE_TIMEOUT regardless, as the version change only reaches other
+    processes through a shared cache.
+
+    Pages are kept in a util.LRUCache of PAGE_CACHE_MAX_BYTES, and pages
+    larger than PAGE_CACHE_MAX_ITEM_BYTES are not cached.
+
+    The analytics hits recorded while rendering a page are stored with it
+    and recorded again whenever the page is served from cache. CSRF tokens
+    in cached pages are replaced with the token of the visitor.
+    """
+
+    def __init__(self):
+        self.pages = util.LRUCache(
+            max_bytes=settings.PAGE_CACHE_MAX_BYTES,
+            max_item_bytes=settings.PAGE_CACHE_MAX_ITEM_BYTES,
+        )
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.invalidations = 0
+
+    def get_version_key(self, blog_id):
+        return f"page-version:{blog_id}"
+
+    def get_key(self, request, query_params):
+        # other query strings share the entry of their page, so that they
+        # cannot fill the cache with copies of it
+        query = "&".join(f"{name}={request.GET.get(name, '')}" for name in query_params)
+        digest = hashlib.sha1(
+            f"{request.get_host()}{request.path}?{query}".encode()
+        ).hexdigest()
+        theme = f"{int(request.theme_zialucia)}{int(request.theme_sansserif)}"
+        return f"page:{request.blog_host['id']}:{theme}:{digest}"
+
+    def is_cacheable(self, request):
+        if request.method != "GET" or not hasattr(request, "blog_host"):
+            return False
+        if request.user.is_authenticated:
+            return False
+        return not has_pending_messages(request)
+
+    def invalidate(self, blog_id):
+        self.invalidations += 1
+        cache.set(self.get_version_key(blog_id), uuid.uuid4().hex, timeout=None)
+
+    def __call__(self, query_params=()):
+        """
+        Decorate a blog view to be served from this cache. query_params are
+        the names of the query parameters the view reads. The view must not
+        answer 200 for values that are invalid, or that only differ in form
+        from valid ones, so that the entries per page are bounded.
+        """
+
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(request, *args, **kwargs):
+                if not self.is_cacheable(request):
+                    self.bypasses += 1
+                    return view(request, *args, **kwargs)
+
+                key = self.get_key(request, query_params)
+                version_key = self.get_version_key(request.blog_host["id"])
+                version = cache.get(version_key)
+                if version is None:
+                    # first request or evicted, either way older entries are void
+                    version = uuid.uuid4().hex
+                    cache.set(version_key, version, timeout=None)
+
+                entry = self.pages.get(key)
+                if (
+                    entry
+                    and entry["version"] == version
+                    and entry["expires_at"] > time.monotonic()
+                ):
+                    self.hits += 1
+                    return self.serve(request, entry)
+
+                self.misses += 1
+                request.analytics_hits = []
+                response = view(request, *args, **kwargs)
+                if response.status_code == 200 and not response.streaming:
+                    if hasattr(response, "render"):
+                        response.render()
+                    entry = {
+                        "version": version,
+                        "expires_at": time.monotonic() + settings.PAGE_CACHE_TIMEOUT,
+                        "content": response.content,
+                        "content_type": response["Content-Type"],
+                        "analytics_hits": request.analytics_hits,
+                    }
+                    self.pages.set(key, entry, size=len(response.content))
+                return response
+
+            return wrapper
+
+        return decorator
+
+    def serve(self, request, entry):
+        for hit in entry["analytics_hits"]:
+            analytics.record_hit(request, *hit)
+
+        content = entry["content"]
+        if CSRF_INPUT_RE.search(content):
+            token = get_token(request).encode()
+            content = CSRF_INPUT_RE.sub(
+                lambda match: match.group(1) + token + match.group(2), content
+            )
+        return HttpResponse(content, content_type=entry["content_type"])
+
+    def info(self):
+        pages = self.pages.info()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "invalidations": self.invalidations,
+            "entries": pages["entries"],
+            "evictions": pages["evictions"],
+            "bytes": pages["bytes"],
+            "max_bytes": pages["max_bytes"],
+        }
+
+
+anonymous_page_cache = AnonymousPageCache()
+
+
+class ConditionalBlogPage:
+    """
+    Answers conditional GET requests for blog pages with 304 Not Modified,
+    from the blog's blog_changed_at in the cached blog_host and nothing else.
+
+    Pages also show posts once their publication date comes, so validators
+    change daily too. ETags also differ per logged in user. Blog owners, who
+    also see drafts and pending comments, which do not change blog_changed_at,
+    always get their pages rendered.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.not_modified = 0
+
+    def get_last_modified(self, request):
+        today = datetime.combine(timezone.now().date(), datetime.min.time())
+        return max(request.blog_host["blog_changed_at"], today)
+
+    def get_etag(self, request):
+        visitor = request.user.id if request.user.is_authenticated else "anon"
+        key = f"{request.blog_host['blog_changed_at'].isoformat()}:{timezone.now().date()}:{visitor}"
+        return f'W/"{hashlib.sha1(key.encode()).hexdigest()}"'
+
+    def __call__(self, get_hit=None):
+        """
+        Decorate a blog view to answer conditional requests. get_hit(request,
+        *args, **kwargs) returns the analytics hit to record for a 304, as
+        analytics.record_hit arguments, or None.
+        """
+
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(request, *args, **kwargs):
+                if (
+                    request.method not in ("GET", "HEAD")
+                    or not hasattr(request, "blog_host")
+                    or request.user.id == request.blog_host["id"]
+                    or has_pending_messages(request)
+                ):
+                    return view(request, *args, **kwargs)
+
+                self.requests += 1
+                etag = self.get_etag(request)
+                last_modified = timegm(self.get_last_modified(request).utctimetuple())
+                response = get_conditional_response(
+                    request, etag=etag, last_modified=last_modified
+                )
+                if response is not None and response.status_code == 304:
+                    self.not_modified += 1
+                    hit = get_hit(request, *args, **kwargs) if get_hit else None
+                    if hit:
+                        analytics.record_hit(request, *hit)
+                    return response
+                if response is not None:
+                    return response  # 412 Precondition Failed
+
+                response = view(request, *args, **kwargs)
+                if response.status_code == 200:
+                    # replace any Last-Modified of the view, eg. of the feed,
+                    # so that If-Modified-Since is checked against ours
+                    response["ETag"] = etag
+                    response["Last-Modified"] = http_date(last_modified)
+                return response
+
+            return wrapper
+
+        return decorator
+
+    def info(self):
+        return {
+            "requests": self.requests,
+            "not_modified": self.not_modified,
+            "not_modified_percent": (
+                self.not_modified * 100 / self.requests if self.requests else 0
+            ),
+        }
+
+
+conditional_blog_page = ConditionalBlogPage()
+
+
+def _changes_blog_host(update_fields):
+    """Whether a user save of update_fields may change its cached blog_host."""
+    # saves of other single fields, eg. last_login, leave the caches valid
+    return update_fields is None or not update_fields.isdisjoint(BLOG_HOST_FIELDS)
+
+
+@receiver(pre_save, sender=models.User)
+def invalidate_previous_blog_host(sender, instance, raw, update_fields=None, **kwargs):
+    # username or custom domain might be changing, so drop the old entries too
+    if raw or not instance.pk or not _changes_blog_host(update_fields):
+        return
+    previous = (
+        models.User.objects.filter(pk=instance.pk)
+        .values("username", "custom_domain")
+        .first()
+    )
+    if previous:
+        invalidate_blog_host(**previous)
+
+
+@receiver(pre_save, sender=models.User)
+def set_blog_changed_at(sender, instance, raw, update_fields=None, **kwargs):
+    # saves of single fields, eg. last_login, change nothing on the blog
+    if raw or update_fields is not None:
+        return
+    instance.blog_changed_at = timezone.now()
+
+
+@receiver(post_save, sender=models.User)
+@receiver(post_delete, sender=models.User)
+def invalidate_current_blog_host(sender, instance, **kwargs):
+    if not _changes_blog_host(kwargs.get("update_fields")):
+        return
+    invalidate_blog_host(instance.username, instance.custom_domain)
+    custom_domains.invalidate()
+    anonymous_page_cache.invalidate(instance.pk)
+
+
+def touch_blog(blog_id):
+    """Mark a blog as changed, for conditional requests and the page cache."""
+    blog = models.User.objects.filter(pk=blog_id)
+    blog_host = blog.values("username", "custom_domain").first()
+    if blog_host is None:
+        return
+    blog.update(blog_changed_at=timezone.now())
+    invalidate_blog_host(**blog_host)
+    anonymous_page_cache.invalidate(blog_id)
+
+
+@receiver(post_save, sender=models.Post)
+@receiver(post_delete, sender=models.Post)
+@receiver(post_save, sender=models.Page)
+@receiver(post_delete, sender=models.Page)
+def touch_post_or_page_blog(sender, instance, **kwargs):
+    touch_blog(instance.owner_id)
+
+
+@receiver(pre_save, sender=models.Comment)
+def note_comment_was_approved(sender, instance, raw, **kwargs):
+    instance._was_approved = bool(
+        not raw
+        and instance.pk
+        and models.Comment.objects.filter(pk=instance.pk, is_approved=True).exists()
+    )
+
+
+@receiver(post_save, sender=models.Comment)
+@receiver(post_delete, sender=models.Comment)
+def touch_comment_blog(sender, instance, **kwargs):
+    # pending comments are shown to the blog owner only, whose pages are
+    # always rendered, so they leave the caches of readers alone
+    if not instance.is_approved and not getattr(instance, "_was_approved", False):
+        return
+    owner_id = (
+        models.Post.objects.filter(pk=instance.post_id)
+        .values_list("owner_id", flat=True)
+        .first()
+    )
+    if owner_id:
+        touch_blog(owner_id)
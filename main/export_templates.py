@@ -0,0 +1,129 @@
+"""
+Registry of the template bundles exports are built from, the export_base_*
+directories.
+
+Each bundle is read once per process, on first use, and checked for the
+placeholders the exporters replace, so that a missing or edited file is
+reported by the system checks, rather than halfway through an archive.
+Bundles are read-only mappings of archive path to file content, in the
+order they are written to archives.
+"""
+
+import functools
+from dataclasses import dataclass, field
+from types import MappingProxyType
+
+from django.conf import settings
+from django.core import checks
+from django.core.exceptions import ImproperlyConfigured
+
+# replaced in the config.toml of site generator bundles
+SITE_CONFIG_PLACEHOLDERS = (
+    "example.com",
+    "Example blog title",
+    "Example blog description",
+)
+
+
+@dataclass(frozen=True)
+class Bundle:
+    directory: str
+    # (archive path, file name in directory) pairs
+    files: tuple
+    # file name to the strings it must contain
+    placeholders: dict = field(default_factory=dict)
+
+
+BUNDLES = {
+    "zola": Bundle(
+        directory="export_base_zola",
+        files=(
+            ("config.toml", "config.toml"),
+            ("static/style.css", "style.css"),
+            ("templates/index.html", "index.html"),
+            ("templates/post.html", "post.html"),
+            ("templates/404.html", "404.html"),
+            ("content/_index.md", "_index.md"),
+        ),
+        placeholders={"config.toml": SITE_CONFIG_PLACEHOLDERS},
+    ),
+    "hugo": Bundle(
+        directory="export_base_hugo",
+        files=(
+            ("config.toml", "config.toml"),
+            ("themes/mataroa/theme.toml", "theme.toml"),
+            ("themes/mataroa/static/style.css", "style.css"),
+            ("themes/mataroa/layouts/index.html", "index.html"),
+            ("themes/mataroa/layouts/404.html", "404.html"),
+            ("themes/mataroa/layouts/_default/single.html", "single.html"),
+            ("themes/mataroa/layouts/_default/list.html", "list.html"),
+            ("themes/mataroa/layouts/_default/baseof.html", "baseof.html"),
+        ),
+        placeholders={"config.toml": SITE_CONFIG_PLACEHOLDERS},
+    ),
+    "epub": Bundle(
+        directory="export_base_epub",
+        files=(
+            ("mimetype", "mimetype"),
+            ("META-INF/container.xml", "container.xml"),
+            ("OEBPS/content.opf", "content.opf"),
+            ("OEBPS/toc.xhtml", "toc.xhtml"),
+            ("OEBPS/toc.ncx", "toc.ncx"),
+        ),
+        placeholders={
+            "content.opf": (
+                "<dc:title></dc:title>",
+                '<dc:creator opf:role="aut"></dc:creator>',
+                "<dc:language></dc:language>",
+                "<dc:publisher></dc:publisher>",
+                '<dc:identifier opf:scheme="UUID"></dc:identifier>',
+                "<dc:date></dc:date>",
+                "<!-- manifest items -->",
+                "<!-- spine items -->",
+            ),
+            "toc.xhtml": ("<!-- chapters list -->",),
+            "toc.ncx": (
+                "<text></text>",
+                '<meta name="dtb:uid" content=""/>',
+                "<!-- nav points -->",
+            ),
+        },
+    ),
+}
+
+
+@functools.cache
+def get_bundle(name):
+    """
+    Return the files of the bundle name as a read-only mapping of archive
+    path to content. Raises ImproperlyConfigured if a file is unreadable or
+    lacks a placeholder.
+    """
+    bundle = BUNDLES[name]
+    directory = settings.BASE_DIR / bundle.directory
+    files = {}
+    for archive_path, file_name in bundle.files:
+        path = directory / file_name
+        try:
+            content = path.read_text()
+        except OSError as ex:
+            raise ImproperlyConfigured(f"Cannot read export template {path}.") from ex
+        for placeholder in bundle.placeholders.get(file_name, ()):
+            if placeholder not in content:
+                raise ImproperlyConfigured(
+                    f"Export template {path} lacks placeholder {placeholder!r}."
+                )
+        files[archive_path] = content
+    return MappingProxyType(files)
+
+
+@checks.register()
+def check_bundles(app_configs, **kwargs):
+    """Load every bundle at startup, reporting the ones that are broken."""
+    errors = []
+    for name in BUNDLES:
+        try:
+            get_bundle(name)
+        except ImproperlyConfigured as ex:
+            errors.append(checks.Error(str(ex), id="main.E001"))
+    return errors
@@ -0,0 +1,366 @@
+"""
+Zip archives of blog exports, generated as a stream.
+
+Each archive entry is compressed into a ZipFile writing to a ZipStream, and
+the bytes written are handed over after every entry, so that an archive is
+sent while it is being built. Posts are read in chunks, so memory stays
+constant however large the blog is.
+
+Exports requested on the website are ExportJobs, built into files by the
+processexports command rather than within the request, with write_export.
+"""
+
+import uuid
+import zipfile
+from datetime import datetime
+from string import Template
+
+from django.conf import settings
+
+from main import export_templates, models, storage, util
+
+# posts fetched per query while exporting
+POST_CHUNK_SIZE = 100
+
+
+class ZipStream:
+    """Write-only, unseekable file object collecting what ZipFile writes."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        """Return the bytes written since the last pop."""
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_zip(entries):
+    """
+    Yield the bytes of a zip archive of entries, (name, content) pairs, name
+    a str or a ZipInfo, and content str, bytes or an iterable of bytes.
+    Each entry is read only once the previous one is sent.
+    """
+    stream = ZipStream()
+    # unseekable, so ZipFile writes sizes after each entry's data
+    with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, content in entries:
+            if isinstance(content, (str, bytes)):
+                archive.writestr(name, content)
+            else:
+                # chunks, eg. of an image file, compressed as they are read
+                with archive.open(name, "w") as entry:
+                    for chunk in content:
+                        entry.write(chunk)
+                        yield stream.pop()
+            yield stream.pop()
+    # the central directory, written on close
+    yield stream.pop()
+
+
+def iter_posts(user, *fields):
+    return (
+        models.Post.objects.filter(owner=user)
+        .only("title", "slug", "body", "published_at", "created_at", *fields)
+        .iterator(chunk_size=POST_CHUNK_SIZE)
+    )
+
+
+def prepend_zola_frontmatter(body, post_title, pub_date):
+    frontmatter = "+++\n"
+    frontmatter += f'title = "{post_title}"\n'
+    frontmatter += f"date = {pub_date}\n"
+    frontmatter += 'template = "post.html"\n'
+    frontmatter += "+++\n"
+    frontmatter += "\n"
+
+    return frontmatter + body
+
+
+def prepend_hugo_frontmatter(body, post_title, pub_date, post_slug):
+    frontmatter = "+++\n"
+    frontmatter += f'title = "{post_title}"\n'
+    frontmatter += f"date = {pub_date}\n"
+    frontmatter += f'url = "blog/{post_slug}"\n'
+    frontmatter += "+++\n"
+    frontmatter += "\n"
+
+    return frontmatter + body
+
+
+def iter_markdown_entries(user, export_name):
+    container_dir = f"{user.username}-mataroa-blog"
+    for p in iter_posts(user):
+        pub_date = p.published_at or p.created_at
+        body = f"# {p.title}\n\n"
+        body += f"> Published on {pub_date.strftime('%b %-d, %Y')}\n\n"
+        body += f"{p.body}\n"
+        yield f"{export_name}/{container_dir}/{p.slug}.md", body
+
+
+def iter_site_entries(user, export_name, bundle_name, blog_title, get_post_body):
+    """
+    Yield the entries of a static site generator project: the files of the
+    template bundle, with the blog's details in its config.toml, and a
+    markdown file per post, of get_post_body(post, pub_date).
+    """
+    for path, content in export_templates.get_bundle(bundle_name).items():
+        if path == "config.toml":
+            content = (
+                content.replace("example.com", f"{user.username}.mataroa.blog")
+                .replace("Example blog title", blog_title)
+                .replace("Example blog description", user.blog_byline or "")
+            )
+        yield f"{export_name}/{path}", content
+
+    for p in iter_posts(user):
+        pub_date = p.published_at or p.created_at.date()
+        yield f"{export_name}/content/{p.slug}.md", get_post_body(p, pub_date)
+
+
+def iter_zola_entries(user, export_name):
+    return iter_site_entries(
+        user,
+        export_name,
+        "zola",
+        f"{user.username} blog",
+        lambda p, pub_date: prepend_zola_frontmatter(
+            p.body, util.escape_quotes(p.title), pub_date
+        ),
+    )
+
+
+def iter_hugo_entries(user, export_name):
+    return iter_site_entries(
+        user,
+        export_name,
+        "hugo",
+        user.blog_title or f"{user.username} blog",
+        lambda p, pub_date: prepend_hugo_frontmatter(
+            p.body, util.escape_quotes(p.title), pub_date, p.slug
+        ),
+    )
+
+
+IMAGE_MEDIA_TYPES = {"jpeg": "image/jpeg", "svg": "image/svg+xml", "tif": "image/tiff"}
+
+
+def _get_epub_author(blog_user):
+    return f"""<?xml version="1.0" encoding="UTF-8" ?>
+<!DOCTYPE html>
+<html xml:lang="en" lang="en" xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+<head>
+    <title>{blog_user.username}</title>
+</head>
+<body>
+<h1>About the Author</h1>
+<p>{blog_user.about_as_html}</p>
+</body>
+</html>
+"""
+
+
+def _get_epub_titlepage(blog_user):
+    return f"""<?xml version="1.0" encoding="UTF-8" ?>
+<!DOCTYPE html>
+<html xml:lang="en" lang="en" xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+<head>
+    <title>{blog_user.blog_title}</title>
+</head>
+<body>
+<h1>{blog_user.blog_title}</h1>
+<p>{blog_user.blog_byline}</p>
+<br/>
+<p>~{blog_user.username}</p>
+</body>
+</html>
+"""
+
+
+def _get_epub_chapter(post):
+    chapter_body = post.body_as_html
+
+    # process image urls
+    image_url_like = util.get_protocol() + "//" + settings.CANONICAL_HOST + "/images/"
+    if image_url_like in chapter_body:
+        chapter_body = chapter_body.replace(image_url_like, "images/")
+
+    # xhtml replacements
+    chapter_body = chapter_body.replace("<br>", "<br/>").replace("<hr>", "<hr/>")
+    return f"""<?xml version="1.0" encoding="UTF-8" ?>
+<!DOCTYPE html>
+<html xml:lang="en" lang="en" xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+<head>
+    <title>{post.title}</title>
+</head>
+<body>
+<h2>{post.title}</h2>
+{chapter_body}
+</body>
+</html>
+"""
+
+
+def iter_epub_entries(user, epub_uuid):
+    """
+    Yield the entries of an EPUB book of the posts of user. Chapters and
+    images are written as they are read; the package document and tables of
+    contents, which list them all, come after them, as only the mimetype has
+    to be first.
+    """
+    templates = export_templates.get_bundle("epub")
+    # first and uncompressed, so that readers can identify the file
+    yield zipfile.ZipInfo("mimetype"), templates["mimetype"].strip()
+    yield "META-INF/container.xml", templates["META-INF/container.xml"]
+
+    # only what the tables of contents need is kept of each chapter
+    chapters = []
+    posts = iter_posts(user, "body_html", "body_html_version")
+    for index, p in enumerate(posts, start=1):
+        chapter = {"title": p.title, "id": index, "link": f"{index}.xhtml"}
+        chapters.append(chapter)
+        yield f"OEBPS/{chapter['link']}", _get_epub_chapter(p)
+
+    # images linked from the posts, streamed from the image storage
+    image_filenames = []
+    linked_images = (
+        models.Image.objects.filter(owner=user, posts__owner=user)
+        .distinct()
+        .defer("data")
+        .iterator(chunk_size=POST_CHUNK_SIZE)
+    )
+    for img in linked_images:
+        image_filenames.append(img.filename)
+        yield f"OEBPS/images/{img.filename}", img.iter_data()
+
+    # process content.opf
+    content_opf_manifest = ""
+    content_opf_spine = ""
+    for chapter in chapters:
+        content_opf_manifest += (
+            f'    <item id="{chapter["id"]}" href="{chapter["link"]}"'
+            + ' media-type="application/xhtml+xml"/>'
+            + "\n"
+        )
+        content_opf_spine += f'    <itemref idref="{chapter["id"]}"/>' + "\n"
+    for index, filename in enumerate(image_filenames, start=1):
+        extension = filename.rsplit(".", 1)[-1]
+        media_type = IMAGE_MEDIA_TYPES.get(extension, f"image/{extension}")
+        content_opf_manifest += (
+            f'    <item id="image-{index}" href="images/{filename}"'
+            + f' media-type="{media_type}"/>'
+            + "\n"
+        )
+    content_opf_content = templates["OEBPS/content.opf"]
+    content_opf_content = content_opf_content.replace(
+        "<dc:title></dc:title>",
+        f"<dc:title>{user.blog_title}</dc:title>",
+    )
+    content_opf_content = content_opf_content.replace(
+        '<dc:creator opf:role="aut"></dc:creator>',
+        f'<dc:creator opf:role="aut">{user.username}</dc:creator>',
+    )
+    content_opf_content = content_opf_content.replace(
+        "<dc:language></dc:language>", "<dc:language>en</dc:language>"
+    )
+    content_opf_content = content_opf_content.replace(
+        "<dc:publisher></dc:publisher>",
+        f"<dc:publisher>{user.username}</dc:publisher>",
+    )
+    content_opf_content = content_opf_content.replace(
+        '<dc:identifier opf:scheme="UUID"></dc:identifier>',
+        f'<dc:identifier opf:scheme="UUID">{epub_uuid}</dc:identifier>',
+    )
+    content_opf_content = content_opf_content.replace(
+        "<dc:date></dc:date>",
+        f"<dc:date>{datetime.now().date().isoformat()}</dc:date>",
+    )
+    content_opf_content = content_opf_content.replace(
+        "<!-- manifest items -->", content_opf_manifest
+    )
+    content_opf_content = content_opf_content.replace(
+        "<!-- spine items -->", content_opf_spine
+    )
+    yield "OEBPS/content.opf", content_opf_content
+
+    # process toc.xhtml
+    toc_xhtml_body = ""
+    for chapter in chapters:
+        toc_xhtml_body += (
+            f'      <li><a href="{chapter["link"]}">{chapter["title"]}</a></li>' + "\n"
+        )
+    toc_xhtml_content = templates["OEBPS/toc.xhtml"].replace(
+        "<!-- chapters list -->", toc_xhtml_body
+    )
+    yield "OEBPS/toc.xhtml", toc_xhtml_content
+
+    # process toc.ncx
+    toc_ncx_body = ""
+    toc_ncx_html_item = Template(
+        """    <navPoint id="$chapter_id" playOrder="$chapter_playorder">
+      <navLabel><text>$chapter_title</text></navLabel>
+      <content src="$chapter_link"/>
+    </navPoint>
+"""
+    )
+    for chapter in chapters:
+        new_item = toc_ncx_html_item.substitute(
+            chapter_id=chapter["id"],
+            chapter_playorder=chapter["id"] + 2,  # +2 because of title+toc
+            chapter_title=chapter["title"],
+            chapter_link=chapter["link"],
+        )
+        toc_ncx_body += new_item + "\n"
+    toc_ncx_body += toc_ncx_html_item.substitute(
+        chapter_id="author",
+        chapter_playorder=len(chapters) + 3,
+        chapter_title="About the Author",
+        chapter_link="author.xhtml",
+    )
+    toc_ncx_content = templates["OEBPS/toc.ncx"]
+    toc_ncx_content = toc_ncx_content.replace(
+        "<text></text>",
+        f"<text>{user.blog_title}</text>",
+    )
+    toc_ncx_content = toc_ncx_content.replace(
+        '<meta name="dtb:uid" content=""/>',
+        f'<meta name="dtb:uid" content="{epub_uuid}"/>',
+    )
+    toc_ncx_content = toc_ncx_content.replace("<!-- nav points -->", toc_ncx_body)
+    yield "OEBPS/toc.ncx", toc_ncx_content
+
+    # write title and author page
+    yield "OEBPS/titlepage.xhtml", _get_epub_titlepage(user)
+    yield "OEBPS/author.xhtml", _get_epub_author(user)
+
+
+ENTRY_BUILDERS = {
+    models.ExportJob.Format.MARKDOWN: iter_markdown_entries,
+    models.ExportJob.Format.ZOLA: iter_zola_entries,
+    models.ExportJob.Format.HUGO: iter_hugo_entries,
+}
+
+
+def get_export_name(export_format):
+    prefix = "book" if export_format == models.ExportJob.Format.EPUB else export_format
+    return f"export-{prefix}-{str(uuid.uuid4())[:8]}"
+
+
+def iter_export(user, export_format, export_name):
+    """Yield the bytes of the archive of user's blog in export_format."""
+    if export_format == models.ExportJob.Format.EPUB:
+        return iter_zip(iter_epub_entries(user, str(uuid.uuid4())))
+    return iter_zip(ENTRY_BUILDERS[export_format](user, export_name))
+
+
+def write_export(path, user, export_format, export_name):
+    """Write the archive of user's blog to path. Returns its size."""
+    return storage.write_chunks(path, iter_export(user, export_format, export_name))
@@ -3,10 +3,16 @@ from datetime import datetime
 from django.contrib.syndication.views import Feed
 from django.http import Http404
 from django.utils import timezone
+from django.utils.decorators import method_decorator
 
-from main import models
+from main import analytics, caching, models
 
 
+def get_rss_hit(request):
+    return ("page", request.blog_host["id"], "rss")
+
+
+@method_decorator(caching.conditional_blog_page(get_rss_hit), name="__call__")
 class RSSBlogFeed(Feed):
     title = ""
     link = ""
@@ -22,7 +28,7 @@ class RSSBlogFeed(Feed):
         self.subdomain = request.subdomain
         self.link = user.blog_url
 
-        models.AnalyticPage.objects.create(user=user, path="rss")
+        analytics.record_hit(request, "page", user.id, "rss")
 
         return super().__call__(request, *args, **kwargs)
 
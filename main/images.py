@@ -0,0 +1,124 @@
+"""
+Resized and converted variants of uploaded images.
+
+image_raw serves /images/<slug>.<ext>?w=<width> scaled down to the next of
+IMAGE_VARIANT_WIDTHS, and /images/<slug>.webp converted to WebP, for images
+Pillow can read. Variants are generated on first request and kept in
+variant_cache under the digest of the original bytes, so they never need
+invalidating.
+"""
+
+import math
+from io import BytesIO
+
+from django.conf import settings
+from PIL import Image, ImageOps
+
+from main import storage
+
+# Pillow format of the image extensions variants are made of and to; gif is
+# left out as resizing would drop its animation
+FORMATS = {
+    "jpeg": "JPEG",
+    "png": "PNG",
+    "webp": "WEBP",
+    "bmp": "BMP",
+    "tiff": "TIFF",
+    "tif": "TIFF",
+}
+
+SAVE_OPTIONS = {
+    "jpeg": {"quality": 85, "optimize": True},
+    "png": {"optimize": True},
+    "webp": {"quality": 80},
+}
+
+variant_cache = storage.LRUFileCache("IMAGE_VARIANTS_ROOT", "IMAGE_VARIANTS_MAX_BYTES")
+
+
+def get_variant_options(source_extension, extension, width_param):
+    """
+    Return (width, extension) of the variant requested, width being None for
+    the full size, or None when the original image is requested. Raises
+    ValueError for a variant that cannot be made.
+    """
+    if extension != source_extension and (
+        extension != "webp" or source_extension not in FORMATS
+    ):
+        raise ValueError(f"Cannot convert {source_extension} to {extension}.")
+
+    width = None
+    if width_param is not None and source_extension in FORMATS:
+        width = int(width_param)
+        if width < 1:
+            raise ValueError(f"Invalid width {width}.")
+        # a few widths only, so that the cache holds few variants per image;
+        # beyond the largest, the full size
+        width = next((w for w in settings.IMAGE_VARIANT_WIDTHS if w >= width), None)
+
+    if width is None and extension == source_extension:
+        return None
+    return width, extension
+
+
+def get_variant_key(digest, width, extension):
+    return f"{digest}-{width or 'full'}.{extension}"
+
+
+def make_variant(data, width, extension):
+    """
+    Return the image data scaled down to width, if wider, and encoded as
+    extension. Raises ValueError for data Pillow cannot read, and for images
+    of more than IMAGE_VARIANT_MAX_PIXELS once decoded.
+    """
+    try:
+        with Image.open(BytesIO(data)) as image:
+            if (width is None or image.width <= width) and (
+                FORMATS[extension] == image.format
+            ):
+                return data
+
+            if width is not None and image.format == "JPEG":
+                # decode at 1/2, 1/4 or 1/8 of the size, as far as the variant
+                # stays at least width wide, whichever way it is oriented
+                scale = width / min(image.size)
+                if scale < 1:
+                    image.draft(
+                        image.mode,
+                        (
+                            math.ceil(image.width * scale),
+                            math.ceil(image.height * scale),
+                        ),
+                    )
+            # the size is read from the header, before anything is decoded
+            if image.width * image.height > settings.IMAGE_VARIANT_MAX_PIXELS:
+                raise ValueError("Image too large.")
+
+            # apply the orientation, as the EXIF data is not kept
+            variant = ImageOps.exif_transpose(image)
+            if width is not None and variant.width > width:
+                height = max(1, round(variant.height * width / variant.width))
+                variant = variant.resize(
+                    (width, height), Image.Resampling.LANCZOS, reducing_gap=3.0
+                )
+            if extension == "jpeg" and variant.mode not in ("RGB", "L"):
+                variant = variant.convert("RGB")
+
+            output = BytesIO()
+            variant.save(output, FORMATS[extension], **SAVE_OPTIONS.get(extension, {}))
+    except (OSError, Image.DecompressionBombError) as error:
+        raise ValueError("Cannot read image.") from error
+    return output.getvalue()
+
+
+def get_variant(image, digest, width, extension):
+    """
+    Return the path of the variant of image, generating it unless cached.
+    Raises ValueError if the image cannot be read.
+    """
+    key = get_variant_key(digest, width, extension)
+    path = variant_cache.get(key)
+    if path is None:
+        data = make_variant(image.read_data(), width, extension)
+        path = variant_cache.put(key, data)
+    return path
@@ -0,0 +1,85 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef, Sum
+from django.db.models.functions import Coalesce, Length
+
+from main import models
+
+
+class Command(BaseCommand):
+    help = "Store missing image sizes and recount the image usage of every user."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of images or users to update per query.",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        self.stdout.write(self.style.NOTICE("Backfilling image sizes."))
+
+        # measured in the database, so that image bytes are never loaded
+        count_sized = 0
+        unsized = models.Image.objects.filter(size_bytes__isnull=True).order_by("id")
+        while True:
+            ids = list(unsized.values_list("id", flat=True)[:batch_size])
+            if not ids:
+                break
+            models.Image.objects.filter(id__in=ids).update(
+                size_bytes=Coalesce(Length("data"), 0)
+            )
+            count_sized += len(ids)
+            self.stdout.write(self.style.NOTICE(f"Sized {count_sized}."))
+
+        self.stdout.write(self.style.NOTICE("Recounting image usage."))
+        owner_ids = list(
+            models.Image.objects.order_by("owner_id")
+            .values_list("owner_id", flat=True)
+            .distinct()
+        )
+        for i in range(0, len(owner_ids), batch_size):
+            batch_ids = owner_ids[i : i + batch_size]
+            with transaction.atomic():
+                # uploads and deletes of these users wait for the recount
+                list(
+                    models.ImageUsage.objects.select_for_update()
+                    .filter(user_id__in=batch_ids)
+                    .values_list("user_id")
+                )
+                totals = (
+                    models.Image.objects.filter(owner_id__in=batch_ids)
+                    .values("owner_id")
+                    .annotate(count=Count("id"), size_bytes=Sum("size_bytes"))
+                    .order_by()
+                )
+                models.ImageUsage.objects.bulk_create(
+                    [
+                        models.ImageUsage(
+                            user_id=total["owner_id"],
+                            count=total["count"],
+                            size_bytes=total["size_bytes"] or 0,
+                        )
+                        for total in totals
+                    ],
+                    update_conflicts=True,
+                    unique_fields=["user"],
+                    update_fields=["count", "size_bytes"],
+                )
+            self.stdout.write(
+                self.style.NOTICE(f"Recounted {i + len(batch_ids)} users.")
+            )
+
+        # users left without images
+        models.ImageUsage.objects.filter(
+            ~Exists(models.Image.objects.filter(owner_id=OuterRef("user_id")))
+        ).update(count=0, size_bytes=0)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Backfill done. Total {count_sized} image sizes "
+                f"and {len(owner_ids)} users."
+            )
+        )
@@ -0,0 +1,132 @@
+import os
+import tempfile
+import tracemalloc
+import uuid
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.signals import request_finished
+from django.db import close_old_connections, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+from django.urls import reverse
+
+from main import models, storage
+from main.views import general
+
+
+def download_materialised(image):
+    """
+    Serves the image like before streaming: the whole bytes loaded from the
+    database and copied into the response.
+    """
+    data = models.Image.objects.filter(id=image.id).values_list("data", flat=True)
+    return HttpResponse(bytes(data.get()), content_type="image/" + image.extension)
+
+
+def download_streamed(image):
+    """Serves the image with the image_raw view."""
+    path = reverse("image_raw", args=(image.slug, image.extension))
+    request = RequestFactory().get(path)
+    return async_to_sync(general.image_raw)(request, image.slug, image.extension)
+
+
+def measure(download, image, downloads):
+    """
+    Returns the peak Python memory, in bytes, per download while serving the
+    image to a number of concurrent downloads, sending a chunk of each in turn.
+    """
+    # closing a response ends the request, which would close the database
+    # connection under the other downloads, so keep it like the test client
+    request_finished.disconnect(close_old_connections)
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        responses = [download(image) for _ in range(downloads)]
+        iterators = [iter(response) for response in responses]
+        while iterators:
+            for iterator in list(iterators):
+                if next(iterator, None) is None:
+                    iterators.remove(iterator)
+        for response in responses:
+            response.close()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        request_finished.connect(close_old_connections)
+    return (peak - baseline) / downloads
+
+
+class Command(BaseCommand):
+    help = "Benchmark memory per concurrent image download, materialised and streamed."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--size",
+            type=int,
+            default=1024,
+            help="Size of the sample image in KiB.",
+        )
+        parser.add_argument(
+            "--downloads",
+            type=int,
+            default=4,
+            help="Number of concurrent downloads.",
+        )
+        parser.add_argument(
+            "--i-know",
+            action="store_true",
+            help="Run with DEBUG off, eg. on the server, in a transaction rolled back.",
+        )
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options["i_know"]:
+            raise CommandError(
+                "Creates sample rows in the database; "
+                "run with DEBUG on, or pass --i-know."
+            )
+        data = os.urandom(options["size"] * 1024)
+        downloads = options["downloads"]
+        name = f"benchmarkimages-{uuid.uuid4().hex[:8]}"
+
+        # sample rows are never committed, and files are stored in a
+        # throwaway directory, even if the benchmark fails
+        with (
+            tempfile.TemporaryDirectory() as images_root,
+            override_settings(IMAGES_ROOT=images_root),
+            transaction.atomic(),
+        ):
+            try:
+                user = models.User.objects.create(username=name)
+                legacy = models.Image.objects.create(
+                    owner=user,
+                    name="legacy",
+                    slug=f"{name}-legacy",
+                    extension="jpeg",
+                    data=data,
+                )
+                stored = models.Image.objects.create(
+                    owner=user,
+                    name="stored",
+                    slug=f"{name}-stored",
+                    extension="jpeg",
+                    digest=storage.image_storage.save(data),
+                    size_bytes=len(data),
+                )
+                before = measure(download_materialised, legacy, downloads)
+                database = measure(download_streamed, legacy, downloads)
+                file = measure(download_streamed, stored, downloads)
+            finally:
+                transaction.set_rollback(True)
+
+        self.stdout.write(f"{downloads} concurrent downloads of {options['size']} KiB")
+        self.stdout.write(f"materialised: {before / 1024:.0f} KiB/download")
+        self.stdout.write(f"streamed from database: {database / 1024:.0f} KiB/download")
+        self.stdout.write(f"streamed from file: {file / 1024:.0f} KiB/download")
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"reduction: {before / database:.1f}x from database, "
+                f"{before / file:.1f}x from file"
+            )
+        )
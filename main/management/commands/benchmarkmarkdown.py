@@ -0,0 +1,69 @@
+import timeit
+from unittest.mock import patch
+
+from django.core.management.base import BaseCommand
+
+from main import util
+
+CODE_BLOCKS = [
+    "```python\ndef fib(n):\n    return n if n < 2 else fib(n - 1) + fib(n - 2)\n```\n",
+    "```js\nconst add = (a, b) => a + b;\nconsole.log(add(1, 2));\n```\n",
+    '```sh\nfor f in *.md; do\n    wc -l "$f"\ndone\n```\n',
+    '```go\nfunc main() {\n\tfmt.Println("hello")\n}\n```\n',
+]
+
+
+def get_sample_post(code_blocks):
+    """Returns a markdown post with prose and the given number of code blocks."""
+    section = "## Section\n\nSome *prose* with a [link](https://mataroa.blog/).\n\n"
+    return "".join(
+        section + CODE_BLOCKS[i % len(CODE_BLOCKS)] + "\n" for i in range(code_blocks)
+    )
+
+
+def render_cold(markdown_string):
+    """
+    Renders building every pipeline object from scratch and looking up the
+    lexer of every code block, like before pipeline objects were reused.
+    """
+    with patch.object(util, "get_lexer", util.get_lexer.__wrapped__):
+        return util.MarkdownRenderer().render(markdown_string)
+
+
+def render_warm(markdown_string):
+    """Renders with the reused per-thread pipeline objects."""
+    return util.render_markdown(markdown_string)
+
+
+class Command(BaseCommand):
+    help = "Benchmark markdown rendering with cold and reused pipeline objects."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--code-blocks",
+            type=int,
+            default=50,
+            help="Number of code blocks in the sample post.",
+        )
+        parser.add_argument(
+            "--runs",
+            type=int,
+            default=20,
+            help="Number of renders to time per variant.",
+        )
+
+    def handle(self, *args, **options):
+        sample = get_sample_post(options["code_blocks"])
+        runs = options["runs"]
+        if render_cold(sample) != render_warm(sample):
+            self.stdout.write(self.style.ERROR("Cold and warm output differ."))
+            return
+
+        cold = timeit.timeit(lambda: render_cold(sample), number=runs) / runs
+        warm = timeit.timeit(lambda: render_warm(sample), number=runs) / runs
+        self.stdout.write(
+            f"{options['code_blocks']} code blocks, {len(sample)} chars, {runs} runs"
+        )
+        self.stdout.write(f"cold: {cold * 1000:.2f} ms/render")
+        self.stdout.write(f"warm: {warm * 1000:.2f} ms/render")
+        self.stdout.write(self.style.SUCCESS(f"speedup: {cold / warm:.2f}x"))
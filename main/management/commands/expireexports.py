@@ -0,0 +1,39 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from main import models
+
+
+class Command(BaseCommand):
+    help = "Delete expired and failed blog exports and their files."
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.NOTICE("Deleting expired exports."))
+        now = timezone.now()
+        failed_before = now - timedelta(hours=settings.EXPORTS_EXPIRE_HOURS)
+        # files are deleted with their jobs, see storage.delete_export_file
+        count, _ = models.ExportJob.objects.filter(
+            Q(status=models.ExportJob.Status.DONE, expires_at__lte=now)
+            | Q(status=models.ExportJob.Status.FAILED, finished_at__lt=failed_before)
+        ).delete()
+
+        # partial files of workers stopped while writing
+        count_partial = 0
+        timed_out = time.time() - settings.EXPORTS_TIMEOUT_MINUTES * 60
+        if settings.EXPORTS_ROOT.exists():
+            for path in settings.EXPORTS_ROOT.glob(".tmp-*"):
+                if path.stat().st_mtime < timed_out:
+                    path.unlink(missing_ok=True)
+                    count_partial += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Expiry done. Total {count} exports "
+                f"and {count_partial} partial files deleted."
+            )
+        )
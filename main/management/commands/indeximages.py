@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main import models, util
+
+
+class Command(BaseCommand):
+    help = "Store which uploaded images every post and page body links to."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of posts or pages to update per query.",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.NOTICE("Indexing images of posts and pages."))
+        count_posts, count_post_links = self.index(models.Post, "post", options)
+        count_pages, count_page_links = self.index(models.Page, "page", options)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Indexing done. Total {count_post_links} images in {count_posts} "
+                f"posts and {count_page_links} images in {count_pages} pages."
+            )
+        )
+
+    def index(self, model, name, options):
+        """Replace the image links of every body of model. Returns counts."""
+        through = model.images.through
+        linking = model.objects.filter(body__contains="/images/")
+        # bodies that link no image anymore
+        through.objects.exclude(**{f"{name}__in": linking}).delete()
+
+        count_bodies = 0
+        count_links = 0
+        batch = []
+        bodies = linking.only("id", "body", "owner_id").order_by("id")
+        for item in bodies.iterator(chunk_size=options["batch_size"]):
+            batch.append(item)
+            if len(batch) >= options["batch_size"]:
+                count_links += self.index_batch(through, name, batch)
+                count_bodies += len(batch)
+                batch = []
+                self.stdout.write(self.style.NOTICE(f"Indexed {count_bodies}."))
+        if batch:
+            count_links += self.index_batch(through, name, batch)
+            count_bodies += len(batch)
+        return count_bodies, count_links
+
+    def index_batch(self, through, name, batch):
+        slugs_by_id = {item.id: util.get_image_slugs(item.body) for item in batch}
+        # only images of the owner of the body, see models.update_images
+        image_ids = {
+            (owner_id, slug): image_id
+            for image_id, owner_id, slug in models.Image.objects.filter(
+                slug__in=set().union(*slugs_by_id.values()),
+                owner_id__in={item.owner_id for item in batch},
+            ).values_list("id", "owner_id", "slug")
+        }
+        links = [
+            through(**{f"{name}_id": item.id, "image_id": image_ids[key]})
+            for item in batch
+            for key in ((item.owner_id, slug) for slug in slugs_by_id[item.id])
+            if key in image_ids
+        ]
+        with transaction.atomic():
+            through.objects.filter(**{f"{name}_id__in": slugs_by_id}).delete()
+            through.objects.bulk_create(links)
+        return len(links)
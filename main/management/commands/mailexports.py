@@ -1,14 +1,17 @@
-import io
-import uuid
-import zipfile
+import tempfile
+import threading
+import time
 from datetime import datetime
+from pathlib import Path
+from queue import Empty, Queue
 
+from django import db
 from django.conf import settings
 from django.core import mail
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 
-from main import models, util
+from main import exports, models, util
 
 
 def get_mail_connection():
@@ -43,9 +46,48 @@ Stop receiving exports:
     return body
 
 
+def get_pending_users(since):
+    """
+    Users to email, except those emailed since then, by an earlier run of
+    the same day.
+    """
+    return (
+        models.User.objects.filter(mail_export_on=True)
+        .exclude(exportrecord__sent_at__gte=since)
+        .order_by("id")
+    )
+
+
+def get_email(user, export_name, zip_outfile):
+    today = datetime.now().date().isoformat()
+    return mail.EmailMessage(
+        subject=f"Mataroa export {today} — {user.username}.{settings.CANONICAL_HOST}",
+        body=get_email_body(user),
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[user.email],
+        headers={
+            "X-PM-Message-Stream": "exports",  # postmark-specific header
+            "List-Unsubscribe": get_unsubscribe_url(user),
+            "List-Unsubscribe-Post": "List-Unsubscribe=One-Click",
+        },
+        attachments=[
+            (f"{export_name}.zip", zip_outfile.read_bytes(), "application/zip")
+        ],
+    )
+
+
 class Command(BaseCommand):
     help = "Generate zip account exports and email them to users."
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of exports built and sent at once, each worker over "
+            "its own SMTP connection.",
+        )
+
     def handle(self, *args, **options):
         if timezone.now().day != 1:
             msg = "No action. Not the first day of the month."
@@ -54,63 +96,101 @@ class Command(BaseCommand):
 
         self.stdout.write(self.style.NOTICE("Processing email exports."))
 
-        # gather all user posts for all users
-        users = models.User.objects.filter(mail_export_on=True)
-        for user in users:
-            self.stdout.write(self.style.NOTICE(f"Processing user {user.username}."))
-
-            user_posts = models.Post.objects.filter(owner=user)
-            export_posts = []
-            for p in user_posts:
-                pub_date = p.published_at or p.created_at
-                title = p.slug + ".md"
-                body = (
-                    f"# {p.title}\n\n"
-                    f"> Published on {pub_date.strftime('%b %-d, %Y')}\n\n"
-                    f"{p.body}\n"
-                )
-                export_posts.append((title, io.BytesIO(body.encode())))
-
-            # write zip archive in /tmp/
-            export_name = "export-markdown-" + str(uuid.uuid4())[:8]
-            container_dir = f"{user.username}-mataroa-blog"
-            zip_outfile = f"/tmp/{export_name}.zip"
-            with zipfile.ZipFile(
-                zip_outfile, "a", zipfile.ZIP_DEFLATED, False
-            ) as export_archive:
-                for file_name, data in export_posts:
-                    export_archive.writestr(
-                        export_name + f"/{container_dir}/" + file_name, data.getvalue()
-                    )
-
-            # reopen zipfile and load in memory
-            with open(zip_outfile, "rb") as f:
-                # create emails
-                today = datetime.now().date().isoformat()
-                email = mail.EmailMessage(
-                    subject=f"Mataroa export {today} — {user.username}.{settings.CANONICAL_HOST}",
-                    body=get_email_body(user),
-                    from_email=settings.DEFAULT_FROM_EMAIL,
-                    to=[user.email],
-                    headers={
-                        "X-PM-Message-Stream": "exports",  # postmark-specific header
-                        "List-Unsubscribe": get_unsubscribe_url(user),
-                        "List-Unsubscribe-Post": "List-Unsubscribe=One-Click",
-                    },
-                    attachments=[(f"{export_name}.zip", f.read(), "application/zip")],
-                )
-
-            # sent out messages
-            connection = get_mail_connection()
-            connection.send_messages([email])
-            self.stdout.write(self.style.SUCCESS(f"Export sent to {user.username}."))
-
-            # log export record
-            name = f"{export_name}.zip"
-            record = models.ExportRecord.objects.create(name=name, user=user)
+        # users emailed by an earlier run today are done, so a rerun after a
+        # crash carries on where it stopped
+        today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        count_skipped = (
+            models.ExportRecord.objects.filter(sent_at__gte=today)
+            .values("user")
+            .distinct()
+            .count()
+        )
+        if count_skipped:
             self.stdout.write(
-                self.style.SUCCESS(f"Logging export record for '{record.name}'.")
+                self.style.NOTICE(f"Skipping {count_skipped} users exported today.")
             )
+        user_ids = Queue()
+        for user_id in get_pending_users(today).values_list("id", flat=True):
+            user_ids.put(user_id)
+
+        self.lock = threading.Lock()
+        self.count_sent = 0
+        self.count_failed = 0
+        started = time.monotonic()
+        workers = min(options["workers"], user_ids.qsize())
+        if workers <= 1:
+            self.work(user_ids)
+        else:
+            threads = [
+                threading.Thread(target=self.work, args=(user_ids, True))
+                for _ in range(workers)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        elapsed = time.monotonic() - started
 
         # log all users mailing is complete
-        self.stdout.write(self.style.SUCCESS("Emailing all exports complete."))
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Emailing all exports complete. Total {self.count_sent} sent and "
+                f"{self.count_failed} failed in {elapsed:.1f}s "
+                f"({self.count_sent / max(elapsed, 0.001):.1f} exports/s)."
+            )
+        )
+
+    def log(self, msg, style):
+        with self.lock:
+            self.stdout.write(style(msg))
+
+    def work(self, user_ids, threaded=False):
+        """Export the users of the queue until it is empty, over one connection."""
+        connection = get_mail_connection()
+        try:
+            while True:
+                try:
+                    user_id = user_ids.get_nowait()
+                except Empty:
+                    break
+                user = models.User.objects.get(id=user_id)
+                try:
+                    # reopens the connection if the previous send closed it
+                    connection.open()
+                    self.export(user, connection)
+                except Exception as ex:
+                    connection.close()
+                    with self.lock:
+                        self.count_failed += 1
+                    self.log(
+                        f"Export for {user.username} failed: {ex!r}", self.style.ERROR
+                    )
+                else:
+                    with self.lock:
+                        self.count_sent += 1
+        finally:
+            connection.close()
+            if threaded:
+                db.connection.close()
+
+    def export(self, user, connection):
+        self.log(f"Processing user {user.username}.", self.style.NOTICE)
+
+        # the zip archive is written to a temporary directory as it is built,
+        # with the builder of the markdown export on the website, and deleted
+        # once sent
+        export_format = models.ExportJob.Format.MARKDOWN
+        export_name = exports.get_export_name(export_format)
+        with tempfile.TemporaryDirectory() as export_dir:
+            zip_outfile = Path(export_dir) / f"{export_name}.zip"
+            exports.write_export(zip_outfile, user, export_format, export_name)
+            email = get_email(user, export_name, zip_outfile)
+
+        # sent out messages
+        connection.send_messages([email])
+        self.log(f"Export sent to {user.username}.", self.style.SUCCESS)
+
+        # log export record, after which reruns of today skip the user
+        name = f"{export_name}.zip"
+        record = models.ExportRecord.objects.create(name=name, user=user)
+        self.log(f"Logging export record for '{record.name}'.", self.style.SUCCESS)
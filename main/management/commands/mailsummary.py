@@ -3,9 +3,8 @@ from datetime import datetime, timedelta
 from django.conf import settings
 from django.core import mail
 from django.core.management.base import BaseCommand
-from django.db.models import Count, Q
 
-from main import models
+from main import analytics, models
 
 
 def build_summary_text(target_date: datetime.date) -> str:
@@ -31,19 +30,22 @@ def build_summary_text(target_date: datetime.date) -> str:
         .order_by("-created_at")
     )
 
-    post_visits_count = models.AnalyticPost.objects.filter(
-        created_at__date=target_date
-    ).count()
-    top_posts_by_visits_qs = (
-        models.Post.objects.filter(analyticpost__created_at__date=target_date)
-        .annotate(
-            visit_count=Count(
-                "analyticpost", filter=Q(analyticpost__created_at__date=target_date)
-            )
-        )
-        .select_related("owner")
-        .order_by("-visit_count", "-id")
+    # read from the daily rollups, as raw hits of past days may be pruned
+    post_counts = analytics.counts_on(
+        models.AnalyticPost, models.AnalyticPostDay, target_date, "post"
+    )
+    page_counts = analytics.counts_on(
+        models.AnalyticPage, models.AnalyticPageDay, target_date, "user"
+    )
+    top_post_ids = sorted(
+        post_counts, key=lambda post_id: (post_counts[post_id], post_id), reverse=True
+    )[:20]
+    top_posts_by_visits = list(
+        models.Post.objects.filter(id__in=top_post_ids).select_related("owner")
     )
+    for post in top_posts_by_visits:
+        post.visit_count = post_counts[post.id]
+    top_posts_by_visits.sort(key=lambda post: (post.visit_count, post.id), reverse=True)
 
     lines: list[str] = []
     lines.append(f"Moderation — Summary {target_date.strftime('%Y-%m-%d')}")
@@ -53,12 +55,13 @@ def build_summary_text(target_date: datetime.date) -> str:
     lines.append(f"- New posts: {new_posts_qs.count()}")
     lines.append(f"- New pages: {new_pages_qs.count()}")
     lines.append(f"- New comments: {new_comments_qs.count()}")
-    lines.append(f"- Post visits: {post_visits_count}")
+    lines.append(f"- Post visits: {sum(post_counts.values())}")
+    lines.append(f"- Page visits: {sum(page_counts.values())}")
     lines.append("")
 
     lines.append("Top Posts by Visits")
-    if top_posts_by_visits_qs.exists():
-        for post in top_posts_by_visits_qs[:20]:
+    if top_posts_by_visits:
+        for post in top_posts_by_visits:
             lines.append(
                 f"- {post.title} — {post.visit_count} — {post.owner.username} — {post.get_proper_url}"
             )
@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main import models, storage
+
+
+class Command(BaseCommand):
+    help = "Move image bytes from the database into the image storage."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=50,
+            help="Number of images to load in memory and update per query.",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.NOTICE("Moving images."))
+
+        pending = (
+            models.Image.objects.filter(digest="")
+            .exclude(data__isnull=True)
+            .order_by("id")
+        )
+        count_moved = 0
+        count_bytes = 0
+        deduplicated_before = storage.image_storage.deduplicated
+        while True:
+            batch = list(pending.values_list("id", "data")[: options["batch_size"]])
+            if not batch:
+                break
+
+            # files are written first, so an interrupted run loses nothing
+            # and the next one finds them already stored
+            updates = []
+            for image_id, data in batch:
+                data = bytes(data)
+                digest = storage.image_storage.save(data)
+                updates.append((image_id, digest, len(data)))
+                count_bytes += len(data)
+
+            with transaction.atomic():
+                for image_id, digest, size_bytes in updates:
+                    models.Image.objects.filter(id=image_id).update(
+                        digest=digest, size_bytes=size_bytes, data=None
+                    )
+            count_moved += len(batch)
+            self.stdout.write(self.style.NOTICE(f"Moved {count_moved}."))
+
+        count_deduplicated = storage.image_storage.deduplicated - deduplicated_before
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Moving done. Total {count_moved} images, {count_bytes} bytes "
+                f"({count_deduplicated} already stored)."
+            )
+        )
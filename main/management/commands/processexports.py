@@ -0,0 +1,90 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from main import exports, models
+
+
+def claim_job():
+    """
+    Mark the oldest pending job, or one running for longer than the timeout,
+    as running and return it. Workers skip the jobs others are claiming.
+    """
+    timed_out = timezone.now() - timedelta(minutes=settings.EXPORTS_TIMEOUT_MINUTES)
+    with transaction.atomic():
+        job = (
+            models.ExportJob.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(status=models.ExportJob.Status.PENDING)
+                | Q(status=models.ExportJob.Status.RUNNING, started_at__lt=timed_out)
+            )
+            .select_related("user")
+            .order_by("created_at")
+            .first()
+        )
+        if job:
+            job.status = models.ExportJob.Status.RUNNING
+            job.started_at = timezone.now()
+            job.save(update_fields=["status", "started_at"])
+    return job
+
+
+def run_job(job):
+    try:
+        job.size_bytes = exports.write_export(job.path, job.user, job.format, job.name)
+    except Exception as ex:
+        job.status = models.ExportJob.Status.FAILED
+        job.error = repr(ex)
+    else:
+        job.status = models.ExportJob.Status.DONE
+        job.expires_at = timezone.now() + timedelta(hours=settings.EXPORTS_EXPIRE_HOURS)
+    job.finished_at = timezone.now()
+    job.save(
+        update_fields=["status", "size_bytes", "error", "finished_at", "expires_at"]
+    )
+
+
+class Command(BaseCommand):
+    help = "Build the queued blog exports into files for download."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--poll",
+            type=int,
+            help="Keep running, checking for new jobs every this many seconds.",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.NOTICE("Processing export jobs."))
+        count_done = 0
+        count_failed = 0
+        while True:
+            job = claim_job()
+            if not job:
+                if not options["poll"]:
+                    break
+                time.sleep(options["poll"])
+                continue
+
+            self.stdout.write(
+                self.style.NOTICE(f"Building {job.filename} for {job.user.username}.")
+            )
+            run_job(job)
+            if job.status == models.ExportJob.Status.DONE:
+                count_done += 1
+            else:
+                count_failed += 1
+                self.stdout.write(
+                    self.style.ERROR(f"Export {job.filename} failed: {job.error}")
+                )
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Exports done. Total {count_done} built and {count_failed} failed."
+            )
+        )
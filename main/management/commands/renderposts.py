@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from main import models, util
+
+
+class Command(BaseCommand):
+    help = "Render and store post body HTML that is missing or stale."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            dest="all",
+            help="Re-render all posts, not only missing or stale ones.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of posts to update per query.",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.NOTICE("Rendering post bodies."))
+
+        post_list = models.Post.objects.only(
+            "id", "body", "body_html", "body_html_version"
+        ).order_by("id")
+        if not options["all"]:
+            post_list = post_list.filter(
+                Q(body_html__isnull=True) | ~Q(body_html_version=util.MARKDOWN_VERSION)
+            )
+
+        count_rendered = 0
+        batch = []
+        for post in post_list.iterator(chunk_size=options["batch_size"]):
+            post.render_body()
+            batch.append(post)
+            if len(batch) >= options["batch_size"]:
+                models.Post.objects.bulk_update(
+                    batch, ["body_html", "body_html_version"]
+                )
+                count_rendered += len(batch)
+                batch = []
+                self.stdout.write(self.style.NOTICE(f"Rendered {count_rendered}."))
+        if batch:
+            models.Post.objects.bulk_update(batch, ["body_html", "body_html_version"])
+            count_rendered += len(batch)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Rendering done. Total {count_rendered} posts "
+                f"(version {util.MARKDOWN_VERSION})."
+            )
+        )
@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from main import analytics, models
+
+
+class Command(BaseCommand):
+    help = "Count raw analytics hits per day into rollup tables."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--prune-days",
+            type=int,
+            default=None,
+            help="Delete raw hits older than this many days, once rolled up.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of day rows to write per query.",
+        )
+
+    def handle(self, *args, **options):
+        if options["prune_days"] is not None and options["prune_days"] < 1:
+            raise CommandError("--prune-days must be at least 1.")
+
+        self.stdout.write(self.style.NOTICE("Rolling up analytics."))
+
+        count_post_days = analytics.rollup(
+            models.AnalyticPost,
+            models.AnalyticPostDay,
+            group_by=["post"],
+            batch_size=options["batch_size"],
+        )
+        count_page_days = analytics.rollup(
+            models.AnalyticPage,
+            models.AnalyticPageDay,
+            group_by=["user", "path"],
+            batch_size=options["batch_size"],
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Rollup done. Total {count_post_days} post days "
+                f"and {count_page_days} page days."
+            )
+        )
+
+        if options["prune_days"] is not None:
+            count_posts = analytics.prune(
+                models.AnalyticPost, models.AnalyticPostDay, options["prune_days"]
+            )
+            count_pages = analytics.prune(
+                models.AnalyticPage, models.AnalyticPageDay, options["prune_days"]
+            )
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Pruning done. Deleted {count_posts} post hits "
+                    f"and {count_pages} page hits."
+                )
+            )
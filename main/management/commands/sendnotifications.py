@@ -0,0 +1,336 @@
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core import mail
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from main import models, util
+
+# immediate attempts per email, waiting RETRY_BACKOFF_SECONDS, then twice that
+SEND_ATTEMPTS = 3
+RETRY_BACKOFF_SECONDS = 2
+
+# queued again after QUEUE_BACKOFF, then twice that, until MAX_ATTEMPTS runs
+MAX_ATTEMPTS = 5
+QUEUE_BACKOFF = timedelta(minutes=10)
+
+# records claimed by a sender that has not updated them by then are claimed
+# again, as its run must have stopped
+SENDING_LEASE = timedelta(minutes=15)
+
+Status = models.NotificationRecord.Status
+
+
+def get_mail_connection():
+    if settings.DEBUG:
+        return mail.get_connection("django.core.mail.backends.console.EmailBackend")
+
+    # SMPT EmailBackend instantiated with the broadcast-specific email host
+    return mail.get_connection(
+        "django.core.mail.backends.smtp.EmailBackend",
+        host=settings.EMAIL_HOST_BROADCASTS,
+    )
+
+
+def get_email_body_head(post):
+    """
+    Returns the email body (which contains the post body) along with titles
+    and links, up to the unsubscribe URL, which differs per subscriber.
+    """
+    post_url = util.get_protocol() + post.get_proper_url()
+    blog_title = post.owner.blog_title or post.owner.username
+
+    body = f"""{blog_title} has published:
+
+# {post.title}
+
+{post_url}
+
+{post.body}
+
+---
+
+Blog post URL:
+{post_url}
+
+---
+
+Unsubscribe:
+"""
+    return body
+
+
+class PostEmail:
+    """
+    The email of a post, rendered once, from which each subscriber's email
+    is built with only their address and unsubscribe URL.
+    """
+
+    def __init__(self, post):
+        blog_title = post.owner.username
+        # email sender name cannot contain commas
+        if post.owner.blog_title and "," not in post.owner.blog_title:
+            blog_title = post.owner.blog_title
+
+        self.subject = post.title
+        self.from_email = (
+            f"{blog_title} <{post.owner.username}@{settings.EMAIL_FROM_HOST}>"
+        )
+        self.body_head = get_email_body_head(post)
+
+    def get_email(self, notification):
+        """Returns the email object, containing all info needed to be sent."""
+        unsubscribe_url = util.get_protocol() + notification.get_unsubscribe_url()
+        return mail.EmailMessage(
+            subject=self.subject,
+            body=self.body_head + unsubscribe_url + "\n",
+            from_email=self.from_email,
+            to=[notification.email],
+            headers={
+                "X-PM-Message-Stream": "newsletters",
+                "List-Unsubscribe": unsubscribe_url,
+                "List-Unsubscribe-Post": "List-Unsubscribe=One-Click",
+            },
+        )
+
+
+class TokenBucket:
+    """
+    Allows rate acquisitions per second on average, and bursts of up to
+    burst, shared by all threads.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            # a token short, wait for it, and reserve it so that the next
+            # callers wait for the ones after
+            wait = max(0, (1 - self.tokens) / self.rate)
+            self.tokens -= 1
+        if wait:
+            time.sleep(wait)
+
+
+class Sender:
+    """
+    Sends chunks of emails from a pool of threads, over one connection each,
+    at the rate of the bucket, retrying failed sends with exponential backoff.
+    """
+
+    def __init__(self, connections, bucket):
+        self.connections = connections
+        self.bucket = bucket
+        self.local = threading.local()
+        self.opened = []
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=connections)
+
+    def get_connection(self):
+        if not hasattr(self.local, "connection"):
+            self.local.connection = get_mail_connection()
+            with self.lock:
+                self.opened.append(self.local.connection)
+        return self.local.connection
+
+    def send(self, email):
+        """Sends email, or raises the exception of its last attempt."""
+        connection = self.get_connection()
+        for attempt in range(SEND_ATTEMPTS):
+            self.bucket.acquire()
+            try:
+                # reopens the connection if a failed attempt closed it
+                connection.open()
+                connection.send_messages([email])
+                return
+            except Exception:
+                connection.close()
+                if attempt == SEND_ATTEMPTS - 1:
+                    raise
+                time.sleep(RETRY_BACKOFF_SECONDS * 2**attempt)
+
+    def send_chunk(self, records, post_emails):
+        """Returns a (record, exception) pair per failed email."""
+        failures = []
+        for record in records:
+            email = post_emails[record.post_id].get_email(record.notification)
+            try:
+                self.send(email)
+            except Exception as ex:
+                failures.append((record, ex))
+        return failures
+
+    def submit(self, records, post_emails):
+        return self.executor.submit(self.send_chunk, records, post_emails)
+
+    def close(self):
+        self.executor.shutdown()
+        for connection in self.opened:
+            connection.close()
+
+
+def claim_records(batch_size):
+    """
+    Mark a batch of due records as sending, and return them. Concurrent
+    senders skip the records others are claiming.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            models.NotificationRecord.objects.select_for_update(skip_locked=True)
+            .filter(
+                status__in=[Status.QUEUED, Status.SENDING], next_attempt_at__lte=now
+            )
+            .order_by("next_attempt_at", "id")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        models.NotificationRecord.objects.filter(id__in=ids).update(
+            status=Status.SENDING,
+            attempts=F("attempts") + 1,
+            next_attempt_at=now + SENDING_LEASE,
+        )
+    return list(
+        models.NotificationRecord.objects.filter(id__in=ids)
+        .select_related("post__owner", "notification__blog_user")
+        .order_by("id")
+    )
+
+
+class Command(BaseCommand):
+    help = "Send the queued newsletter emails, at a limited rate."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=10,
+            help="Emails sent per second, on average.",
+        )
+        parser.add_argument(
+            "--burst",
+            type=int,
+            default=20,
+            help="Emails sent at once before the rate applies.",
+        )
+        parser.add_argument(
+            "--connections",
+            type=int,
+            default=4,
+            help="Number of SMTP connections to send over at once.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of records claimed, and updated, at a time.",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.NOTICE("Sending queued notifications."))
+        counts = defaultdict(int)
+        started = time.monotonic()
+        sender = Sender(
+            options["connections"], TokenBucket(options["rate"], options["burst"])
+        )
+        post_emails = {}
+        try:
+            while records := claim_records(options["batch_size"]):
+                self.send_batch(records, sender, post_emails, counts)
+        finally:
+            sender.close()
+        elapsed = time.monotonic() - started
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Sending done. Total {counts['sent']} sent, {counts['retry']} "
+                f"queued for retry, {counts['failed']} failed and "
+                f"{counts['dropped']} dropped in {elapsed:.1f}s "
+                f"({counts['sent'] / max(elapsed, 0.001):.1f} emails/s)."
+            )
+        )
+
+    def send_batch(self, records, sender, post_emails, counts):
+        # deleted posts, and subscribers who left since, get nothing
+        dropped = [
+            r
+            for r in records
+            if not r.post or not r.notification or not r.notification.is_active
+        ]
+        models.NotificationRecord.objects.filter(
+            id__in=[r.id for r in dropped]
+        ).delete()
+        records = [r for r in records if r not in dropped]
+        counts["dropped"] += len(dropped)
+
+        for record in records:
+            if record.post_id not in post_emails:
+                post_emails[record.post_id] = PostEmail(record.post)
+
+        # one chunk per connection
+        chunk_size = -(-len(records) // sender.connections) or 1
+        futures = [
+            sender.submit(records[i : i + chunk_size], post_emails)
+            for i in range(0, len(records), chunk_size)
+        ]
+        failures = {}
+        for future in futures:
+            failures.update(future.result())
+
+        # state updates, one query per outcome
+        now = timezone.now()
+        sent_ids = []
+        for record in records:
+            if record not in failures:
+                sent_ids.append(record.id)
+                msg = (
+                    f"Email sent for '{record.post.title}' "
+                    f"to '{record.notification.email}'."
+                )
+                self.stdout.write(self.style.SUCCESS(msg))
+        models.NotificationRecord.objects.filter(id__in=sent_ids).update(
+            status=Status.SENT, sent_at=now, next_attempt_at=None
+        )
+        counts["sent"] += len(sent_ids)
+        retry_ids_by_attempts = defaultdict(list)
+        failed_ids = []
+        for record, ex in failures.items():
+            msg = (
+                f"Failed to send '{record.post.title}' to {record.notification.email}."
+            )
+            self.stdout.write(self.style.ERROR(msg))
+            self.stdout.write(self.style.ERROR(repr(ex)))
+            if record.attempts >= MAX_ATTEMPTS:
+                failed_ids.append(record.id)
+            else:
+                retry_ids_by_attempts[record.attempts].append(record.id)
+        models.NotificationRecord.objects.filter(id__in=failed_ids).update(
+            status=Status.FAILED, next_attempt_at=None
+        )
+        counts["failed"] += len(failed_ids)
+        for attempts, ids in retry_ids_by_attempts.items():
+            models.NotificationRecord.objects.filter(id__in=ids).update(
+                status=Status.QUEUED,
+                next_attempt_at=now + QUEUE_BACKOFF * 2 ** (attempts - 1),
+            )
+            counts["retry"] += len(ids)
+
+        self.stdout.write(
+            self.style.NOTICE(f"Sent {len(sent_ids)} of {len(records)} claimed.")
+        )
@@ -0,0 +1,73 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main import models, storage
+
+
+class Command(BaseCommand):
+    help = "Delete stored image files that no image refers to anymore."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-age-hours",
+            type=int,
+            default=24,
+            help="Keep unused files written or uploaded again since then.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of files to look up per query.",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.NOTICE("Sweeping image storage."))
+        # files of uploads whose Image is not saved yet are recent, so files
+        # unused and untouched since then are not going to be used
+        cutoff = time.time() - options["min_age_hours"] * 3600
+
+        count_unused = 0
+        count_partial = 0
+        batch = []
+        for path in storage.image_storage.iter_paths():
+            if path.name.startswith(".tmp-"):
+                # of workers stopped while writing
+                count_partial += self.delete_if_old(path, cutoff)
+                continue
+            batch.append(path)
+            if len(batch) >= options["batch_size"]:
+                count_unused += self.sweep_batch(batch, cutoff)
+                batch = []
+        if batch:
+            count_unused += self.sweep_batch(batch, cutoff)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Sweep done. Total {count_unused} unused files "
+                f"and {count_partial} partial files deleted."
+            )
+        )
+
+    def sweep_batch(self, paths, cutoff):
+        used = set(
+            models.Image.objects.filter(
+                digest__in=[path.name for path in paths]
+            ).values_list("digest", flat=True)
+        )
+        # age is checked after the lookup, so that files uploaded again
+        # meanwhile are kept
+        return sum(
+            self.delete_if_old(path, cutoff) for path in paths if path.name not in used
+        )
+
+    def delete_if_old(self, path, cutoff):
+        """Delete path unless modified since cutoff. Returns 1 if deleted."""
+        try:
+            if path.stat().st_mtime >= cutoff:
+                return 0
+        except FileNotFoundError:
+            return 0
+        path.unlink(missing_ok=True)
+        return 1
@@ -2,9 +2,23 @@ from timeit import default_timer as timer
 
 from django.conf import settings
 from django.http import Http404, HttpResponseBadRequest
-from django.shortcuts import redirect
+from django.shortcuts import get_object_or_404, redirect
+from django.utils.functional import SimpleLazyObject
 
-from main import denylist, models, util
+from main import caching, denylist, models, util
+
+
+def set_blog_user(request, blog_host):
+    """
+    Set request.blog_user, loaded only when first accessed, and the theme flags
+    from the cached blog_host dict.
+    """
+    request.blog_host = blog_host
+    request.blog_user = SimpleLazyObject(
+        lambda: get_object_or_404(models.User, id=blog_host["id"])
+    )
+    request.theme_zialucia = blog_host["theme_zialucia"]
+    request.theme_sansserif = blog_host["theme_sansserif"]
 
 
 def host_middleware(get_response):
@@ -41,13 +55,11 @@ def host_middleware(get_response):
             # check if subdomain is disallowed
             if request.subdomain in denylist.DISALLOWED_USERNAMES:
                 return redirect(f"{util.get_protocol()}//{settings.CANONICAL_HOST}")
-            # check if subdomain exists as blog
-            elif models.User.objects.filter(username=request.subdomain).exists():
-                request.blog_user = models.User.objects.get(username=request.subdomain)
 
-                # set theme
-                request.theme_zialucia = request.blog_user.theme_zialucia
-                request.theme_sansserif = request.blog_user.theme_sansserif
+            # check if subdomain exists as blog
+            blog_host = caching.get_blog_host_by_username(request.subdomain)
+            if blog_host:
+                set_blog_user(request, blog_host)
 
                 # redirect to custom and/or retired urls for cases:
                 # * logged out / anon users
@@ -57,15 +69,13 @@ def host_middleware(get_response):
                     and request.user.username != request.subdomain
                 ):
                     redir_domain = ""
-                    if request.blog_user.custom_domain:  # user has set custom domain
-                        redir_domain = (
-                            request.blog_user.custom_domain + request.path_info
-                        )
+                    if blog_host["custom_domain"]:  # user has set custom domain
+                        redir_domain = blog_host["custom_domain"] + request.path_info
 
                     # user has retired their mataroa blog, redirect to new domain
-                    if request.blog_user.redirect_domain:
+                    if blog_host["redirect_domain"]:
                         redir_domain = (
-                            request.blog_user.redirect_domain + request.path_info[5:]
+                            blog_host["redirect_domain"] + request.path_info[5:]
                         )
 
                     # if there is no protocol prefix,
@@ -77,17 +87,15 @@ def host_middleware(get_response):
                         return redirect(redir_domain)
             else:
                 raise Http404()
-        elif models.User.objects.filter(custom_domain=host).exists():
+        elif blog_host := caching.get_blog_host_by_domain(host):
             # custom domain case
-            request.blog_user = models.User.objects.get(custom_domain=host)
-            request.subdomain = request.blog_user.username
-            request.theme_zialucia = request.blog_user.theme_zialucia
-            request.theme_sansserif = request.blog_user.theme_sansserif
+            set_blog_user(request, blog_host)
+            request.subdomain = blog_host["username"]
 
             # if user has retired their mataroa blog (and keeps the custom domain)
             # redirect to new domain
-            if request.blog_user.redirect_domain:
-                redir_domain = request.blog_user.redirect_domain + request.path_info[5:]
+            if blog_host["redirect_domain"]:
+                redir_domain = blog_host["redirect_domain"] + request.path_info[5:]
 
                 # if there is no protocol prefix,
                 # prepend double slashes to indicate other domain
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0104_alter_onboard_problems_alter_onboard_quality_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="post",
+            name="body_html",
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="post",
+            name="body_html_version",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:11
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0105_post_body_html"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="analyticpage",
+            name="created_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name="analyticpost",
+            name="created_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
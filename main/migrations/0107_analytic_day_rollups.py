@@ -0,0 +1,83 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:14
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0106_analytic_created_at_default"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="analyticpage",
+            name="created_at",
+            field=models.DateTimeField(
+                db_index=True, default=django.utils.timezone.now
+            ),
+        ),
+        migrations.AlterField(
+            model_name="analyticpost",
+            name="created_at",
+            field=models.DateTimeField(
+                db_index=True, default=django.utils.timezone.now
+            ),
+        ),
+        migrations.CreateModel(
+            name="AnalyticPageDay",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("path", models.CharField(max_length=300)),
+                ("date", models.DateField(db_index=True)),
+                ("count", models.PositiveIntegerField(default=0)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["-date"],
+                "unique_together": {("user", "path", "date")},
+            },
+        ),
+        migrations.CreateModel(
+            name="AnalyticPostDay",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField(db_index=True)),
+                ("count", models.PositiveIntegerField(default=0)),
+                (
+                    "post",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="main.post"
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["-date"],
+                "unique_together": {("post", "date")},
+            },
+        ),
+    ]
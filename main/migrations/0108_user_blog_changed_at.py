@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:19
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0107_analytic_day_rollups"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="blog_changed_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0108_user_blog_changed_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="image",
+            name="digest",
+            field=models.CharField(
+                blank=True, db_index=True, default="", max_length=64
+            ),
+        ),
+        migrations.AddField(
+            model_name="image",
+            name="size_bytes",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name="image",
+            name="data",
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
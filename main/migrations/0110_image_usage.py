@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:30
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0109_image_storage"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ImageUsage",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="image_usage",
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                ("count", models.PositiveIntegerField(db_index=True, default=0)),
+                (
+                    "size_bytes",
+                    models.PositiveBigIntegerField(db_index=True, default=0),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0110_image_usage"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="page",
+            name="images",
+            field=models.ManyToManyField(
+                blank=True, related_name="pages", to="main.image"
+            ),
+        ),
+        migrations.AddField(
+            model_name="post",
+            name="images",
+            field=models.ManyToManyField(
+                blank=True, related_name="posts", to="main.image"
+            ),
+        ),
+    ]
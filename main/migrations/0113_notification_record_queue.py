@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0112_export_job"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="notificationrecord",
+            name="attempts",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="notificationrecord",
+            name="next_attempt_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="notificationrecord",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("queued", "Queued"),
+                    ("sending", "Sending"),
+                    ("sent", "Sent"),
+                    ("failed", "Failed"),
+                ],
+                default="sent",
+                max_length=20,
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="notificationrecord",
+            index=models.Index(
+                condition=models.Q(("status__in", ["queued", "sending"])),
+                fields=["next_attempt_at"],
+                name="notificationrecord_due_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:54
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0113_notification_record_queue"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="index_posts_per_page",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="Show this many posts on the blog index, with older ones on further pages and yearly archives. Leave empty to show all posts.",
+                null=True,
+                validators=[django.core.validators.MinValueValidator(1)],
+                verbose_name="Posts per page",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="post",
+            index=models.Index(
+                fields=["owner", "-published_at", "-created_at"],
+                include=("slug", "title"),
+                name="post_owner_published_idx",
+            ),
+        ),
+    ]
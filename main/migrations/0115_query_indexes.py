@@ -0,0 +1,98 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:58
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+# the foreign key indexes that the composite indexes now lead with, dropped
+# on their own rather than by altering the fields, which would also drop and
+# validate again their foreign key constraints
+REDUNDANT_INDEXES = [
+    ("main_post_owner_id_882a5722", "main_post", "owner_id"),
+    ("main_comment_post_id_8158f528", "main_comment", "post_id"),
+    ("main_analytic_post_id_1e0e27d9", "main_analyticpost", "post_id"),
+    ("main_analyticpage_user_id_291443ae", "main_analyticpage", "user_id"),
+]
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0114_blog_index_pagination"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="analyticpage",
+            index=models.Index(
+                fields=["user", "path", "created_at"], name="analyticpage_user_path_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="analyticpost",
+            index=models.Index(
+                fields=["post", "created_at"], name="analyticpost_post_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="comment",
+            index=models.Index(
+                fields=["post", "is_approved", "created_at"],
+                name="comment_post_approved_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="post",
+            index=models.Index(
+                condition=models.Q(("broadcasted_at__isnull", True)),
+                fields=["published_at"],
+                name="post_unbroadcasted_idx",
+            ),
+        ),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    sql=f'DROP INDEX IF EXISTS "{name}";',
+                    reverse_sql=f'CREATE INDEX "{name}" ON "{table}" ("{column}");',
+                )
+                for name, table, column in REDUNDANT_INDEXES
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name="analyticpage",
+                    name="user",
+                    field=models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                migrations.AlterField(
+                    model_name="analyticpost",
+                    name="post",
+                    field=models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="main.post",
+                    ),
+                ),
+                migrations.AlterField(
+                    model_name="comment",
+                    name="post",
+                    field=models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="main.post",
+                    ),
+                ),
+                migrations.AlterField(
+                    model_name="post",
+                    name="owner",
+                    field=models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+    ]
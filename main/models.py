@@ -6,11 +6,13 @@ import uuid
 import bleach
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
+from django.core.validators import MinValueValidator
 from django.db import models
+from django.db.models.functions import Substr
 from django.urls import reverse
 from django.utils import timezone
 
-from main import util, validators
+from main import storage, util, validators
 
 
 def _generate_key():
@@ -65,6 +67,14 @@ class User(AbstractUser):
         verbose_name="Theme Sans-serif",
         help_text="Use sans-serif font in blog content.",
     )
+    index_posts_per_page = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        validators=[MinValueValidator(1)],
+        verbose_name="Posts per page",
+        help_text="Show this many posts on the blog index, with older ones on "
+        "further pages and yearly archives. Leave empty to show all posts.",
+    )
 
     redirect_domain = models.CharField(
         max_length=150,
@@ -134,6 +144,9 @@ class User(AbstractUser):
     # moderation
     is_approved = models.BooleanField(default=False)
 
+    # last change of anything shown on the blog, see main.caching
+    blog_changed_at = models.DateTimeField(default=timezone.now)
+
     class Meta:
         ordering = ["-id"]
 
@@ -195,11 +208,32 @@ class User(AbstractUser):
         return self.username
 
 
+def update_images(post_or_page):
+    """
+    Store which uploaded images of its owner the body of a post or page links
+    to, for lookups that would otherwise search every body. See indeximages.
+    """
+    slugs = util.get_image_slugs(post_or_page.body)
+    # images of other users, linked like any image on the web, are not theirs
+    # to export
+    images = (
+        Image.objects.filter(owner_id=post_or_page.owner_id, slug__in=slugs)
+        if slugs
+        else []
+    )
+    post_or_page.images.set(images)
+
+
 class Post(models.Model):
     title = models.CharField(max_length=300)
     slug = models.CharField(max_length=300)
     body = models.TextField(blank=True, null=True)
-    owner = models.ForeignKey(User, on_delete=models.CASCADE)
+    body_html = models.TextField(blank=True, null=True)
+    body_html_version = models.PositiveIntegerField(default=0)
+    # uploaded images linked from body, kept up to date on save
+    images = models.ManyToManyField("Image", blank=True, related_name="posts")
+    # indexed by post_owner_published_idx
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     published_at = models.DateField(
@@ -212,16 +246,52 @@ class Post(models.Model):
 
     class Meta:
         ordering = ["-published_at", "-created_at"]
+        indexes = [
+            # a blog's posts newest first, for its index, feed and sitemap; the
+            # blog index reads them from the index alone
+            models.Index(
+                fields=["owner", "-published_at", "-created_at"],
+                include=["slug", "title"],
+                name="post_owner_published_idx",
+            ),
+            # posts processnotifications has yet to queue
+            models.Index(
+                fields=["published_at"],
+                condition=models.Q(broadcasted_at__isnull=True),
+                name="post_unbroadcasted_idx",
+            ),
+        ]
         unique_together = [["slug", "owner"]]
 
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None or "body" in update_fields:
+            self.render_body()
+            if update_fields is not None:
+                kwargs["update_fields"] = {
+                    *update_fields,
+                    "body_html",
+                    "body_html_version",
+                }
+        super().save(*args, **kwargs)
+        if update_fields is None or "body" in update_fields:
+            update_images(self)
+
+    def render_body(self):
+        """Store the rendered HTML of body so that reads skip markdown."""
+        self.body_html = util.render_markdown(self.body) if self.body else ""
+        self.body_html_version = util.MARKDOWN_VERSION
+
     @property
     def body_as_html(self):
-        return util.md_to_html(self.body)
+        # stored HTML is stale or missing, eg. not yet re-rendered after deploy
+        if self.body_html is None or self.body_html_version != util.MARKDOWN_VERSION:
+            return util.md_to_html(self.body)
+        return self.body_html
 
     @property
     def body_as_text(self):
-        as_html = util.md_to_html(self.body)
-        return bleach.clean(as_html, strip=True, tags=[])
+        return bleach.clean(self.body_as_html, strip=True, tags=[])
 
     @property
     def is_draft(self):
@@ -253,11 +323,21 @@ class Post(models.Model):
         return self.title
 
 
+# bytea values that do not compress, like most image formats, are stored
+# as plain TOAST chunks of about 2KB, so substring() reads only the chunks
+# it needs
+DATABASE_CHUNK_SIZE = 256 * 1024
+
+
 class Image(models.Model):
     owner = models.ForeignKey(User, on_delete=models.CASCADE)
     name = models.CharField(max_length=300)  # original filename
     slug = models.CharField(max_length=300, unique=True)
-    data = models.BinaryField()
+    # bytes of images not yet moved to the image storage, see moveimages
+    data = models.BinaryField(blank=True, null=True)
+    # sha256 of the bytes, naming the file in the image storage
+    digest = models.CharField(max_length=64, blank=True, default="", db_index=True)
+    size_bytes = models.PositiveIntegerField(blank=True, null=True)
     extension = models.CharField(max_length=10)
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
@@ -268,14 +348,62 @@ class Image(models.Model):
     def filename(self):
         return self.slug + "." + self.extension
 
+    def save(self, *args, **kwargs):
+        if self.size_bytes is None and self.data is not None:
+            self.size_bytes = len(self.data)
+        super().save(*args, **kwargs)
+
+    def read_data(self):
+        """Return image bytes, from the image storage or the database."""
+        if self.digest:
+            return storage.image_storage.read(self.digest)
+        return self.data
+
+    def iter_data(self, start=0, end=None):
+        """
+        Yield image bytes from start up to end, exclusive, in chunks. Bytes
+        still in the database are read a slice per query, so that the whole
+        image is never held in memory.
+        """
+        if self.digest:
+            yield from storage.image_storage.iter_chunks(self.digest, start, end)
+            return
+
+        position = start
+        while end is None or position < end:
+            size = DATABASE_CHUNK_SIZE
+            if end is not None:
+                size = min(size, end - position)
+            chunk = (
+                Image.objects.filter(id=self.id)
+                .annotate(
+                    # substring() is 1-based
+                    chunk=Substr(
+                        "data", position + 1, size, output_field=models.BinaryField()
+                    )
+                )
+                .values_list("chunk", flat=True)
+                .order_by()
+                .first()
+            )
+            if not chunk:
+                break
+            position += len(chunk)
+            yield bytes(chunk)
+            if len(chunk) < size:
+                break
+
     @property
     def data_as_base64(self):
-        return base64.b64encode(self.data).decode("utf-8")
+        return base64.b64encode(self.read_data()).decode("utf-8")
 
     @property
     def data_size(self):
         """Get image size in MB."""
-        return round(len(self.data) / (1024 * 1024), 2)
+        size_bytes = self.size_bytes
+        if size_bytes is None:
+            size_bytes = len(self.read_data())
+        return round(size_bytes / (1024 * 1024), 2)
 
     @property
     def raw_url_absolute(self):
@@ -292,6 +420,23 @@ class Image(models.Model):
         return self.name
 
 
+class ImageUsage(models.Model):
+    """
+    Number and total size of the images of a user, maintained on image save
+    and delete, see main.storage. Kept apart from User so that saving a user
+    never overwrites it with a stale value.
+    """
+
+    user = models.OneToOneField(
+        User, on_delete=models.CASCADE, primary_key=True, related_name="image_usage"
+    )
+    count = models.PositiveIntegerField(default=0, db_index=True)
+    size_bytes = models.PositiveBigIntegerField(default=0, db_index=True)
+
+    def __str__(self):
+        return f"{self.user.username}: {self.count} images, {self.size_bytes} bytes"
+
+
 class Page(models.Model):
     title = models.CharField(max_length=300)
     slug = models.CharField(
@@ -300,6 +445,8 @@ class Page(models.Model):
         help_text="Lowercase letters, numbers, and - (hyphen) allowed.",
     )
     body = models.TextField(blank=True, null=True)
+    # uploaded images linked from body, kept up to date on save
+    images = models.ManyToManyField("Image", blank=True, related_name="pages")
     owner = models.ForeignKey(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -312,6 +459,12 @@ class Page(models.Model):
         ordering = ["slug"]
         unique_together = [["slug", "owner"]]
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None or "body" in update_fields:
+            update_images(self)
+
     @property
     def body_as_html(self):
         return util.md_to_html(self.body)
@@ -325,30 +478,79 @@ class Page(models.Model):
 
 
 class AnalyticPage(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # indexed by analyticpage_user_path_idx
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
     path = models.CharField(max_length=300)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # set when the hit is recorded, which can be before it is written
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
 
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            # hits per day of a page since a date
+            models.Index(
+                fields=["user", "path", "created_at"],
+                name="analyticpage_user_path_idx",
+            )
+        ]
 
     def __str__(self):
         return self.created_at.strftime("%c") + ": " + self.user.username
 
 
 class AnalyticPost(models.Model):
-    post = models.ForeignKey(Post, on_delete=models.CASCADE)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # indexed by analyticpost_post_created_idx
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, db_index=False)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
 
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            # hits per day of a post since a date
+            models.Index(
+                fields=["post", "created_at"],
+                name="analyticpost_post_created_idx",
+            )
+        ]
 
     def __str__(self):
         return self.created_at.strftime("%c") + ": " + self.post.title
 
 
-class Comment(models.Model):
+class AnalyticPageDay(models.Model):
+    """Daily hit count of a blog page, rolled up from AnalyticPage."""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    path = models.CharField(max_length=300)
+    date = models.DateField(db_index=True)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ["-date"]
+        unique_together = [["user", "path", "date"]]
+
+    def __str__(self):
+        return f"{self.date}: {self.user.username} /{self.path} ({self.count})"
+
+
+class AnalyticPostDay(models.Model):
+    """Daily hit count of a post, rolled up from AnalyticPost."""
+
     post = models.ForeignKey(Post, on_delete=models.CASCADE)
+    date = models.DateField(db_index=True)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ["-date"]
+        unique_together = [["post", "date"]]
+
+    def __str__(self):
+        return f"{self.date}: {self.post.title} ({self.count})"
+
+
+class Comment(models.Model):
+    # indexed by comment_post_approved_idx
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, db_index=False)
     created_at = models.DateTimeField(auto_now_add=True)
     body = models.TextField()
     name = models.CharField(max_length=150, default="Anonymous", null=True, blank=True)
@@ -360,6 +562,13 @@ class Comment(models.Model):
 
     class Meta:
         ordering = ["created_at"]
+        indexes = [
+            # approved and pending comments of a post, in order
+            models.Index(
+                fields=["post", "is_approved", "created_at"],
+                name="comment_post_approved_idx",
+            )
+        ]
 
     @property
     def body_as_html(self):
@@ -398,16 +607,36 @@ class Notification(models.Model):
 class NotificationRecord(models.Model):
     """
     NotificationRecord model is to keep track of all notifications
-    for the newsletter feature.
+    for the newsletter feature. Records are queued by processnotifications
+    and sent by sendnotifications, which retries failed sends at
+    next_attempt_at.
     """
 
+    class Status(models.TextChoices):
+        QUEUED = "queued"
+        SENDING = "sending"
+        SENT = "sent"
+        FAILED = "failed"
+
     notification = models.ForeignKey(Notification, on_delete=models.SET_NULL, null=True)
     post = models.ForeignKey(Post, on_delete=models.SET_NULL, null=True)
     sent_at = models.DateTimeField(default=timezone.now, null=True)
+    status = models.CharField(max_length=20, choices=Status, default=Status.SENT)
+    attempts = models.PositiveIntegerField(default=0)
+    # when queued, the earliest time to send; when sending, the time after
+    # which a sender is assumed to have crashed
+    next_attempt_at = models.DateTimeField(blank=True, null=True)
 
     class Meta:
         ordering = ["-sent_at"]
         unique_together = [["post", "notification"]]
+        indexes = [
+            models.Index(
+                fields=["next_attempt_at"],
+                condition=models.Q(status__in=["queued", "sending"]),
+                name="notificationrecord_due_idx",
+            )
+        ]
 
     def __str__(self):
         if not self.sent_at:
@@ -432,6 +661,59 @@ class ExportRecord(models.Model):
         return self.name
 
 
+class ExportJob(models.Model):
+    """
+    ExportJob model is a blog export requested by its user, built into a file
+    by the processexports command, and deleted once expired.
+    """
+
+    class Format(models.TextChoices):
+        MARKDOWN = "markdown"
+        ZOLA = "zola"
+        HUGO = "hugo"
+        EPUB = "epub"
+
+    class Status(models.TextChoices):
+        PENDING = "pending"
+        RUNNING = "running"
+        DONE = "done"
+        FAILED = "failed"
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    format = models.CharField(max_length=20, choices=Format)
+    name = models.CharField(max_length=150)
+    status = models.CharField(max_length=20, choices=Status, default=Status.PENDING)
+    size_bytes = models.PositiveBigIntegerField(blank=True, null=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    expires_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+        indexes = [models.Index(fields=["status", "created_at"])]
+
+    def __str__(self):
+        return self.filename
+
+    @property
+    def filename(self):
+        extension = "epub" if self.format == self.Format.EPUB else "zip"
+        return f"{self.name}.{extension}"
+
+    @property
+    def path(self):
+        return settings.EXPORTS_ROOT / f"{self.id}-{self.filename}"
+
+    @property
+    def is_active(self):
+        return self.status in (self.Status.PENDING, self.Status.RUNNING)
+
+    def get_absolute_url(self):
+        return reverse("export_job_detail", args=(self.id,))
+
+
 class Snapshot(models.Model):
     """Snapshot model is used to keep track of all versions of Posts."""
 
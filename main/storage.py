@@ -0,0 +1,274 @@
+"""
+Content-addressed file storage for image bytes.
+
+Files are named by the SHA-256 of their contents and sharded in two levels
+of subdirectories, eg. IMAGES_ROOT/3a/7b/3a7bd3e2...; so identical uploads,
+from any user, are stored once. Files are never modified, only written in
+full, and deleted by the sweepimages command once no Image has referred to
+them for a while. Deleting them along with their last Image instead would
+race uploads of the same bytes, whose Image is not saved yet.
+
+Files derived from others, like resized images, go in an LRUFileCache, which
+deletes the least recently used ones beyond a total size.
+
+Finished blog exports, see ExportJob, are files too, deleted with their job.
+
+The number and total bytes of images per user, in ImageUsage, are kept up to
+date here too, on Image save and delete.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+CHUNK_SIZE = 64 * 1024
+
+
+def write_file(path, data):
+    write_chunks(path, [data])
+
+
+def write_chunks(path, chunks):
+    """Write the iterable of bytes chunks to path. Returns the size written."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # write under a temporary name and rename, so that readers never see a
+    # partial file
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            for chunk in chunks:
+                tmp_file.write(chunk)
+                size += len(chunk)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+    return size
+
+
+def iter_file(path, start=0, end=None):
+    """Yield the bytes of the file at path from start up to end, exclusive."""
+    with open(path, "rb") as file:
+        file.seek(start)
+        remaining = None if end is None else end - start
+        while remaining is None or remaining > 0:
+            size = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+            chunk = file.read(size)
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+
+class ContentAddressedStorage:
+    def __init__(self, root_setting):
+        self.root_setting = root_setting
+        self.writes = 0
+        self.deduplicated = 0
+
+    @property
+    def root(self):
+        # read on access, so that tests can override the setting
+        return Path(getattr(settings, self.root_setting))
+
+    @staticmethod
+    def get_digest(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def path(self, digest):
+        return self.root / digest[:2] / digest[2:4] / digest
+
+    def exists(self, digest):
+        return self.path(digest).exists()
+
+    def save(self, data):
+        """
+        Store data unless already stored, returning its digest. A file already
+        stored is touched instead, so that sweeps keep it, as unused but
+        recently written, until the Image of this upload is saved.
+        """
+        digest = self.get_digest(data)
+        path = self.path(digest)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            write_file(path, data)
+            self.writes += 1
+        else:
+            self.deduplicated += 1
+        return digest
+
+    def iter_paths(self):
+        """Yield the path of every file, including partial ones."""
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                yield Path(dirpath) / filename
+
+    def open(self, digest):
+        return self.path(digest).open("rb")
+
+    def iter_chunks(self, digest, start=0, end=None):
+        """Yield the bytes of a file from start up to end, exclusive."""
+        return iter_file(self.path(digest), start, end)
+
+    def read(self, digest):
+        return self.path(digest).read_bytes()
+
+    def size(self, digest):
+        return self.path(digest).stat().st_size
+
+    def delete(self, digest):
+        self.path(digest).unlink(missing_ok=True)
+
+
+image_storage = ContentAddressedStorage("IMAGES_ROOT")
+
+
+class LRUFileCache:
+    """
+    Files of derived data by key, up to a total size, beyond which the least
+    recently used ones are deleted. Every worker shares the directory: files
+    are touched when used, and each worker rescans the directory to evict
+    when its estimate of the total is over the limit, or it has written a
+    tenth of the limit since its last scan.
+    """
+
+    def __init__(self, root_setting, max_bytes_setting):
+        self.root_setting = root_setting
+        self.max_bytes_setting = max_bytes_setting
+        self.lock = threading.Lock()
+        self.total_bytes = None  # estimate, unknown until the first scan
+        self.written_bytes = 0  # since the last scan
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def root(self):
+        return Path(getattr(settings, self.root_setting))
+
+    @property
+    def max_bytes(self):
+        return getattr(settings, self.max_bytes_setting)
+
+    def path(self, key):
+        return self.root / key[:2] / key
+
+    def get(self, key):
+        """Return the path of the file for key, or None if not cached."""
+        path = self.path(key)
+        try:
+            # mark as recently used; mtime, as atime is often not updated
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return path
+
+    def put(self, key, data):
+        """Store data for key, returning the path of its file."""
+        path = self.path(key)
+        write_file(path, data)
+        with self.lock:
+            if self.total_bytes is not None:
+                self.total_bytes += len(data)
+            self.written_bytes += len(data)
+            is_due = (
+                self.total_bytes is None
+                or self.total_bytes > self.max_bytes
+                or self.written_bytes > self.max_bytes / 10
+            )
+        if is_due:
+            self.evict()
+        return path
+
+    def evict(self):
+        """Delete least recently used files until 90% of the limit is left."""
+        files = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.startswith(".tmp-"):
+                    continue
+                path = Path(dirpath) / filename
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue  # evicted by another worker meanwhile
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in files)
+        count_evicted = 0
+        if total_bytes > self.max_bytes:
+            files.sort()
+            for _, size, path in files:
+                if total_bytes <= self.max_bytes * 0.9:
+                    break
+                path.unlink(missing_ok=True)
+                total_bytes -= size
+                count_evicted += 1
+
+        with self.lock:
+            self.total_bytes = total_bytes
+            self.written_bytes = 0
+            self.evictions += count_evicted
+
+    def info(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "total_bytes": self.total_bytes,
+            }
+
+
+def add_image_usage(user_id, count, size_bytes):
+    """
+    Add to the image count and bytes of a user, atomically. Subtracting
+    never creates a usage row, which may be gone along with its user.
+    """
+    from main.models import ImageUsage
+
+    usage = ImageUsage.objects.filter(user_id=user_id)
+    values = {
+        "count": Greatest(F("count") + count, 0),
+        "size_bytes": Greatest(F("size_bytes") + size_bytes, 0),
+    }
+    if not usage.update(**values) and count > 0:
+        ImageUsage.objects.bulk_create(
+            [ImageUsage(user_id=user_id)], ignore_conflicts=True
+        )
+        usage.update(**values)
+
+
+@receiver(post_save, sender="main.Image")
+def add_saved_image_usage(sender, instance, created, raw, **kwargs):
+    if created and not raw:
+        add_image_usage(instance.owner_id, 1, instance.size_bytes or 0)
+
+
+@receiver(post_delete, sender="main.Image")
+def remove_deleted_image_usage(sender, instance, **kwargs):
+    add_image_usage(instance.owner_id, -1, -(instance.size_bytes or 0))
+
+
+@receiver(post_delete, sender="main.ExportJob")
+def delete_export_file(sender, instance, **kwargs):
+    # before the instance loses its id, which names the file
+    path = instance.path
+    transaction.on_commit(lambda: path.unlink(missing_ok=True))
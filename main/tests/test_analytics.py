@@ -1,8 +1,14 @@
+from datetime import timedelta
+from unittest.mock import patch
+
 from django.conf import settings
-from django.test import TestCase
+from django.db import OperationalError
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 
-from main import models
+from main import analytics, models
+from main.management.commands import mailsummary
 
 
 class PostAnalyticAnonTestCase(TestCase):
@@ -294,3 +300,262 @@ class PageAnalyticDetailRSSTestCase(TestCase):
             '<svg version="1.1" viewBox="0 0 500 192" xmlns="http://www.w3.org/2000/svg">',
         )
         self.assertContains(response, "1 hits")
+
+
+@override_settings(ANALYTICS_BUFFER_SIZE=3, ANALYTICS_BUFFER_MAX_AGE=60)
+class AnalyticsBufferTestCase(TestCase):
+    """Test buffered analytics writes."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user, title="Welcome post", slug="welcome-post"
+        )
+        self.buffer = analytics.AnalyticsBuffer()
+
+    def test_buffered_until_size(self):
+        self.buffer.record_page(self.user.id, "index")
+        self.buffer.record_post(self.post.id)
+        self.assertFalse(models.AnalyticPage.objects.exists())
+        self.assertFalse(models.AnalyticPost.objects.exists())
+        self.assertEqual(self.buffer.info()["pending"], 2)
+
+        self.buffer.record_post(self.post.id)
+        self.assertEqual(models.AnalyticPage.objects.count(), 1)
+        self.assertEqual(models.AnalyticPost.objects.count(), 2)
+        info = self.buffer.info()
+        self.assertEqual(info["pending"], 0)
+        self.assertEqual(info["recorded"], 3)
+        self.assertEqual(info["flushed"], 3)
+        self.assertEqual(info["flushes"], 1)
+
+    @override_settings(ANALYTICS_BUFFER_MAX_AGE=0)
+    def test_flushed_when_old(self):
+        self.buffer.record_page(self.user.id, "rss")
+        self.assertEqual(models.AnalyticPage.objects.filter(path="rss").count(), 1)
+
+    def test_created_at_is_hit_time(self):
+        recorded_at = timezone.now() - timedelta(minutes=5)
+        with patch("django.utils.timezone.now", return_value=recorded_at):
+            self.buffer.record_post(self.post.id)
+        self.buffer.flush()
+        self.assertEqual(models.AnalyticPost.objects.get().created_at, recorded_at)
+
+    def test_long_path_truncated(self):
+        self.buffer.record_page(self.user.id, "a" * 500)
+        self.buffer.flush()
+        self.assertEqual(len(models.AnalyticPage.objects.get().path), 300)
+
+    def test_failed_flush_requeued(self):
+        self.buffer.record_page(self.user.id, "index")
+        with (
+            patch.object(
+                models.AnalyticPage.objects, "bulk_create", side_effect=OperationalError
+            ),
+            self.assertLogs("main.analytics", level="ERROR"),
+        ):
+            self.buffer.flush()
+        info = self.buffer.info()
+        self.assertEqual(info["pending"], 1)
+        self.assertEqual(info["failures"], 1)
+        self.assertFalse(models.AnalyticPage.objects.exists())
+
+        self.buffer.flush()
+        self.assertEqual(models.AnalyticPage.objects.count(), 1)
+        self.assertEqual(self.buffer.info()["pending"], 0)
+
+    @override_settings(ANALYTICS_BUFFER_SIZE=100, ANALYTICS_BUFFER_MAX_PENDING=2)
+    def test_failed_flush_capped(self):
+        for path in ["first", "second", "third"]:
+            self.buffer.record_page(self.user.id, path)
+        with (
+            patch.object(
+                models.AnalyticPage.objects, "bulk_create", side_effect=OperationalError
+            ),
+            self.assertLogs("main.analytics", level="ERROR"),
+        ):
+            self.buffer.flush()
+        info = self.buffer.info()
+        self.assertEqual(info["pending"], 2)
+        self.assertEqual(info["dropped"], 1)
+
+        self.buffer.flush()
+        self.assertEqual(
+            list(models.AnalyticPage.objects.values_list("path", flat=True)),
+            ["third", "second"],
+        )
+
+
+@override_settings(ANALYTICS_BUFFER_SIZE=3, ANALYTICS_BUFFER_MAX_AGE=60)
+class AnalyticsBufferOrphanTestCase(TransactionTestCase):
+    """Test hits of deleted posts do not fail the batch they are written in."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user, title="Welcome post", slug="welcome-post"
+        )
+        self.buffer = analytics.AnalyticsBuffer()
+
+    def test_deleted_post_dropped(self):
+        other_post = models.Post.objects.create(
+            owner=self.user, title="Other post", slug="other-post"
+        )
+        self.buffer.record_post(self.post.id)
+        self.buffer.record_post(other_post.id)
+        other_post.delete()
+        self.buffer.flush()
+        self.assertEqual(models.AnalyticPost.objects.get().post, self.post)
+        self.assertEqual(self.buffer.info()["dropped"], 1)
+
+
+@override_settings(ANALYTICS_BUFFER_SIZE=100, ANALYTICS_BUFFER_MAX_AGE=0.5)
+class AnalyticsBufferTimerTestCase(TransactionTestCase):
+    """Test pending hits are written on time when no further hit comes in."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.buffer = analytics.AnalyticsBuffer()
+
+    def test_flushed_when_idle(self):
+        self.buffer.record_page(self.user.id, "index")
+        self.assertFalse(models.AnalyticPage.objects.exists())
+        self.buffer.flush_timer.join(timeout=5)
+        self.assertEqual(models.AnalyticPage.objects.count(), 1)
+        self.assertEqual(self.buffer.info()["pending"], 0)
+        self.assertIsNone(self.buffer.flush_timer)
+
+    def test_failed_flush_retried_when_idle(self):
+        self.buffer.record_page(self.user.id, "index")
+        with (
+            patch.object(
+                models.AnalyticPage.objects, "bulk_create", side_effect=OperationalError
+            ),
+            self.assertLogs("main.analytics", level="ERROR"),
+        ):
+            self.buffer.flush()
+        self.assertEqual(self.buffer.info()["pending"], 1)
+        self.buffer.flush_timer.join(timeout=5)
+        self.assertEqual(models.AnalyticPage.objects.count(), 1)
+        self.assertEqual(self.buffer.info()["pending"], 0)
+
+    def test_no_timer_when_flushed(self):
+        self.buffer.record_page(self.user.id, "index")
+        self.buffer.flush()
+        self.assertIsNone(self.buffer.flush_timer)
+
+
+class AnalyticsRollupReadTestCase(TestCase):
+    """Test analytics dashboards read daily rollups along with recent raw hits."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user, title="Welcome post", slug="welcome-post"
+        )
+        self.today = timezone.now().date()
+
+    def test_count_per_day(self):
+        # rolled up until yesterday, whose raw hits are then read instead
+        models.AnalyticPostDay.objects.create(
+            post=self.post, date=self.today - timedelta(days=2), count=7
+        )
+        models.AnalyticPostDay.objects.create(
+            post=self.post, date=self.today - timedelta(days=1), count=1
+        )
+        for _ in range(2):
+            models.AnalyticPost.objects.create(
+                post=self.post, created_at=timezone.now() - timedelta(days=1)
+            )
+        models.AnalyticPost.objects.create(post=self.post)
+
+        counts = analytics.count_per_day(
+            models.AnalyticPost,
+            models.AnalyticPostDay,
+            since=self.today - timedelta(days=24),
+            post=self.post,
+        )
+        self.assertEqual(
+            dict(counts),
+            {
+                self.today - timedelta(days=2): 7,
+                self.today - timedelta(days=1): 2,
+                self.today: 1,
+            },
+        )
+
+    def test_post_detail_after_prune(self):
+        for _ in range(3):
+            models.AnalyticPost.objects.create(
+                post=self.post, created_at=timezone.now() - timedelta(days=10)
+            )
+        models.AnalyticPost.objects.create(post=self.post)
+        analytics.rollup(models.AnalyticPost, models.AnalyticPostDay, ["post"])
+        analytics.prune(models.AnalyticPost, models.AnalyticPostDay, keep_days=1)
+        self.assertEqual(models.AnalyticPost.objects.count(), 1)
+
+        self.client.force_login(self.user)
+        response = self.client.get(
+            reverse("analytic_post_detail", args=(self.post.slug,)),
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "3 hits")
+        self.assertContains(response, "1 hits")
+
+    def test_counts_on(self):
+        models.AnalyticPostDay.objects.create(
+            post=self.post, date=self.today - timedelta(days=2), count=7
+        )
+        models.AnalyticPostDay.objects.create(
+            post=self.post, date=self.today - timedelta(days=1), count=1
+        )
+        for _ in range(2):
+            models.AnalyticPost.objects.create(
+                post=self.post, created_at=timezone.now() - timedelta(days=1)
+            )
+        for days_ago, count in [(2, 7), (1, 2), (0, 0)]:
+            counts = analytics.counts_on(
+                models.AnalyticPost,
+                models.AnalyticPostDay,
+                self.today - timedelta(days=days_ago),
+                "post",
+            )
+            self.assertEqual(counts[self.post.id], count)
+
+    def test_summary_after_prune(self):
+        for _ in range(3):
+            models.AnalyticPost.objects.create(
+                post=self.post, created_at=timezone.now() - timedelta(days=10)
+            )
+            models.AnalyticPage.objects.create(
+                user=self.user,
+                path="index",
+                created_at=timezone.now() - timedelta(days=10),
+            )
+        models.AnalyticPost.objects.create(post=self.post)
+        models.AnalyticPage.objects.create(user=self.user, path="index")
+        for raw_model, day_model, group_by in [
+            (models.AnalyticPost, models.AnalyticPostDay, ["post"]),
+            (models.AnalyticPage, models.AnalyticPageDay, ["user", "path"]),
+        ]:
+            analytics.rollup(raw_model, day_model, group_by)
+            analytics.prune(raw_model, day_model, keep_days=1)
+        self.assertEqual(models.AnalyticPost.objects.count(), 1)
+
+        date = self.today - timedelta(days=10)
+        self.user.is_superuser = True
+        self.user.save()
+        self.client.force_login(self.user)
+        response = self.client.get(
+            reverse("moderation_summary", args=(date.isoformat(),))
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["counts"]["post_visits"], 3)
+        self.assertEqual(response.context["counts"]["page_visits"], 3)
+        self.assertEqual(response.context["top_posts_by_visits"], [self.post])
+        self.assertEqual(response.context["top_posts_by_visits"][0].visit_count, 3)
+
+        text = mailsummary.build_summary_text(date)
+        self.assertIn("- Post visits: 3", text)
+        self.assertIn("- Page visits: 3", text)
+        self.assertIn("- Welcome post — 3 — alice", text)
@@ -1,8 +1,46 @@
+import io
+import tempfile
+import time
+import zipfile
+from datetime import date, timedelta
+from pathlib import Path
+from unittest.mock import patch
+
 from django.conf import settings
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+
+from main import caching, export_templates, exports, models
+
+# keep the export files of all tests out of the real exports directory
+exports_root = tempfile.TemporaryDirectory()
+exports_root_settings = override_settings(EXPORTS_ROOT=Path(exports_root.name))
+
+
+def setUpModule():
+    exports_root_settings.enable()
 
-from main import models
+
+def tearDownModule():
+    exports_root_settings.disable()
+    exports_root.cleanup()
+
+
+def run_export(testcase, url_name):
+    """
+    Request an export, build it like the worker, and return the download
+    response.
+    """
+    response = testcase.client.post(reverse(url_name))
+    job = models.ExportJob.objects.latest("id")
+    testcase.assertRedirects(response, reverse("export_job_detail", args=(job.id,)))
+    call_command("processexports", stdout=io.StringIO())
+    return testcase.client.get(reverse("export_job_download", args=(job.id,)))
 
 
 class IndexTestCase(TestCase):
@@ -84,6 +122,109 @@ class BlogIndexRedirTestCase(TestCase):
         )
 
 
+class BlogIndexPaginationTestCase(TestCase):
+    """Test blog index pages and yearly archives of blogs that enable them."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice", index_posts_per_page=2)
+        self.host = self.user.username + "." + settings.CANONICAL_HOST
+        for title, published_at in [
+            ("Old post", date(2019, 5, 1)),
+            ("Older post", date(2019, 3, 1)),
+            ("New post", date(2020, 2, 1)),
+            ("Newer post", date(2020, 3, 1)),
+            ("Newest post", date(2020, 4, 1)),
+            ("Scheduled post", date(2999, 1, 1)),
+        ]:
+            models.Post.objects.create(
+                owner=self.user,
+                title=title,
+                slug=title.lower().replace(" ", "-"),
+                published_at=published_at,
+            )
+        cache.clear()
+
+    def test_first_page(self):
+        response = self.client.get(reverse("index"), HTTP_HOST=self.host)
+        self.assertContains(response, "Newest post")
+        self.assertContains(response, "Newer post")
+        self.assertNotContains(response, "New post<")
+        self.assertNotContains(response, "Scheduled post")
+        self.assertContains(response, '<a href="?page=2">older posts</a>')
+        self.assertContains(response, reverse("blog_archive", args=(2019,)))
+        self.assertContains(response, reverse("blog_archive", args=(2020,)))
+        self.assertNotContains(response, reverse("blog_archive", args=(2999,)))
+
+    def test_last_page(self):
+        response = self.client.get(reverse("index"), {"page": 3}, HTTP_HOST=self.host)
+        self.assertContains(response, "Older post")
+        self.assertNotContains(response, "Old post<")
+        self.assertContains(response, '<a href="?page=2">newer posts</a>')
+        self.assertNotContains(response, "older posts")
+
+    def test_invalid_page_not_found(self):
+        for page in ["4", "0", "01", "x", ""]:
+            response = self.client.get(
+                reverse("index"), {"page": page}, HTTP_HOST=self.host
+            )
+            self.assertEqual(response.status_code, 404, page)
+
+    def test_page_redirects_without_pagination(self):
+        self.user.index_posts_per_page = None
+        self.user.save()
+        response = self.client.get(reverse("index"), {"page": 2}, HTTP_HOST=self.host)
+        self.assertRedirects(response, reverse("index"), fetch_redirect_response=False)
+
+    def test_owner_sees_scheduled(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse("index"), HTTP_HOST=self.host)
+        self.assertContains(response, "Scheduled post")
+        self.assertContains(response, "— SCHEDULED")
+        self.assertNotContains(response, "Newer post")
+
+    def test_archive(self):
+        response = self.client.get(
+            reverse("blog_archive", args=(2019,)), HTTP_HOST=self.host
+        )
+        self.assertContains(response, "Posts of 2019")
+        self.assertContains(response, "Old post")
+        self.assertContains(response, "Older post")
+        self.assertNotContains(response, "Newest post")
+
+        response = self.client.get(
+            reverse("blog_archive", args=(2999,)), HTTP_HOST=self.host
+        )
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(
+            reverse("blog_archive", args=(2018,)), HTTP_HOST=self.host
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_queries_flat(self):
+        """As many queries to render the index, however many posts."""
+
+        def count_queries():
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse("index"), HTTP_HOST=self.host)
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        before = count_queries()
+        models.Post.objects.bulk_create(
+            [
+                models.Post(
+                    owner=self.user,
+                    title=f"Post {i}",
+                    slug=f"post-{i}",
+                    published_at=date(2010 + i % 10, 1, 1 + i % 28),
+                )
+                for i in range(200)
+            ]
+        )
+        self.assertEqual(count_queries(), before)
+
+
 class BlogRetiredRedirTestCase(TestCase):
     """
     Test anon user is redirected to redirect_domain,
@@ -138,6 +279,316 @@ class BlogRetiredRedirProtocolTestCase(TestCase):
         self.assertEqual(self.user.redirect_domain, response.url)
 
 
+class BlogHostCacheTestCase(TestCase):
+    """Test host to blog resolution is cached and invalidated on user changes."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = models.User.objects.create(
+            username="alice", custom_domain="alice.example.com"
+        )
+        self.host = "alice.example.com"
+
+    def test_cached(self):
+        caching.get_blog_host_by_username("alice")
+        with self.assertNumQueries(0):
+            blog_host = caching.get_blog_host_by_username("alice")
+        self.assertEqual(blog_host["id"], self.user.id)
+        self.assertEqual(blog_host["custom_domain"], "alice.example.com")
+
+    def test_index_resolved_once(self):
+        caching.get_blog_host_by_domain(self.host)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("index"), HTTP_HOST=self.host)
+        self.assertEqual(response.status_code, 200)
+        for query in queries:
+            self.assertNotIn('"username"', query["sql"].split("WHERE")[-1])
+
+    def test_unknown_cached(self):
+        self.assertIsNone(caching.get_blog_host_by_domain("unknown.example.com"))
+        with self.assertNumQueries(0):
+            caching.get_blog_host_by_domain("unknown.example.com")
+
+    def test_unknown_invalidated_on_create(self):
+        response = self.client.get(
+            reverse("index"), HTTP_HOST="bob." + settings.CANONICAL_HOST
+        )
+        self.assertEqual(response.status_code, 404)
+        models.User.objects.create(username="bob")
+        response = self.client.get(
+            reverse("index"), HTTP_HOST="bob." + settings.CANONICAL_HOST
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_kept_on_login(self):
+        self.client.get(reverse("index"), HTTP_HOST=self.host)
+        blog_changed_at = models.User.objects.get(pk=self.user.pk).blog_changed_at
+        self.client.force_login(self.user)
+        self.client.logout()
+
+        hits = caching.anonymous_page_cache.hits
+        response = self.client.get(reverse("index"), HTTP_HOST=self.host)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(caching.anonymous_page_cache.hits, hits + 1)
+        self.assertEqual(
+            models.User.objects.get(pk=self.user.pk).blog_changed_at, blog_changed_at
+        )
+
+    def test_invalidated_on_user_update(self):
+        response = self.client.get(reverse("index"), HTTP_HOST="alice.example.com")
+        self.assertEqual(response.status_code, 200)
+
+        self.client.force_login(self.user)
+        self.client.post(
+            reverse("user_update"),
+            {"username": "alice2", "custom_domain": "new.example.com"},
+        )
+        self.client.logout()
+
+        response = self.client.get(reverse("index"), HTTP_HOST="alice.example.com")
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(
+            reverse("index"), HTTP_HOST="alice." + settings.CANONICAL_HOST
+        )
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse("index"), HTTP_HOST="new.example.com")
+        self.assertEqual(response.status_code, 200)
+
+
+class AnonymousPageCacheTestCase(TestCase):
+    """Test blog pages are cached for anonymous visitors until the blog changes."""
+
+    def setUp(self):
+        cache.clear()
+        caching.anonymous_page_cache.pages.clear()
+        self.user = models.User.objects.create(username="alice", comments_on=True)
+        self.post = models.Post.objects.create(
+            owner=self.user,
+            title="Welcome post",
+            slug="welcome-post",
+            body="Content sentence.",
+            published_at="2020-01-01",
+        )
+        self.host = "alice." + settings.CANONICAL_HOST
+
+    def get_post(self, client=None):
+        return (client or self.client).get(
+            reverse("post_detail", args=(self.post.slug,)), HTTP_HOST=self.host
+        )
+
+    def test_cached(self):
+        self.client.get(reverse("index"), HTTP_HOST=self.host)
+
+        # only the analytics hit is written
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("index"), HTTP_HOST=self.host)
+        self.assertContains(response, "Welcome post")
+        self.assertEqual(
+            models.AnalyticPage.objects.filter(user=self.user, path="index").count(),
+            2,
+        )
+
+    def test_post_analytics_recorded_when_cached(self):
+        self.get_post()
+        self.get_post()
+        self.assertEqual(models.AnalyticPost.objects.filter(post=self.post).count(), 2)
+
+    def test_invalidated_on_post_update(self):
+        self.get_post()
+        self.post.title = "Updated post"
+        self.post.save()
+        self.assertContains(self.get_post(), "Updated post")
+
+    def test_invalidated_on_comment_approval(self):
+        comment = models.Comment.objects.create(
+            post=self.post, name="Jon", body="Nice post."
+        )
+        self.assertNotContains(self.get_post(), "Nice post.")
+        comment.is_approved = True
+        comment.save()
+        self.assertContains(self.get_post(), "Nice post.")
+
+    def test_pending_comment_keeps_cache(self):
+        self.get_post()
+        models.Comment.objects.create(post=self.post, name="Jon", body="Spam.")
+        # only the analytics hit is written
+        with self.assertNumQueries(1):
+            self.get_post()
+
+    def test_other_query_strings_share_entry(self):
+        self.client.get(reverse("index"), HTTP_HOST=self.host)
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                reverse("index"), {"utm_source": "x"}, HTTP_HOST=self.host
+            )
+        self.assertContains(response, "Welcome post")
+
+    def test_invalidated_on_admin_comment_approval(self):
+        comment = models.Comment.objects.create(
+            post=self.post, name="Jon", body="Nice post."
+        )
+        self.assertNotContains(self.get_post(), "Nice post.")
+
+        admin_client = Client()
+        admin_client.force_login(
+            models.User.objects.create(
+                username="admin", is_superuser=True, is_staff=True
+            )
+        )
+        admin_client.post(
+            reverse("admin:main_comment_changelist"),
+            {"action": "approve_comments", "_selected_action": [comment.id]},
+        )
+        comment.refresh_from_db()
+        self.assertTrue(comment.is_approved)
+        self.assertContains(self.get_post(), "Nice post.")
+
+    def test_invalidated_on_user_update(self):
+        self.client.get(reverse("index"), HTTP_HOST=self.host)
+        self.user.blog_title = "Alice's blog"
+        self.user.save()
+        response = self.client.get(reverse("index"), HTTP_HOST=self.host)
+        self.assertContains(response, "Alice&#x27;s blog")
+
+    def test_large_page_not_cached(self):
+        pages = caching.anonymous_page_cache.pages
+        misses = caching.anonymous_page_cache.misses
+        with patch.object(pages, "max_item_bytes", 100):
+            self.get_post()
+            self.get_post()
+        self.assertEqual(caching.anonymous_page_cache.misses, misses + 2)
+        self.assertEqual(pages.info()["entries"], 0)
+
+    def test_expired(self):
+        self.get_post()
+        misses = caching.anonymous_page_cache.misses
+        expired_at = time.monotonic() + settings.PAGE_CACHE_TIMEOUT + 1
+        with patch.object(time, "monotonic", return_value=expired_at):
+            self.get_post()
+        self.assertEqual(caching.anonymous_page_cache.misses, misses + 1)
+
+    def test_bypassed_for_owner(self):
+        self.assertNotContains(self.get_post(), "Edit post")
+        self.client.force_login(self.user)
+        self.assertContains(self.get_post(), "Edit post")
+        self.assertEqual(models.AnalyticPost.objects.filter(post=self.post).count(), 1)
+
+    def test_csrf_token_per_visitor(self):
+        self.get_post()
+
+        client = Client(enforce_csrf_checks=True)
+        with self.assertNumQueries(1):
+            response = self.get_post(client)
+        self.assertIn(settings.CSRF_COOKIE_NAME, response.cookies)
+        token = (
+            response.content.decode()
+            .split('name="csrfmiddlewaretoken" value="')[1]
+            .split('"')[0]
+        )
+
+        response = client.post(
+            reverse("comment_create", args=(self.post.slug,)),
+            {"body": "Cached comment.", "csrfmiddlewaretoken": token},
+            HTTP_HOST=self.host,
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(models.Comment.objects.filter(body="Cached comment.").exists())
+
+
+class ConditionalGetTestCase(TestCase):
+    """Test blog pages answer conditional requests with 304 until the blog changes."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user,
+            title="Welcome post",
+            slug="welcome-post",
+            body="Content sentence.",
+            published_at="2020-01-01",
+        )
+        self.host = "alice." + settings.CANONICAL_HOST
+
+    def test_index_not_modified(self):
+        response = self.client.get(reverse("index"), HTTP_HOST=self.host)
+        self.assertEqual(response.status_code, 200)
+
+        # only the analytics hit is written
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                reverse("index"),
+                HTTP_HOST=self.host,
+                HTTP_IF_NONE_MATCH=response["ETag"],
+            )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(
+            models.AnalyticPage.objects.filter(user=self.user, path="index").count(),
+            2,
+        )
+
+    def test_post_not_modified(self):
+        url = reverse("post_detail", args=(self.post.slug,))
+        response = self.client.get(url, HTTP_HOST=self.host)
+        response = self.client.get(
+            url, HTTP_HOST=self.host, HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(models.AnalyticPost.objects.filter(post=self.post).count(), 2)
+
+    def test_modified_on_post_update(self):
+        url = reverse("post_detail", args=(self.post.slug,))
+        response = self.client.get(url, HTTP_HOST=self.host)
+        self.post.title = "Updated post"
+        self.post.save()
+
+        response = self.client.get(
+            url, HTTP_HOST=self.host, HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertContains(response, "Updated post")
+
+    def test_rss_if_modified_since(self):
+        response = self.client.get(reverse("rss_feed"), HTTP_HOST=self.host)
+        response = self.client.get(
+            reverse("rss_feed"),
+            HTTP_HOST=self.host,
+            HTTP_IF_MODIFIED_SINCE=response["Last-Modified"],
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(
+            models.AnalyticPage.objects.filter(user=self.user, path="rss").count(), 2
+        )
+
+    def test_sitemap_not_modified(self):
+        response = self.client.get(reverse("sitemap"), HTTP_HOST=self.host)
+        response = self.client.get(
+            reverse("sitemap"),
+            HTTP_HOST=self.host,
+            HTTP_IF_NONE_MATCH=response["ETag"],
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_owner_sees_new_pending_comment(self):
+        url = reverse("post_detail", args=(self.post.slug,))
+        self.user.comments_on = True
+        self.user.save()
+        self.client.force_login(self.user)
+        response = self.client.get(url, HTTP_HOST=self.host)
+        models.Comment.objects.create(post=self.post, name="Jon", body="Pending.")
+        response = self.client.get(
+            url, HTTP_HOST=self.host, HTTP_IF_NONE_MATCH=response.get("ETag", "")
+        )
+        self.assertContains(response, "Pending.")
+
+    def test_etag_differs_for_owner(self):
+        response = self.client.get(reverse("index"), HTTP_HOST=self.host)
+        self.client.force_login(self.user)
+        response = self.client.get(
+            reverse("index"), HTTP_HOST=self.host, HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(response.status_code, 200)
+
+
 class BlogImportTestCase(TestCase):
     def setUp(self):
         self.user = models.User.objects.create(username="alice")
@@ -168,11 +619,15 @@ class BlogExportMarkdownTestCase(TestCase):
         self.post = models.Post.objects.create(owner=self.user, **self.data)
 
     def test_blog_export(self):
-        response = self.client.post(reverse("export_markdown"))
+        response = run_export(self, "export_markdown")
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response["Content-Type"], "application/zip")
-        self.assertContains(response, b"export-markdown")
-        self.assertContains(response, self.data["slug"].encode("utf-8"))
+        self.assertTrue(response.streaming)
+        with zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content))) as zf:
+            names = zf.namelist()
+            self.assertTrue(names[0].startswith("export-markdown-"))
+            self.assertTrue(names[0].endswith("/alice-mataroa-blog/welcome-post.md"))
+            self.assertIn(b"Content sentence.", zf.read(names[0]))
 
 
 class BlogExportPrintTestCase(TestCase):
@@ -210,11 +665,15 @@ class BlogExportZolaTestCase(TestCase):
         self.post = models.Post.objects.create(owner=self.user, **self.data)
 
     def test_blog_export(self):
-        response = self.client.post(reverse("export_zola"))
+        response = run_export(self, "export_zola")
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response["Content-Type"], "application/zip")
-        self.assertContains(response, b"export-zola")
-        self.assertContains(response, self.data["slug"].encode("utf-8"))
+        self.assertTrue(response.streaming)
+        with zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content))) as zf:
+            names = zf.namelist()
+            self.assertTrue(names[0].startswith("export-zola-"))
+            self.assertTrue(names[-1].endswith("/content/welcome-post.md"))
+            self.assertIn(b'title = "Welcome post"', zf.read(names[-1]))
 
 
 class BlogExportHugoTestCase(TestCase):
@@ -229,11 +688,139 @@ class BlogExportHugoTestCase(TestCase):
         self.post = models.Post.objects.create(owner=self.user, **self.data)
 
     def test_blog_export(self):
-        response = self.client.post(reverse("export_hugo"))
+        response = run_export(self, "export_hugo")
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response["Content-Type"], "application/zip")
-        self.assertContains(response, b"export-hugo")
-        self.assertContains(response, self.data["slug"].encode("utf-8"))
+        self.assertTrue(response.streaming)
+        with zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content))) as zf:
+            names = zf.namelist()
+            self.assertTrue(names[0].startswith("export-hugo-"))
+            self.assertTrue(names[-1].endswith("/content/welcome-post.md"))
+            self.assertIn(b'url = "blog/welcome-post"', zf.read(names[-1]))
+
+
+class ExportJobTestCase(TestCase):
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.client.force_login(self.user)
+
+    def test_export_queued(self):
+        response = self.client.post(reverse("export_markdown"))
+        job = models.ExportJob.objects.get(user=self.user)
+        self.assertEqual(job.status, models.ExportJob.Status.PENDING)
+        self.assertTrue(job.name.startswith("export-markdown-"))
+        response = self.client.get(response.url)
+        self.assertContains(response, "is queued")
+        self.assertContains(response, 'http-equiv="refresh"')
+
+        # again while queued, same job
+        self.client.post(reverse("export_markdown"))
+        self.assertEqual(models.ExportJob.objects.filter(user=self.user).count(), 1)
+
+    def test_export_get_not_allowed(self):
+        response = self.client.get(reverse("export_hugo"))
+        self.assertEqual(response.status_code, 405)
+        self.assertFalse(models.ExportJob.objects.exists())
+
+    def test_export_done(self):
+        self.client.post(reverse("export_zola"))
+        call_command("processexports", stdout=io.StringIO())
+        job = models.ExportJob.objects.get(user=self.user)
+        self.assertEqual(job.status, models.ExportJob.Status.DONE)
+        self.assertEqual(job.path.stat().st_size, job.size_bytes)
+        response = self.client.get(reverse("export_job_detail", args=(job.id,)))
+        self.assertContains(response, reverse("export_job_download", args=(job.id,)))
+        self.assertNotContains(response, 'http-equiv="refresh"')
+        response = self.client.get(reverse("export_index"))
+        self.assertContains(response, job.filename)
+
+    def test_download_pending(self):
+        self.client.post(reverse("export_markdown"))
+        job = models.ExportJob.objects.get(user=self.user)
+        response = self.client.get(reverse("export_job_download", args=(job.id,)))
+        self.assertEqual(response.status_code, 404)
+
+    def test_download_expired(self):
+        self.client.post(reverse("export_markdown"))
+        call_command("processexports", stdout=io.StringIO())
+        job = models.ExportJob.objects.get(user=self.user)
+        job.expires_at = timezone.now() - timedelta(minutes=1)
+        job.save()
+        response = self.client.get(reverse("export_job_download", args=(job.id,)))
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse("export_job_detail", args=(job.id,)))
+        self.assertContains(response, "has expired")
+
+    def test_other_user(self):
+        self.client.post(reverse("export_markdown"))
+        call_command("processexports", stdout=io.StringIO())
+        job = models.ExportJob.objects.get(user=self.user)
+        self.client.force_login(models.User.objects.create(username="bob"))
+        response = self.client.get(reverse("export_job_detail", args=(job.id,)))
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse("export_job_download", args=(job.id,)))
+        self.assertEqual(response.status_code, 404)
+
+
+class ExportTemplatesTestCase(TestCase):
+    def setUp(self):
+        export_templates.get_bundle.cache_clear()
+        self.addCleanup(export_templates.get_bundle.cache_clear)
+
+    def test_bundle_read_once(self):
+        bundle = export_templates.get_bundle("hugo")
+        self.assertIs(export_templates.get_bundle("hugo"), bundle)
+        self.assertEqual(next(iter(bundle)), "config.toml")
+        self.assertIn("themes/mataroa/layouts/_default/baseof.html", bundle)
+        with self.assertRaises(TypeError):
+            bundle["config.toml"] = ""
+
+    def test_check_bundles(self):
+        self.assertEqual(export_templates.check_bundles(None), [])
+
+        with tempfile.TemporaryDirectory() as base_dir:
+            (Path(base_dir) / "broken").mkdir()
+            (Path(base_dir) / "broken" / "config.toml").write_text('title = ""')
+            broken = export_templates.Bundle(
+                directory="broken",
+                files=(("config.toml", "config.toml"), ("style.css", "style.css")),
+                placeholders={"config.toml": ("Example blog title",)},
+            )
+            with (
+                override_settings(BASE_DIR=Path(base_dir)),
+                patch.dict(export_templates.BUNDLES, {"broken": broken}, clear=True),
+            ):
+                errors = export_templates.check_bundles(None)
+                self.assertEqual(len(errors), 1)
+                self.assertIn("lacks placeholder 'Example blog title'", errors[0].msg)
+
+                (Path(base_dir) / "broken" / "config.toml").write_text(
+                    'title = "Example blog title"'
+                )
+                errors = export_templates.check_bundles(None)
+                self.assertEqual(len(errors), 1)
+                self.assertIn("Cannot read export template", errors[0].msg)
+
+
+class ExportZipStreamTestCase(TestCase):
+    def test_entries_read_as_sent(self):
+        read = []
+
+        def entries():
+            for name in ["a.md", "b.md"]:
+                read.append(name)
+                yield name, name * 1000
+
+        chunks = exports.iter_zip(entries())
+        first = next(chunks)
+        self.assertEqual(read, ["a.md"])
+        self.assertIn(b"a.md", first)
+
+        archive = first + b"".join(chunks)
+        with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+            self.assertEqual(zf.namelist(), ["a.md", "b.md"])
+            self.assertEqual(zf.read("b.md"), b"b.md" * 1000)
+            self.assertIsNone(zf.testzip())
 
 
 class BlogExportEpubTestCase(TestCase):
@@ -247,13 +834,57 @@ class BlogExportEpubTestCase(TestCase):
         }
         self.post = models.Post.objects.create(owner=self.user, **self.data)
 
-    def test_blog_export(self):
-        response = self.client.post(reverse("export_epub"))
+    def get_epub(self):
+        response = run_export(self, "export_epub")
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response["Content-Type"], "application/epub")
-        self.assertContains(response, b"OEBPS/titlepage.xhtml")
-        self.assertContains(response, b"OEBPS/toc.xhtml")
-        self.assertContains(response, b"OEBPS/author.xhtml")
+        self.assertTrue(response.streaming)
+        return zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+
+    def test_blog_export(self):
+        with self.get_epub() as epub:
+            names = epub.namelist()
+            self.assertEqual(names[0], "mimetype")
+            self.assertEqual(epub.getinfo("mimetype").compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(epub.read("mimetype"), b"application/epub+zip")
+            self.assertIn("OEBPS/titlepage.xhtml", names)
+            self.assertIn("OEBPS/author.xhtml", names)
+            self.assertIn(b"Content sentence.", epub.read("OEBPS/1.xhtml"))
+            self.assertIn(b'href="1.xhtml"', epub.read("OEBPS/toc.xhtml"))
+            self.assertIn(b"Welcome post", epub.read("OEBPS/toc.ncx"))
+            self.assertIsNone(epub.testzip())
+
+    def test_blog_export_linked_images(self):
+        models.Image.objects.create(
+            owner=self.user, name="a", slug="linked", extension="png", data=b"a"
+        )
+        models.Image.objects.create(
+            owner=self.user, name="b", slug="unlinked", extension="png", data=b"b"
+        )
+        self.post.body = "![a](/images/linked.png)"
+        self.post.save()
+        with self.get_epub() as epub:
+            names = epub.namelist()
+            self.assertEqual(epub.read("OEBPS/images/linked.png"), b"a")
+            self.assertNotIn("OEBPS/images/unlinked.png", names)
+            self.assertIn(
+                b'href="images/linked.png" media-type="image/png"',
+                epub.read("OEBPS/content.opf"),
+            )
+
+    def test_blog_export_other_users_images(self):
+        bob = models.User.objects.create(username="bob")
+        image = models.Image.objects.create(
+            owner=bob, name="b", slug="bobs", extension="png", data=b"b"
+        )
+        self.post.body = "![b](/images/bobs.png)"
+        self.post.save()
+        self.assertFalse(self.post.images.exists())
+
+        # links stored before only images of the owner were linked
+        self.post.images.add(image)
+        with self.get_epub() as epub:
+            self.assertNotIn("OEBPS/images/bobs.png", epub.namelist())
 
 
 class BlogNotificationListTestCase(TestCase):
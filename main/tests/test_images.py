@@ -1,7 +1,30 @@
-from django.test import TestCase
+import os
+import tempfile
+from io import BytesIO
+from pathlib import Path
+from unittest.mock import patch
+
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from PIL import Image
+
+from main import images, models, storage
+
+# keep uploads and variants of all tests out of the real image storage
+images_root = tempfile.TemporaryDirectory()
+images_root_settings = override_settings(
+    IMAGES_ROOT=Path(images_root.name) / "images",
+    IMAGE_VARIANTS_ROOT=Path(images_root.name) / "variants",
+)
+
 
-from main import models
+def setUpModule():
+    images_root_settings.enable()
+
+
+def tearDownModule():
+    images_root_settings.disable()
+    images_root.cleanup()
 
 
 class ImageCreateTestCase(TestCase):
@@ -42,6 +65,48 @@ class ImageDetailTestCase(TestCase):
         self.assertContains(response, "Uploaded on")
 
 
+class ImageLinksTestCase(TestCase):
+    """Tests the images linked from post and page bodies are kept."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.client.force_login(self.user)
+        self.image = models.Image.objects.create(
+            owner=self.user, name="vulf", slug="vulf", extension="jpeg", data=b"a"
+        )
+        self.other = models.Image.objects.create(
+            owner=self.user, name="other", slug="other", extension="png", data=b"b"
+        )
+        self.post = models.Post.objects.create(
+            owner=self.user,
+            title="Hello",
+            slug="hello",
+            body="![vulf](https://mataroa.blog/images/vulf.jpeg?w=800)",
+        )
+
+    def test_post_save(self):
+        self.assertEqual(list(self.post.images.all()), [self.image])
+        self.post.body = "![other](/images/other.webp) ![gone](/images/gone.png)"
+        self.post.save()
+        self.assertEqual(list(self.post.images.all()), [self.other])
+
+    def test_page_save(self):
+        page = models.Page.objects.create(
+            owner=self.user, title="About", slug="about", body="/images/other.png"
+        )
+        self.assertEqual(list(page.images.all()), [self.other])
+
+    def test_image_detail(self):
+        response = self.client.get(reverse("image_detail", args=(self.image.slug,)))
+        self.assertEqual(list(response.context["used_by_posts"]), [self.post])
+        response = self.client.get(reverse("image_detail", args=(self.other.slug,)))
+        self.assertEqual(list(response.context["used_by_posts"]), [])
+
+    def test_image_list_unused(self):
+        response = self.client.get(reverse("image_list"))
+        self.assertEqual(list(response.context["unused_images"]), [self.other])
+
+
 class ImageDetailNotOwnTestCase(TestCase):
     """Tests user cannot open image detail page of another user's image."""
 
@@ -100,7 +165,350 @@ class ImageRawTestCase(TestCase):
             reverse("image_raw", args=(self.image.slug, self.image.extension)),
         )
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(self.image.data, response.content)
+        self.assertEqual(self.image.read_data(), b"".join(response.streaming_content))
+
+
+class ImageRawCachingTestCase(TestCase):
+    """Tests image_raw sends caching headers and answers conditional requests."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.client.force_login(self.user)
+        with open("main/tests/testdata/vulf.jpeg", "rb") as fp:
+            self.data = fp.read()
+            fp.seek(0)
+            self.client.post(reverse("image_list"), {"file": fp})
+        self.image = models.Image.objects.get(name="vulf")
+        self.url = reverse("image_raw", args=(self.image.slug, self.image.extension))
+
+    def test_headers(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response["ETag"], f'"{self.image.digest}"')
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertEqual(response["Content-Length"], str(len(self.data)))
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+
+    def test_not_modified(self):
+        response = self.client.get(
+            self.url, HTTP_IF_NONE_MATCH=f'"{self.image.digest}"'
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], f'"{self.image.digest}"')
+        self.assertIn("immutable", response["Cache-Control"])
+
+    def test_range(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=10-19")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), self.data[10:20])
+        self.assertEqual(response["Content-Range"], f"bytes 10-19/{len(self.data)}")
+
+    def test_range_suffix(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=-5")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), self.data[-5:])
+
+    def test_range_not_satisfiable(self):
+        response = self.client.get(self.url, HTTP_RANGE=f"bytes={len(self.data)}-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], f"bytes */{len(self.data)}")
+
+    def test_range_if_range_mismatch(self):
+        response = self.client.get(
+            self.url, HTTP_RANGE="bytes=10-19", HTTP_IF_RANGE='"other"'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), self.data)
+
+
+class ImageRawDatabaseTestCase(TestCase):
+    """Tests images not yet moved to the image storage are still served."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.image = models.Image.objects.create(
+            owner=self.user, name="vulf", slug="vulf", extension="jpeg", data=b"jpeg"
+        )
+
+    def test_image_raw(self):
+        response = self.client.get(
+            reverse("image_raw", args=(self.image.slug, self.image.extension)),
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Length"], "4")
+        self.assertEqual(b"".join(response.streaming_content), b"jpeg")
+
+    def test_image_raw_chunked(self):
+        with patch.object(models, "DATABASE_CHUNK_SIZE", 3):
+            response = self.client.get(
+                reverse("image_raw", args=(self.image.slug, self.image.extension)),
+            )
+            with self.assertNumQueries(2):
+                chunks = list(response.streaming_content)
+        self.assertEqual(chunks, [b"jpe", b"g"])
+
+    def test_image_raw_range(self):
+        response = self.client.get(
+            reverse("image_raw", args=(self.image.slug, self.image.extension)),
+            HTTP_RANGE="bytes=1-2",
+        )
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Length"], "2")
+        self.assertEqual(b"".join(response.streaming_content), b"pe")
+        self.assertEqual(
+            response["ETag"], f'"{storage.image_storage.get_digest(b"jpeg")}"'
+        )
+
+
+class ImageIterDataTestCase(TestCase):
+    """Tests image bytes are read in chunks, from storage or database alike."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.stored = models.Image.objects.create(
+            owner=self.user,
+            name="stored",
+            slug="stored",
+            extension="jpeg",
+            digest=storage.image_storage.save(b"0123456789"),
+            size_bytes=10,
+        )
+        self.legacy = models.Image.objects.create(
+            owner=self.user,
+            name="legacy",
+            slug="legacy",
+            extension="jpeg",
+            data=b"0123456789",
+        )
+
+    def test_chunks(self):
+        with (
+            patch.object(storage, "CHUNK_SIZE", 4),
+            patch.object(models, "DATABASE_CHUNK_SIZE", 4),
+        ):
+            for image in [self.stored, self.legacy]:
+                self.assertEqual(list(image.iter_data()), [b"0123", b"4567", b"89"])
+                self.assertEqual(list(image.iter_data(3, 9)), [b"3456", b"78"])
+                self.assertEqual(list(image.iter_data(8, 20)), [b"89"])
+
+
+class ImageStorageTestCase(TestCase):
+    """Tests image bytes are stored once per content, outside the database."""
+
+    def setUp(self):
+        self.alice = models.User.objects.create(username="alice")
+        self.bob = models.User.objects.create(username="bob")
+        for user in [self.alice, self.bob]:
+            self.client.force_login(user)
+            with open("main/tests/testdata/vulf.jpeg", "rb") as fp:
+                self.client.post(reverse("image_list"), {"file": fp})
+        self.alice_image = models.Image.objects.get(owner=self.alice)
+        self.bob_image = models.Image.objects.get(owner=self.bob)
+
+    def test_stored_by_digest(self):
+        with open("main/tests/testdata/vulf.jpeg", "rb") as fp:
+            data = fp.read()
+        self.assertIsNone(self.alice_image.data)
+        self.assertEqual(self.alice_image.size_bytes, len(data))
+        self.assertEqual(
+            self.alice_image.digest, storage.image_storage.get_digest(data)
+        )
+        path = storage.image_storage.path(self.alice_image.digest)
+        self.assertEqual(path.read_bytes(), data)
+        self.assertEqual(path.parent.parent.name, self.alice_image.digest[:2])
+
+    def test_deduplicated(self):
+        self.assertEqual(self.alice_image.digest, self.bob_image.digest)
+
+    def test_file_kept_on_delete(self):
+        # for sweepimages to delete, as uploads of the same bytes may be saving
+        path = storage.image_storage.path(self.alice_image.digest)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice_image.delete()
+            self.bob_image.delete()
+        self.assertTrue(path.exists())
+
+
+class ImageUsageTestCase(TestCase):
+    """Tests the image count and bytes of users follow uploads and deletes."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.client.force_login(self.user)
+        with open("main/tests/testdata/vulf.jpeg", "rb") as fp:
+            self.data = fp.read()
+            fp.seek(0)
+            self.client.post(reverse("image_list"), {"file": fp})
+
+    def test_upload(self):
+        usage = models.ImageUsage.objects.get(user=self.user)
+        self.assertEqual(usage.count, 1)
+        self.assertEqual(usage.size_bytes, len(self.data))
+
+    def test_delete(self):
+        image = models.Image.objects.get(owner=self.user)
+        self.client.post(reverse("image_delete", args=(image.slug,)))
+        usage = models.ImageUsage.objects.get(user=self.user)
+        self.assertEqual(usage.count, 0)
+        self.assertEqual(usage.size_bytes, 0)
+
+    def test_delete_user(self):
+        self.user.delete()
+        self.assertFalse(models.ImageUsage.objects.exists())
+
+    def test_quota(self):
+        models.ImageUsage.objects.filter(user=self.user).update(
+            size_bytes=1_000_000_000 - 10
+        )
+        with open("main/tests/testdata/vulf.jpeg", "rb") as fp:
+            response = self.client.post(reverse("image_list"), {"file": fp})
+        self.assertContains(response, "Storage limit exceeded")
+        self.assertEqual(models.Image.objects.filter(owner=self.user).count(), 1)
+
+    def test_image_list(self):
+        response = self.client.get(reverse("image_list"))
+        self.assertEqual(
+            response.context["total_quota"], round(len(self.data) / 1_000_000, 2)
+        )
+
+
+class ImageVariantTestCase(TestCase):
+    """Tests resized and converted variants of images."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        output = BytesIO()
+        Image.new("RGB", (1000, 500), "teal").save(output, "PNG")
+        self.data = output.getvalue()
+        self.image = models.Image.objects.create(
+            owner=self.user,
+            name="teal",
+            slug="teal",
+            extension="png",
+            digest=storage.image_storage.save(self.data),
+            size_bytes=len(self.data),
+        )
+        self.url = reverse("image_raw", args=(self.image.slug, "png"))
+        self.webp_url = reverse("image_raw", args=(self.image.slug, "webp"))
+
+    def open_response(self, response):
+        return Image.open(BytesIO(b"".join(response.streaming_content)))
+
+    def test_width(self):
+        response = self.client.get(self.url, {"w": "300"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertEqual(response["ETag"], f'"{self.image.digest}-320.png"')
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertEqual(self.open_response(response).size, (320, 160))
+
+    def test_cached(self):
+        hits = images.variant_cache.info()["hits"]
+        self.client.get(self.url, {"w": "640"})
+        with patch.object(images, "make_variant") as make_variant:
+            response = self.client.get(self.url, {"w": "640"})
+        make_variant.assert_not_called()
+        self.assertEqual(images.variant_cache.info()["hits"], hits + 1)
+        self.assertEqual(self.open_response(response).size, (640, 320))
+
+    def test_webp(self):
+        response = self.client.get(self.webp_url)
+        self.assertEqual(response["Content-Type"], "image/webp")
+        variant = self.open_response(response)
+        self.assertEqual(variant.format, "WEBP")
+        self.assertEqual(variant.size, (1000, 500))
+
+    def test_webp_width(self):
+        response = self.client.get(self.webp_url, {"w": "800"})
+        variant = self.open_response(response)
+        self.assertEqual((variant.format, variant.size), ("WEBP", (800, 400)))
+
+    @override_settings(IMAGE_VARIANT_MAX_PIXELS=100_000)
+    def test_too_large(self):
+        response = self.client.get(self.url, {"w": "320"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_decompression_bomb(self):
+        with patch.object(Image, "MAX_IMAGE_PIXELS", 1000):
+            response = self.client.get(self.url, {"w": "320"})
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(IMAGE_VARIANT_MAX_PIXELS=600_000)
+    def test_jpeg_decoded_smaller(self):
+        # 4000x2000 pixels, but decoded at 1/4 of that for a 320 wide variant
+        output = BytesIO()
+        Image.new("RGB", (4000, 2000), "teal").save(output, "JPEG")
+        variant = images.make_variant(output.getvalue(), 320, "jpeg")
+        self.assertEqual(Image.open(BytesIO(variant)).size, (320, 160))
+        with self.assertRaises(ValueError):
+            images.make_variant(output.getvalue(), 1600, "jpeg")
+
+    def test_wider_than_widths(self):
+        response = self.client.get(self.url, {"w": "5000"})
+        self.assertEqual(response["ETag"], f'"{self.image.digest}"')
+        self.assertEqual(b"".join(response.streaming_content), self.data)
+
+    def test_not_enlarged(self):
+        response = self.client.get(self.url, {"w": "1280"})
+        self.assertEqual(b"".join(response.streaming_content), self.data)
+
+    def test_invalid_width(self):
+        for width in ["wide", "0", "-5"]:
+            response = self.client.get(self.url, {"w": width})
+            self.assertEqual(response.status_code, 404)
+
+    def test_gif_not_converted(self):
+        self.image.extension = "gif"
+        self.image.save()
+        response = self.client.get(reverse("image_raw", args=(self.image.slug, "webp")))
+        self.assertEqual(response.status_code, 404)
+
+    def test_not_modified(self):
+        with patch.object(images, "get_variant") as get_variant:
+            response = self.client.get(
+                self.url,
+                {"w": "320"},
+                HTTP_IF_NONE_MATCH=f'"{self.image.digest}-320.png"',
+            )
+        get_variant.assert_not_called()
+        self.assertEqual(response.status_code, 304)
+
+    def test_range(self):
+        full = b"".join(self.client.get(self.webp_url).streaming_content)
+        response = self.client.get(self.webp_url, HTTP_RANGE="bytes=0-9")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), full[:10])
+
+
+class LRUFileCacheTestCase(TestCase):
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        settings = override_settings(CACHE_ROOT=root.name, CACHE_MAX_BYTES=25)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.cache = storage.LRUFileCache("CACHE_ROOT", "CACHE_MAX_BYTES")
+
+    def test_get(self):
+        self.assertIsNone(self.cache.get("key"))
+        path = self.cache.put("key", b"data")
+        self.assertEqual(self.cache.get("key"), path)
+        self.assertEqual(path.read_bytes(), b"data")
+        self.assertEqual(self.cache.info()["hits"], 1)
+        self.assertEqual(self.cache.info()["misses"], 1)
+
+    def test_evicts_least_recently_used(self):
+        for i, key in enumerate(["first", "second"]):
+            path = self.cache.put(key, b"0123456789")
+            os.utime(path, (i, i))
+        # using the first makes the second the least recently used
+        self.cache.get("first")
+        self.cache.put("third", b"0123456789")
+        self.assertIsNotNone(self.cache.get("first"))
+        self.assertIsNone(self.cache.get("second"))
+        self.assertIsNotNone(self.cache.get("third"))
+        self.assertEqual(self.cache.info()["evictions"], 1)
+        self.assertEqual(self.cache.info()["total_bytes"], 20)
 
 
 class ImageRawWrongExtTestCase(TestCase):
@@ -0,0 +1,125 @@
+from datetime import timedelta
+from types import SimpleNamespace
+
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection
+from django.test import TestCase
+from django.utils import timezone
+
+from main import feeds, models, sitemaps
+from main.management.commands import processnotifications
+from main.views import general
+
+
+class QueryIndexTestCase(TestCase):
+    """
+    The hot queries, planned against a seeded dataset of many blogs, use the
+    indexes designed for them.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        today = now.date()
+        users = models.User.objects.bulk_create(
+            [
+                models.User(username=f"user{i}", notifications_on=True)
+                for i in range(200)
+            ]
+        )
+        # one long-running blog among many small ones
+        cls.user = users[0]
+        posts = models.Post.objects.bulk_create(
+            [
+                models.Post(
+                    owner=user,
+                    title=f"post {i}",
+                    slug=f"post-{i}",
+                    body="body",
+                    # some drafts, and one scheduled post per blog
+                    published_at=None if i % 10 == 0 else today - timedelta(days=i - 1),
+                    broadcasted_at=now if i > 2 else None,
+                )
+                for user in users
+                for i in range(300 if user == cls.user else 20)
+            ]
+        )
+        cls.post = posts[5]
+        models.Comment.objects.bulk_create(
+            [
+                models.Comment(post=post, body="comment", is_approved=i % 3 != 0)
+                for post in posts
+                for i in range(200 if post == cls.post else 2)
+            ]
+        )
+        # a hit a day for a year, and a few for the rest
+        models.AnalyticPost.objects.bulk_create(
+            [
+                models.AnalyticPost(post=post, created_at=now - timedelta(days=i))
+                for post in posts
+                for i in range(365 if post == cls.post else 3)
+            ]
+        )
+        models.AnalyticPage.objects.bulk_create(
+            [
+                models.AnalyticPage(
+                    user=user, path=path, created_at=now - timedelta(days=i)
+                )
+                for user in users
+                for path in ["index", "rss", "about", "now"]
+                for i in range(365 if user == cls.user else 3)
+            ]
+        )
+        with connection.cursor() as cursor:
+            for model in [
+                models.User,
+                models.Post,
+                models.Comment,
+                models.AnalyticPost,
+                models.AnalyticPage,
+            ]:
+                cursor.execute(f"ANALYZE {model._meta.db_table}")
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan, msg=plan)
+
+    def test_blog_index(self):
+        request = SimpleNamespace(blog_user=self.user, user=AnonymousUser())
+        posts = general.get_index_posts(request, timezone.now().date())
+        self.assertUsesIndex(posts, "post_owner_published_idx")
+
+    def test_rss_feed(self):
+        feed = feeds.RSSBlogFeed()
+        feed.subdomain = self.user.username
+        self.assertUsesIndex(feed.items(), "post_owner_published_idx")
+
+    def test_sitemap(self):
+        sitemap = sitemaps.PostSitemap(self.user.username)
+        self.assertUsesIndex(sitemap.items(), "post_owner_published_idx")
+
+    def test_processnotifications(self):
+        yesterday = timezone.now().date() - timedelta(days=1)
+        posts = processnotifications.get_unbroadcasted_posts(yesterday)
+        self.assertUsesIndex(posts, "post_unbroadcasted_idx")
+
+    def test_post_comments(self):
+        for is_approved in [True, False]:
+            comments = models.Comment.objects.filter(
+                post=self.post, is_approved=is_approved
+            )
+            self.assertUsesIndex(comments, "comment_post_approved_idx")
+
+    def test_post_analytics(self):
+        hits = models.AnalyticPost.objects.filter(
+            post=self.post, created_at__gte=timezone.now() - timedelta(days=3)
+        )
+        self.assertUsesIndex(hits, "analyticpost_post_created_idx")
+
+    def test_page_analytics(self):
+        hits = models.AnalyticPage.objects.filter(
+            user=self.user,
+            path="rss",
+            created_at__gte=timezone.now() - timedelta(days=24),
+        )
+        self.assertUsesIndex(hits, "analyticpage_user_path_idx")
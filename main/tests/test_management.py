@@ -1,20 +1,30 @@
-from datetime import datetime
-from io import StringIO
+import os
+import smtplib
+import socketserver
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import datetime, timedelta
+from io import BytesIO, StringIO
+from pathlib import Path
 from unittest.mock import patch
 
 from django.conf import settings
 from django.core import mail
-from django.core.management import call_command
-from django.test import TestCase
+from django.core.mail.backends import locmem
+from django.core.management import CommandError, call_command
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.utils import timezone
 
-from main import models
-from main.management.commands import mailexports, processnotifications
+from main import analytics, exports, models, storage, util
+from main.management.commands import mailexports, sendnotifications
 
 
 class ProcessNotificationsTest(TestCase):
     """
-    Test processnotifications sends emails to the blog's subscibers.
+    Test processnotifications queues emails to the blog's subscibers, and
+    sendnotifications sends them.
     """
 
     def setUp(self):
@@ -43,7 +53,7 @@ class ProcessNotificationsTest(TestCase):
         )
 
     def test_mail_backend(self):
-        connection = processnotifications.get_mail_connection()
+        connection = sendnotifications.get_mail_connection()
         self.assertEqual(connection.host, settings.EMAIL_HOST_BROADCASTS)
 
     def test_command(self):
@@ -54,8 +64,8 @@ class ProcessNotificationsTest(TestCase):
             patch.object(
                 # Django default test runner overrides SMTP EmailBackend with locmem,
                 # but because we re-import the SMTP backend in
-                # processnotifications.get_mail_connection, we need to mock it here too.
-                processnotifications,
+                # sendnotifications.get_mail_connection, we need to mock it here too.
+                sendnotifications,
                 "get_mail_connection",
                 return_value=mail.get_connection(
                     "django.core.mail.backends.locmem.EmailBackend"
@@ -63,6 +73,7 @@ class ProcessNotificationsTest(TestCase):
             ),
         ):
             call_command("processnotifications", "--no-dryrun", stdout=output)
+            call_command("sendnotifications", stdout=output)
 
         # notification records
         records = models.NotificationRecord.objects.all()
@@ -105,11 +116,201 @@ class ProcessNotificationsTest(TestCase):
             "List-Unsubscribe=One-Click",
         )
 
+    def test_blog_unchanged(self):
+        self.user.refresh_from_db()
+        blog_changed_at = self.user.blog_changed_at
+        with patch.object(timezone, "now", return_value=datetime(2020, 1, 2, 13, 00)):
+            call_command("processnotifications", "--no-dryrun", stdout=StringIO())
+
+        self.post_yesterday.refresh_from_db()
+        self.assertEqual(
+            self.post_yesterday.broadcasted_at, datetime(2020, 1, 2, 13, 00)
+        )
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.blog_changed_at, blog_changed_at)
+
     def tearDown(self):
         models.User.objects.all().delete()
         models.Post.objects.all().delete()
 
 
+class FlakyEmailBackend(locmem.EmailBackend):
+    """Fails the number of times in failures to send to each address."""
+
+    def __init__(self, failures, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+        self.lock = threading.Lock()
+
+    def send_messages(self, messages):
+        with self.lock:
+            for message in messages:
+                if self.failures.get(message.to[0], 0) > 0:
+                    self.failures[message.to[0]] -= 1
+                    raise smtplib.SMTPServerDisconnected(
+                        "Connection unexpectedly closed"
+                    )
+        return super().send_messages(messages)
+
+
+@patch.object(sendnotifications, "RETRY_BACKOFF_SECONDS", 0)
+class SendNotificationsTest(TestCase):
+    """
+    Test sendnotifications sends queued emails in chunks, over a pool of
+    connections, retries failed sends, and resumes stopped runs.
+    """
+
+    def setUp(self):
+        self.user = models.User.objects.create(
+            username="alice", email="alice@mataroa.blog", notifications_on=True
+        )
+        self.post = models.Post.objects.create(
+            owner=self.user,
+            title="Yesterday post",
+            slug="yesterday-post",
+            body="Content sentence.",
+            published_at=datetime(2020, 1, 1),
+        )
+        self.notifications = models.Notification.objects.bulk_create(
+            [
+                models.Notification(blog_user=self.user, email=f"s{i}@example.com")
+                for i in range(25)
+            ]
+        )
+        self.now = datetime(2020, 1, 2, 10, 00)
+        with patch.object(timezone, "now", return_value=self.now):
+            call_command("processnotifications", "--no-dryrun", stdout=StringIO())
+
+    def call_command(self, now=None, failures=None, rate="1000"):
+        output = StringIO()
+        with (
+            patch.object(timezone, "now", return_value=now or self.now),
+            patch.object(
+                sendnotifications,
+                "get_mail_connection",
+                side_effect=lambda: FlakyEmailBackend(failures or {}),
+            ),
+        ):
+            call_command(
+                "sendnotifications",
+                "--connections",
+                "3",
+                "--batch-size",
+                "10",
+                "--rate",
+                rate,
+                stdout=output,
+            )
+        return output.getvalue()
+
+    def get_statuses(self):
+        return dict(
+            models.NotificationRecord.objects.values_list(
+                "notification__email", "status"
+            )
+        )
+
+    def test_queued(self):
+        self.assertEqual(
+            set(self.get_statuses().values()), {models.NotificationRecord.Status.QUEUED}
+        )
+        self.assertEqual(len(mail.outbox), 0)
+        self.post.refresh_from_db()
+        self.assertIsNotNone(self.post.broadcasted_at)
+
+    def test_command(self):
+        output = self.call_command()
+        self.assertEqual(len(mail.outbox), 25)
+        self.assertEqual(
+            sorted(m.to[0] for m in mail.outbox),
+            sorted(n.email for n in self.notifications),
+        )
+        self.assertEqual(
+            set(self.get_statuses().values()), {models.NotificationRecord.Status.SENT}
+        )
+        self.assertRegex(
+            output,
+            r"Total 25 sent, 0 queued for retry, 0 failed and 0 dropped "
+            r"in [\d.]+s \([\d.]+ emails/s\)",
+        )
+
+        # same body for all, but their own unsubscribe link
+        for email in mail.outbox:
+            notification = models.Notification.objects.get(email=email.to[0])
+            head, unsubscribe_url = email.body.rstrip().rsplit("\n", 1)
+            self.assertIn("# Yesterday post", head)
+            self.assertIn(str(notification.unsubscribe_key), unsubscribe_url)
+            self.assertEqual(unsubscribe_url, email.extra_headers["List-Unsubscribe"])
+
+        # nothing left to send
+        self.call_command()
+        self.assertEqual(len(mail.outbox), 25)
+
+    def test_rate_limit(self):
+        sleeps = []
+        with patch.object(sendnotifications.time, "sleep", side_effect=sleeps.append):
+            self.call_command(rate="5")
+        # a burst of 20, then the other 5 spread out at 5 per second
+        self.assertEqual(len(sleeps), 5)
+        self.assertAlmostEqual(sleeps[-1], 1, delta=0.1)
+
+    def test_retry(self):
+        output = self.call_command(failures={"s3@example.com": 2, "s7@example.com": 3})
+        self.assertEqual(len(mail.outbox), 24)
+        self.assertIn("s3@example.com", [m.to[0] for m in mail.outbox])
+        self.assertIn("Failed to send 'Yesterday post' to s7@example.com.", output)
+        self.assertIn("Total 24 sent, 1 queued for retry", output)
+
+        # queued again, for later
+        record = models.NotificationRecord.objects.get(
+            notification__email="s7@example.com"
+        )
+        self.assertEqual(record.status, models.NotificationRecord.Status.QUEUED)
+        self.assertEqual(record.attempts, 1)
+        self.assertEqual(
+            record.next_attempt_at, self.now + sendnotifications.QUEUE_BACKOFF
+        )
+        self.call_command()
+        self.assertEqual(len(mail.outbox), 24)
+        self.call_command(now=record.next_attempt_at)
+        self.assertEqual(mail.outbox[-1].to, ["s7@example.com"])
+
+    def test_failed(self):
+        record = models.NotificationRecord.objects.get(
+            notification__email="s7@example.com"
+        )
+        record.attempts = sendnotifications.MAX_ATTEMPTS - 1
+        record.save()
+        output = self.call_command(failures={"s7@example.com": 3})
+        self.assertIn("0 queued for retry, 1 failed", output)
+        record.refresh_from_db()
+        self.assertEqual(record.status, models.NotificationRecord.Status.FAILED)
+
+    def test_resume(self):
+        # a run stopped after claiming a batch, leaving it sending
+        with patch.object(timezone, "now", return_value=self.now):
+            claimed = sendnotifications.claim_records(10)
+        self.call_command()
+        self.assertEqual(len(mail.outbox), 15)
+
+        # until the lease ends
+        self.call_command(now=self.now + sendnotifications.SENDING_LEASE)
+        self.assertEqual(len(mail.outbox), 25)
+        self.assertEqual(
+            {m.to[0] for m in mail.outbox[15:]},
+            {r.notification.email for r in claimed},
+        )
+
+    def test_unsubscribed(self):
+        models.Notification.objects.filter(email="s0@example.com").update(
+            is_active=False
+        )
+        output = self.call_command()
+        self.assertEqual(len(mail.outbox), 24)
+        self.assertIn("0 failed and 1 dropped", output)
+        self.assertNotIn("s0@example.com", self.get_statuses())
+
+
 class MailExportsTest(TestCase):
     """
     Test mail_export sends emails to users with `mail_export_on` enabled.
@@ -195,6 +396,545 @@ class MailExportsTest(TestCase):
             "List-Unsubscribe=One-Click",
         )
 
+        # attachment, built like the markdown export on the website
+        name, content, mimetype = mail.outbox[0].attachments[0]
+        self.assertEqual(name, records[0].name)
+        self.assertEqual(mimetype, "application/zip")
+        with zipfile.ZipFile(BytesIO(content)) as zf:
+            self.assertEqual(len(zf.namelist()), 2)
+            self.assertIn(
+                b"Content sentence two.",
+                zf.read(
+                    records[0].name.removesuffix(".zip")
+                    + "/alice-mataroa-blog/second-post.md"
+                ),
+            )
+
     def tearDown(self):
         models.User.objects.all().delete()
         models.Post.objects.all().delete()
+
+
+class MailExportsResumeTest(TestCase):
+    """
+    Test mailexports skips users exported earlier the same day, and leaves
+    failed users for the next run.
+    """
+
+    def setUp(self):
+        self.alice = models.User.objects.create(
+            username="alice", email="alice@mataroa.blog", mail_export_on=True
+        )
+        self.bob = models.User.objects.create(
+            username="bob", email="bob@mataroa.blog", mail_export_on=True
+        )
+
+    def call_command(self):
+        output = StringIO()
+        with (
+            patch.object(timezone, "now", return_value=datetime(2020, 1, 1, 10, 00)),
+            patch.object(
+                mailexports,
+                "get_mail_connection",
+                return_value=mail.get_connection(
+                    "django.core.mail.backends.locmem.EmailBackend"
+                ),
+            ),
+        ):
+            call_command("mailexports", "--workers", "1", stdout=output)
+        return output.getvalue()
+
+    def test_skip_exported_today(self):
+        with patch.object(timezone, "now", return_value=datetime(2020, 1, 1, 6, 00)):
+            models.ExportRecord.objects.create(name="earlier.zip", user=self.alice)
+        output = self.call_command()
+        self.assertIn("Skipping 1 users exported today.", output)
+        self.assertEqual([m.to for m in mail.outbox], [[self.bob.email]])
+        self.assertIn("Total 1 sent and 0 failed", output)
+
+    def test_resume_failed(self):
+        write_export = exports.write_export
+
+        def fail_for_alice(path, user, *args):
+            if user == self.alice:
+                raise OSError("disk full")
+            return write_export(path, user, *args)
+
+        with patch.object(exports, "write_export", side_effect=fail_for_alice):
+            output = self.call_command()
+        self.assertIn("Export for alice failed: OSError('disk full')", output)
+        self.assertIn("Total 1 sent and 1 failed", output)
+
+        output = self.call_command()
+        self.assertIn("Skipping 1 users exported today.", output)
+        self.assertEqual(
+            [m.to for m in mail.outbox], [[self.bob.email], [self.alice.email]]
+        )
+
+
+class SMTPStandIn(socketserver.StreamRequestHandler):
+    """Just enough of an SMTP server to accept messages, and count them."""
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        self.wfile.write(b"220 localhost\r\n")
+        while line := self.rfile.readline():
+            command = line[:4].upper()
+            if command == b"DATA":
+                self.wfile.write(b"354 go ahead\r\n")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                with self.server.lock:
+                    self.server.messages += 1
+            elif command == b"QUIT":
+                self.wfile.write(b"221 bye\r\n")
+                break
+            self.wfile.write(b"250 ok\r\n")
+
+
+class MailExportsThroughputTest(TransactionTestCase):
+    """
+    Test mailexports workers send over an SMTP server, one connection each,
+    and report their throughput.
+    """
+
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), SMTPStandIn)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.connections = 0
+        self.server.messages = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        for i in range(12):
+            user = models.User.objects.create(
+                username=f"user{i}", email=f"user{i}@mataroa.blog", mail_export_on=True
+            )
+            models.Post.objects.create(
+                owner=user, title="A post", slug="a-post", body="Content. " * 1000
+            )
+
+    def test_command(self):
+        output = StringIO()
+        with (
+            patch.object(timezone, "now", return_value=datetime(2020, 1, 1, 6, 00)),
+            override_settings(
+                EMAIL_HOST_BROADCASTS="127.0.0.1",
+                EMAIL_PORT=self.server.server_address[1],
+                EMAIL_USE_TLS=False,
+                EMAIL_HOST_USER="",
+                EMAIL_HOST_PASSWORD="",
+            ),
+        ):
+            call_command("mailexports", "--workers", "3", stdout=output)
+
+        self.assertEqual(self.server.messages, 12)
+        self.assertLessEqual(self.server.connections, 3)
+        self.assertEqual(models.ExportRecord.objects.count(), 12)
+        self.assertRegex(
+            output.getvalue(),
+            r"Total 12 sent and 0 failed in [\d.]+s \([\d.]+ exports/s\)",
+        )
+
+
+class ProcessExportsTest(TestCase):
+    """
+    Test processexports builds queued exports and expireexports deletes them.
+    """
+
+    def setUp(self):
+        exports_root = tempfile.TemporaryDirectory()
+        self.addCleanup(exports_root.cleanup)
+        settings_override = override_settings(EXPORTS_ROOT=Path(exports_root.name))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = models.User.objects.create(username="alice")
+        models.Post.objects.create(
+            owner=self.user, title="A post", slug="a-post", body="Content."
+        )
+
+    def create_job(self, export_format, **kwargs):
+        return models.ExportJob.objects.create(
+            user=self.user,
+            format=export_format,
+            name=exports.get_export_name(export_format),
+            **kwargs,
+        )
+
+    def test_command(self):
+        epub = self.create_job(models.ExportJob.Format.EPUB)
+        hugo = self.create_job(models.ExportJob.Format.HUGO)
+        output = StringIO()
+        call_command("processexports", stdout=output)
+
+        for job in [epub, hugo]:
+            job.refresh_from_db()
+            self.assertEqual(job.status, models.ExportJob.Status.DONE)
+            self.assertIsNotNone(job.expires_at)
+            with zipfile.ZipFile(job.path) as zf:
+                self.assertIsNone(zf.testzip())
+        self.assertTrue(epub.filename.startswith("export-book-"))
+        self.assertTrue(epub.filename.endswith(".epub"))
+        self.assertIn(f"Building {epub.filename} for alice.", output.getvalue())
+        self.assertIn("Exports done. Total 2 built and 0 failed.", output.getvalue())
+
+    def test_failed(self):
+        job = self.create_job(models.ExportJob.Format.MARKDOWN)
+        output = StringIO()
+        with patch.object(exports, "iter_zip", side_effect=OSError("disk full")):
+            call_command("processexports", stdout=output)
+        job.refresh_from_db()
+        self.assertEqual(job.status, models.ExportJob.Status.FAILED)
+        self.assertIn("disk full", job.error)
+        self.assertFalse(job.path.exists())
+        self.assertEqual(list(settings.EXPORTS_ROOT.iterdir()), [])
+        self.assertIn("Total 0 built and 1 failed.", output.getvalue())
+
+    def test_timed_out(self):
+        now = timezone.now()
+        running = self.create_job(
+            models.ExportJob.Format.MARKDOWN,
+            status=models.ExportJob.Status.RUNNING,
+            started_at=now - timedelta(minutes=5),
+        )
+        timed_out = self.create_job(
+            models.ExportJob.Format.ZOLA,
+            status=models.ExportJob.Status.RUNNING,
+            started_at=now - timedelta(minutes=settings.EXPORTS_TIMEOUT_MINUTES + 1),
+        )
+        call_command("processexports", stdout=StringIO())
+        running.refresh_from_db()
+        timed_out.refresh_from_db()
+        self.assertEqual(running.status, models.ExportJob.Status.RUNNING)
+        self.assertEqual(timed_out.status, models.ExportJob.Status.DONE)
+
+    def test_expire(self):
+        expired = self.create_job(models.ExportJob.Format.MARKDOWN)
+        fresh = self.create_job(models.ExportJob.Format.ZOLA)
+        call_command("processexports", stdout=StringIO())
+        expired.refresh_from_db()
+        expired.expires_at = timezone.now() - timedelta(minutes=1)
+        expired.save()
+        failed = self.create_job(
+            models.ExportJob.Format.HUGO,
+            status=models.ExportJob.Status.FAILED,
+            finished_at=timezone.now()
+            - timedelta(hours=settings.EXPORTS_EXPIRE_HOURS + 1),
+        )
+        partial = settings.EXPORTS_ROOT / ".tmp-partial"
+        partial.write_bytes(b"partial")
+        os.utime(partial, (0, 0))
+
+        output = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("expireexports", stdout=output)
+
+        self.assertEqual(list(models.ExportJob.objects.all()), [fresh])
+        self.assertFalse(expired.path.exists())
+        self.assertTrue(fresh.path.exists())
+        self.assertFalse(partial.exists())
+        self.assertIn(
+            "Expiry done. Total 2 exports and 1 partial files deleted.",
+            output.getvalue(),
+        )
+        self.assertFalse(models.ExportJob.objects.filter(id=failed.id).exists())
+
+
+class RenderPostsTest(TestCase):
+    """
+    Test renderposts stores HTML for posts with missing or stale rendering.
+    """
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user, title="A post", slug="a-post", body="Content **bold**."
+        )
+        models.Post.objects.filter(id=self.post.id).update(
+            body_html=None, body_html_version=0
+        )
+
+    def test_command(self):
+        output = StringIO()
+        call_command("renderposts", stdout=output)
+
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.body_html, "<p>Content <strong>bold</strong>.</p>")
+        self.assertEqual(self.post.body_html_version, util.MARKDOWN_VERSION)
+        self.assertIn("Rendering done. Total 1 posts", output.getvalue())
+
+    def test_command_skips_fresh(self):
+        call_command("renderposts", stdout=StringIO())
+        output = StringIO()
+        call_command("renderposts", stdout=output)
+        self.assertIn("Rendering done. Total 0 posts", output.getvalue())
+
+    def test_command_all(self):
+        call_command("renderposts", stdout=StringIO())
+        output = StringIO()
+        call_command("renderposts", "--all", stdout=output)
+        self.assertIn("Rendering done. Total 1 posts", output.getvalue())
+
+
+class RollupAnalyticsTest(TestCase):
+    """
+    Test rollupanalytics counts hits per day and prunes old raw hits.
+    """
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user, title="A post", slug="a-post", body="Content."
+        )
+        self.today = timezone.now().replace(hour=12, minute=0)
+        for days_ago in [40, 40, 3, 0]:
+            created_at = self.today - timedelta(days=days_ago)
+            models.AnalyticPost.objects.create(post=self.post, created_at=created_at)
+            models.AnalyticPage.objects.create(
+                user=self.user, path="index", created_at=created_at
+            )
+
+    def test_command(self):
+        output = StringIO()
+        call_command("rollupanalytics", stdout=output)
+
+        self.assertEqual(
+            dict(models.AnalyticPostDay.objects.values_list("date", "count")),
+            {
+                (self.today - timedelta(days=40)).date(): 2,
+                (self.today - timedelta(days=3)).date(): 1,
+                self.today.date(): 1,
+            },
+        )
+        self.assertEqual(
+            models.AnalyticPageDay.objects.get(
+                user=self.user, path="index", date=self.today.date()
+            ).count,
+            1,
+        )
+        self.assertIn("Total 3 post days and 3 page days", output.getvalue())
+        self.assertEqual(models.AnalyticPost.objects.count(), 4)
+
+    def test_command_incremental(self):
+        call_command("rollupanalytics", stdout=StringIO())
+        models.AnalyticPost.objects.create(post=self.post, created_at=self.today)
+
+        output = StringIO()
+        call_command("rollupanalytics", stdout=output)
+        self.assertIn("Total 1 post days", output.getvalue())
+        self.assertEqual(
+            models.AnalyticPostDay.objects.get(date=self.today.date()).count, 2
+        )
+        self.assertEqual(
+            models.AnalyticPostDay.objects.get(
+                date=(self.today - timedelta(days=40)).date()
+            ).count,
+            2,
+        )
+
+    def test_command_prune(self):
+        call_command("rollupanalytics", "--prune-days", "30", stdout=StringIO())
+
+        self.assertEqual(models.AnalyticPost.objects.count(), 2)
+        self.assertEqual(models.AnalyticPage.objects.count(), 2)
+        self.assertEqual(models.AnalyticPostDay.objects.count(), 3)
+
+    def test_prune_keeps_hits_not_rolled_up(self):
+        call_command("rollupanalytics", stdout=StringIO())
+        models.AnalyticPostDay.objects.exclude(
+            date=(self.today - timedelta(days=40)).date()
+        ).delete()
+
+        # latest rolled up day is 40 days ago, so later raw hits are kept
+        analytics.prune(models.AnalyticPost, models.AnalyticPostDay, keep_days=1)
+        self.assertEqual(models.AnalyticPost.objects.count(), 4)
+
+
+class MoveImagesTest(TestCase):
+    """
+    Test moveimages moves image bytes from the database to the image storage.
+    """
+
+    def setUp(self):
+        images_root = tempfile.TemporaryDirectory()
+        self.addCleanup(images_root.cleanup)
+        settings_override = override_settings(IMAGES_ROOT=images_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = models.User.objects.create(username="alice")
+        for slug, data in [
+            ("first", b"first"),
+            ("second", b"same"),
+            ("third", b"same"),
+        ]:
+            models.Image.objects.create(
+                owner=self.user, name=slug, slug=slug, extension="png", data=data
+            )
+
+    def test_command(self):
+        output = StringIO()
+        call_command("moveimages", "--batch-size", "2", stdout=output)
+
+        for image in models.Image.objects.all():
+            self.assertIsNone(image.data)
+            self.assertEqual(image.size_bytes, len(image.read_data()))
+        self.assertEqual(models.Image.objects.get(slug="first").read_data(), b"first")
+        self.assertEqual(
+            models.Image.objects.get(slug="second").digest,
+            models.Image.objects.get(slug="third").digest,
+        )
+        self.assertIn("Total 3 images, 13 bytes (1 already stored)", output.getvalue())
+
+    def test_command_resumes(self):
+        call_command("moveimages", stdout=StringIO())
+        output = StringIO()
+        call_command("moveimages", stdout=output)
+        self.assertIn("Total 0 images", output.getvalue())
+
+
+class SweepImagesTest(TestCase):
+    """Test sweepimages deletes stored image files no image refers to."""
+
+    def setUp(self):
+        images_root = tempfile.TemporaryDirectory()
+        self.addCleanup(images_root.cleanup)
+        settings_override = override_settings(IMAGES_ROOT=images_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = models.User.objects.create(username="alice")
+        self.used = self.store(b"used")
+        models.Image.objects.create(
+            owner=self.user, name="used", slug="used", extension="png", digest=self.used
+        )
+        self.unused = self.store(b"unused")
+        self.partial = storage.image_storage.path(self.used).parent / ".tmp-partial"
+        self.partial.write_bytes(b"part")
+        self.age(self.partial)
+
+    def store(self, data):
+        digest = storage.image_storage.save(data)
+        self.age(storage.image_storage.path(digest))
+        return digest
+
+    def age(self, path):
+        two_days_ago = time.time() - 2 * 24 * 3600
+        os.utime(path, (two_days_ago, two_days_ago))
+
+    def test_command(self):
+        output = StringIO()
+        call_command("sweepimages", "--batch-size", "1", stdout=output)
+        self.assertTrue(storage.image_storage.exists(self.used))
+        self.assertFalse(storage.image_storage.exists(self.unused))
+        self.assertFalse(self.partial.exists())
+        self.assertIn("Total 1 unused files and 1 partial files", output.getvalue())
+
+    def test_keeps_recent(self):
+        recent = storage.image_storage.save(b"recent")
+        call_command("sweepimages", stdout=StringIO())
+        self.assertTrue(storage.image_storage.exists(recent))
+
+    def test_keeps_uploaded_again(self):
+        # an upload of the same bytes, whose image is not saved yet
+        self.assertEqual(storage.image_storage.save(b"unused"), self.unused)
+        call_command("sweepimages", stdout=StringIO())
+        self.assertTrue(storage.image_storage.exists(self.unused))
+
+
+class BackfillImageUsageTest(TestCase):
+    def setUp(self):
+        self.alice = models.User.objects.create(username="alice")
+        self.bob = models.User.objects.create(username="bob")
+        models.Image.objects.create(
+            owner=self.alice, name="a", slug="a", extension="png", data=b"alice"
+        )
+        models.Image.objects.create(
+            owner=self.alice, name="b", slug="b", extension="png", data=b"alice2"
+        )
+        # as stored before sizes and usage were kept
+        models.Image.objects.update(size_bytes=None)
+        models.ImageUsage.objects.update(count=0, size_bytes=0)
+        models.ImageUsage.objects.create(user=self.bob, count=3, size_bytes=100)
+
+    def test_command(self):
+        output = StringIO()
+        call_command("backfillimageusage", "--batch-size", "1", stdout=output)
+        self.assertIn("Total 2 image sizes and 1 users", output.getvalue())
+        self.assertEqual(
+            sorted(models.Image.objects.values_list("size_bytes", flat=True)), [5, 6]
+        )
+        alice_usage = models.ImageUsage.objects.get(user=self.alice)
+        self.assertEqual((alice_usage.count, alice_usage.size_bytes), (2, 11))
+        bob_usage = models.ImageUsage.objects.get(user=self.bob)
+        self.assertEqual((bob_usage.count, bob_usage.size_bytes), (0, 0))
+
+
+class IndexImagesTest(TestCase):
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.image = models.Image.objects.create(
+            owner=self.user, name="a", slug="a1b2", extension="png", data=b"a"
+        )
+        self.post = models.Post.objects.create(
+            owner=self.user, title="A", slug="a", body="![a](/images/a1b2.png)"
+        )
+        self.page = models.Page.objects.create(
+            owner=self.user, title="B", slug="b", body="![a](/images/a1b2.png)"
+        )
+        self.stale = models.Post.objects.create(owner=self.user, title="C", slug="c")
+        self.other_user = models.User.objects.create(username="bob")
+        self.other = models.Post.objects.create(
+            owner=self.other_user, title="D", slug="d", body="![a](/images/a1b2.png)"
+        )
+        # as stored before links were kept
+        models.Post.images.through.objects.all().delete()
+        models.Page.images.through.objects.all().delete()
+        self.stale.images.add(self.image)
+
+    def test_command(self):
+        output = StringIO()
+        call_command("indeximages", "--batch-size", "1", stdout=output)
+        self.assertIn(
+            "Total 1 images in 2 posts and 1 images in 1 pages", output.getvalue()
+        )
+        self.assertEqual(list(self.post.images.all()), [self.image])
+        self.assertEqual(list(self.page.images.all()), [self.image])
+        self.assertFalse(self.stale.images.exists())
+        self.assertFalse(self.other.images.exists())
+
+
+class BenchmarkMarkdownTest(TestCase):
+    def test_command(self):
+        output = StringIO()
+        call_command(
+            "benchmarkmarkdown", "--code-blocks", "2", "--runs", "1", stdout=output
+        )
+        self.assertIn("2 code blocks", output.getvalue())
+        self.assertIn("speedup:", output.getvalue())
+
+
+class BenchmarkImagesTest(TestCase):
+    def test_command(self):
+        output = StringIO()
+        call_command(
+            "benchmarkimages",
+            "--size",
+            "64",
+            "--downloads",
+            "2",
+            "--i-know",
+            stdout=output,
+        )
+        self.assertIn("2 concurrent downloads of 64 KiB", output.getvalue())
+        self.assertIn("reduction:", output.getvalue())
+        self.assertFalse(models.Image.objects.exists())
+        self.assertFalse(models.User.objects.exists())
+
+    def test_refuses_without_debug(self):
+        with self.assertRaises(CommandError):
+            call_command("benchmarkimages", stdout=StringIO())
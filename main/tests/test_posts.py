@@ -2,7 +2,7 @@ from django.conf import settings
 from django.test import TestCase
 from django.urls import reverse
 
-from main import models
+from main import models, util
 
 
 class PostCreateTestCase(TestCase):
@@ -430,3 +430,44 @@ class PostDeleteNotOwnTestCase(TestCase):
                 slug=self.data["slug"], owner=self.victim
             ).exists()
         )
+
+
+class PostBodyHTMLTestCase(TestCase):
+    """Test rendered body HTML is stored on save and used on read."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.client.force_login(self.user)
+
+    def test_post_create_stores_html(self):
+        data = {
+            "title": "New post",
+            "slug": "new-post",
+            "body": "Content **sentence**.",
+        }
+        self.client.post(reverse("post_create"), data)
+        post = models.Post.objects.get(title=data["title"])
+        self.assertEqual(post.body_html, "<p>Content <strong>sentence</strong>.</p>")
+        self.assertEqual(post.body_html_version, util.MARKDOWN_VERSION)
+
+    def test_post_update_rerenders_html(self):
+        post = models.Post.objects.create(
+            owner=self.user, title="New post", slug="new-post", body="Old."
+        )
+        self.client.post(
+            reverse("post_update", args=(post.slug,)),
+            HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
+            data={"title": "New post", "slug": "new-post", "body": "*New*."},
+        )
+        post.refresh_from_db()
+        self.assertEqual(post.body_html, "<p><em>New</em>.</p>")
+
+    def test_post_stale_html_not_used(self):
+        post = models.Post.objects.create(
+            owner=self.user, title="New post", slug="new-post", body="Fresh."
+        )
+        models.Post.objects.filter(id=post.id).update(
+            body_html="<p>Stale.</p>", body_html_version=0
+        )
+        post.refresh_from_db()
+        self.assertEqual(post.body_as_html, "<p>Fresh.</p>")
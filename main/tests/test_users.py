@@ -289,3 +289,24 @@ class UserDomainCheckTestCase(TestCase):
     def test_domain_unknown(self):
         response = self.client.get(reverse("domain_check") + "?domain=randomdomain.com")
         self.assertEqual(response.status_code, 403)
+
+    def test_domain_check_from_memory(self):
+        self.client.get(reverse("domain_check") + "?domain=example.com")
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                reverse("domain_check") + "?domain=scanner.example.net"
+            )
+        self.assertEqual(response.status_code, 403)
+
+    def test_domain_added(self):
+        self.client.get(reverse("domain_check") + "?domain=example.org")
+        models.User.objects.create(username="bob", custom_domain="example.org")
+        response = self.client.get(reverse("domain_check") + "?domain=example.org")
+        self.assertEqual(response.status_code, 200)
+
+    def test_domain_removed(self):
+        self.client.get(reverse("domain_check") + "?domain=example.com")
+        self.user.custom_domain = None
+        self.user.save()
+        response = self.client.get(reverse("domain_check") + "?domain=example.com")
+        self.assertEqual(response.status_code, 403)
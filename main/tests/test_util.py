@@ -0,0 +1,175 @@
+import pygments
+from django.test import SimpleTestCase
+
+from main import util
+
+
+class LRUCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.cache = util.LRUCache(max_bytes=10, max_item_bytes=5)
+
+    def test_hit_miss(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", "A", size=1)
+        self.assertEqual(self.cache.get("a"), "A")
+        info = self.cache.info()
+        self.assertEqual(info["hits"], 1)
+        self.assertEqual(info["misses"], 1)
+        self.assertEqual(info["entries"], 1)
+        self.assertEqual(info["bytes"], 1)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set("a", "A", size=4)
+        self.cache.set("b", "B", size=4)
+        self.cache.get("a")  # "b" is now the least recently used
+        self.cache.set("c", "C", size=4)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("a"), "A")
+        self.assertEqual(self.cache.get("c"), "C")
+        self.assertEqual(self.cache.info()["evictions"], 1)
+        self.assertEqual(self.cache.info()["bytes"], 8)
+
+    def test_oversized_item_not_stored(self):
+        self.cache.set("a", "A", size=6)
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.info()["bytes"], 0)
+
+    def test_replace_keeps_size(self):
+        self.cache.set("a", "A", size=3)
+        self.cache.set("a", "AA", size=4)
+        self.assertEqual(self.cache.get("a"), "AA")
+        self.assertEqual(self.cache.info()["bytes"], 4)
+
+
+class MarkdownCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        util.md_cache.clear()
+
+    def test_md_to_html_cached(self):
+        self.assertEqual(util.md_to_html("**hey**"), "<p><strong>hey</strong></p>")
+        self.assertEqual(util.md_to_html("**hey**"), "<p><strong>hey</strong></p>")
+        info = util.md_cache.info()
+        self.assertEqual(info["misses"], 1)
+        self.assertEqual(info["hits"], 1)
+
+    def test_md_to_html_strip_tags_keyed_separately(self):
+        self.assertEqual(util.md_to_html("# hey"), '<h1 id="hey">hey</h1>')
+        self.assertEqual(util.md_to_html("# hey", strip_tags=True), "hey")
+        self.assertEqual(util.md_cache.info()["misses"], 2)
+
+
+class MarkdownRendererTestCase(SimpleTestCase):
+    def test_renderer_reused_per_thread(self):
+        self.assertIs(util.get_renderer(), util.get_renderer())
+
+    def test_footnotes_do_not_leak_between_documents(self):
+        first = util.render_markdown("text[^1]\n\n[^1]: first note")
+        second = util.render_markdown("plain text")
+        self.assertIn("first note", first)
+        self.assertEqual(second, "<p>plain text</p>")
+
+    def test_toc_ids_reset_between_documents(self):
+        util.render_markdown("# Title")
+        self.assertEqual(util.render_markdown("# Title"), '<h1 id="title">Title</h1>')
+
+    def test_get_lexer_cached(self):
+        self.assertIs(util.get_lexer("py"), util.get_lexer("py"))
+
+    def test_get_lexer_unknown_falls_back_to_c(self):
+        self.assertEqual(util.get_lexer("notalanguage").name, "C")
+
+    def test_code_block_highlighted(self):
+        html = util.render_markdown("```python\nprint('hey')\n```")
+        self.assertIn('<div style="background: #fdf6e3;">', html)
+        self.assertIn(">print</span>", html)
+
+
+def _reference_syntax_highlight(text):
+    """Line by line implementation syntax_highlight must stay equivalent to."""
+    processed_text = ""
+    within_code_block = False
+    lexer = None
+    code_block = ""
+    for line in text.split("\n"):
+        if line[:3] == "```":
+            if not within_code_block:
+                lang = line[3:].strip()
+                if lang:
+                    within_code_block = True
+                    lexer = util.get_lexer(lang)
+                    continue
+                else:
+                    lexer = None
+            else:
+                within_code_block = False
+                processed_text += pygments.highlight(
+                    code_block, lexer, util.code_formatter
+                )
+                code_block = ""
+                continue
+        if within_code_block:
+            code_block += line + "\n"
+        else:
+            processed_text += line + "\n"
+    return processed_text
+
+
+class SyntaxHighlightTestCase(SimpleTestCase):
+    def get_synthetic_document(self, size):
+        """Returns ~size chars of prose, pasted logs and a few code blocks."""
+        log = "\n".join(
+            f"2024-01-01 12:00:{i % 60:02d} INFO worker[{i}] handled in {i % 97} ms"
+            for i in range(1000)
+        )
+        prose = "Some prose with *emphasis* and a [link](https://example.com).\n"
+        section = (
+            prose * 100 + "\n```\n" + log + "\n```\n\n```python\nprint('hey')\n```\n\n"
+        )
+        return section * (size // len(section) + 1)
+
+    def test_edge_cases(self):
+        for text in [
+            "",
+            "no code",
+            "```py\nx = 1\n```",
+            "```py\n```",
+            "```\ngeneric\n```\n```py\nx\n```\ntail",
+            "```py\nunclosed\nblock",
+            "```py\r\nx = 1\r\n```\r\n",
+            "  ```py\nindented\n```",
+            "````py\nfour\n```\n",
+            "```py\n```js\n```\n",
+        ]:
+            with self.subTest(text=text):
+                self.assertEqual(
+                    util.syntax_highlight(text), _reference_syntax_highlight(text)
+                )
+
+    def test_synthetic_1mb_document(self):
+        text = self.get_synthetic_document(1_000_000)
+        self.assertEqual(util.syntax_highlight(text), _reference_syntax_highlight(text))
+
+
+class ParseByteRangeTestCase(SimpleTestCase):
+    def test_range(self):
+        self.assertEqual(util.parse_byte_range("bytes=0-499", 1000), (0, 499))
+
+    def test_open_ended(self):
+        self.assertEqual(util.parse_byte_range("bytes=500-", 1000), (500, 999))
+
+    def test_end_clamped(self):
+        self.assertEqual(util.parse_byte_range("bytes=500-2000", 1000), (500, 999))
+
+    def test_suffix(self):
+        self.assertEqual(util.parse_byte_range("bytes=-100", 1000), (900, 999))
+        self.assertEqual(util.parse_byte_range("bytes=-2000", 1000), (0, 999))
+
+    def test_full_content(self):
+        for header in [None, "", "bytes=-", "bytes=5-1", "bytes=0-1,5-6", "items=0-1"]:
+            self.assertIsNone(util.parse_byte_range(header, 1000))
+
+    def test_not_satisfiable(self):
+        with self.assertRaises(ValueError):
+            util.parse_byte_range("bytes=1000-", 1000)
+        with self.assertRaises(ValueError):
+            util.parse_byte_range("bytes=-0", 1000)
@@ -10,6 +10,7 @@ admin.site.site_header = "mataroa admin"
 urlpatterns = [
     path("", general.index, name="index"),
     path("blog/", general.blog_index, name="blog_index"),
+    path("archive/<int:year>/", general.blog_archive, name="blog_archive"),
     path("dashboard/", general.dashboard, name="dashboard"),
     path("about/methodology/", general.methodology, name="methodology"),
     path("about/transparency/", general.transparency, name="transparency"),
@@ -208,6 +209,16 @@ urlpatterns += [
     path("export/hugo/", export.export_hugo, name="export_hugo"),
     path("export/epub/", export.export_epub, name="export_epub"),
     path("export/print/", export.export_print, name="export_print"),
+    path(
+        "export/jobs/<int:job_id>/",
+        export.export_job_detail,
+        name="export_job_detail",
+    ),
+    path(
+        "export/jobs/<int:job_id>/download/",
+        export.export_job_download,
+        name="export_job_download",
+    ),
     path(
         "export/unsubscribe/<uuid:unsubscribe_key>/",
         export.export_unsubscribe_key,
@@ -1,7 +1,12 @@
+import functools
+import hashlib
 import io
 import re
+import sys
+import threading
 import uuid
 import zipfile
+from collections import OrderedDict
 
 import bleach
 import markdown
@@ -14,6 +19,77 @@ from pygments.lexers import ClassNotFound, get_lexer_by_name, get_lexer_for_file
 
 from main import denylist, models
 
+# Bump whenever the output of md_to_html changes (extensions, sanitiser
+# allowlists, highlighting style), so that stored HTML gets re-rendered.
+MARKDOWN_VERSION = 1
+
+
+class LRUCache:
+    """
+    Process-local least-recently-used cache bounded by total size in bytes.
+    Values larger than max_item_bytes are never stored.
+    """
+
+    def __init__(self, max_bytes, max_item_bytes=None):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes or max_bytes
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.data = OrderedDict()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.data:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.data.move_to_end(key)
+            return self.data[key][0]
+
+    def set(self, key, value, size):
+        if size > self.max_item_bytes:
+            return
+        with self.lock:
+            if key in self.data:
+                self.size -= self.data.pop(key)[1]
+            self.data[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.data.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.data:
+                self.size -= self.data.pop(key)[1]
+
+    def info(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.data),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+            }
+
+
+# memoizes md_to_html for the small strings rendered on every page view,
+# eg. bylines, footer notes and comments
+md_cache = LRUCache(
+    max_bytes=settings.MARKDOWN_CACHE_MAX_BYTES,
+    max_item_bytes=settings.MARKDOWN_CACHE_MAX_BYTES // 64,
+)
+
 
 def is_disallowed(username):
     """Return true if username is not allowed to be registered."""
@@ -64,60 +140,118 @@ def create_post_slug(post_title, owner, post=None):
     return slug
 
 
-def syntax_highlight(text):
-    """Highlights markdown codeblocks within a markdown text."""
+@functools.lru_cache(maxsize=256)
+def get_lexer(lang):
+    """Return pygments lexer for a code block language tag, cached per tag."""
+    try:
+        return get_lexer_for_filename("file." + lang)
+    except ClassNotFound:
+        try:
+            return get_lexer_by_name(lang)
+        except ClassNotFound:
+            # can't find lexer, just use C lang as default
+            return get_lexer_by_name("c")
 
-    processed_text = ""
-    within_code_block = False
-    lexer = None
-    code_block = ""
-    for line in text.split("\n"):
-        # code block backticks found, either begin or end
-        if line[:3] == "```":
-            if not within_code_block:
-                # then this is the beginning of a block
-                lang = line[3:].strip()
-
-                if lang:
-                    # then this is a *code* block
-                    within_code_block = True
-                    lang_filename = "file." + lang
-                    try:
-                        lexer = get_lexer_for_filename(lang_filename)
-                    except ClassNotFound:
-                        try:
-                            lexer = get_lexer_by_name(lang)
-                        except ClassNotFound:
-                            # can't find lexer, just use C lang as default
-                            lexer = get_lexer_by_name("c")
-
-                    # continue because we don't want to add backticks in the processed text
-                    continue
-                else:
-                    # no lang, so just a generic block (non-code)
-                    lexer = None
 
-            else:
-                # then this is the end of a code block
-                # actual highlighting happens here
-                within_code_block = False
-                highlighted_block = pygments.highlight(
-                    code_block,
-                    lexer,
-                    HtmlFormatter(style="solarized-light", noclasses=True, cssclass=""),
-                )
-                processed_text += highlighted_block
-                code_block = ""  # reset code_block variable
-
-                # continue because we don't want to add backticks in the processed text
+code_formatter = HtmlFormatter(style="solarized-light", noclasses=True, cssclass="")
+
+
+# a line beginning with backticks, matched along with its preceding new line
+CODE_FENCE_RE = re.compile(r"\n```([^\n]*)")
+
+
+def iter_highlighted(text):
+    """
+    Yields segments of a markdown text, with its codeblocks highlighted.
+    Text between code fences is sliced out whole, so that long texts are
+    processed in linear time.
+    """
+    # pad so that every line, including the first and last, is enclosed in
+    # new lines; the leading one is never yielded
+    text = "\n" + text + "\n"
+
+    position = 1  # start of text not yet yielded
+    code_start = 0  # start of current code block contents
+    lexer = None  # set only while within a code block
+    for fence in CODE_FENCE_RE.finditer(text):
+        # code block backticks found, either begin or end
+        if lexer is None:
+            lang = fence.group(1).strip()
+            if not lang:
+                # no lang, so just a generic block (non-code), keep as text
                 continue
 
-        if within_code_block:
-            code_block += line + "\n"
+            # then this is the beginning of a *code* block
+            # skip backticks line, we don't want it in the processed text
+            lexer = get_lexer(lang)
+            yield text[position : fence.start() + 1]
+            code_start = fence.end() + 1
         else:
-            processed_text += line + "\n"
+            # then this is the end of a code block
+            # actual highlighting happens here
+            code_block = text[code_start : fence.start() + 1]
+            yield pygments.highlight(code_block, lexer, code_formatter)
+            lexer = None
+            position = fence.end() + 1
+
+    # the contents of a code block that is never closed are dropped
+    if lexer is None:
+        yield text[position:]
+
 
-    return processed_text
+def syntax_highlight(text):
+    """Highlights markdown codeblocks within a markdown text."""
+    return "".join(iter_highlighted(text))
+
+
+class MarkdownRenderer:
+    """
+    Markdown and bleach objects built once and reused across documents.
+
+    Neither markdown.Markdown nor bleach's Cleaner is thread-safe, so use
+    get_renderer() to get the instance of the current thread.
+    """
+
+    def __init__(self):
+        self.markdown = markdown.Markdown(
+            extensions=[
+                "markdown.extensions.fenced_code",
+                "markdown.extensions.tables",
+                "markdown.extensions.footnotes",
+                "markdown.extensions.toc",
+            ],
+        )
+        self.cleaner = bleach.sanitizer.Cleaner(
+            tags=denylist.ALLOWED_HTML_ELEMENTS,
+            attributes=denylist.ALLOWED_HTML_ATTRS,
+            css_sanitizer=CSSSanitizer(
+                allowed_css_properties=denylist.ALLOWED_CSS_STYLES
+            ),
+        )
+        self.strip_cleaner = bleach.sanitizer.Cleaner(strip=True)
+
+    def clean(self, dirty_html, strip_tags=False):
+        if strip_tags:
+            return self.strip_cleaner.clean(dirty_html)
+        return self.cleaner.clean(dirty_html)
+
+    def render(self, markdown_string, strip_tags=False):
+        try:
+            dirty_html = self.markdown.convert(syntax_highlight(markdown_string))
+        finally:
+            # footnotes and toc keep per-document state on the instance
+            self.markdown.reset()
+        return self.clean(dirty_html, strip_tags)
+
+
+_renderers = threading.local()
+
+
+def get_renderer():
+    """Return the MarkdownRenderer of the current thread."""
+    if not hasattr(_renderers, "renderer"):
+        _renderers.renderer = MarkdownRenderer()
+    return _renderers.renderer
 
 
 def clean_html(dirty_html, strip_tags=False):
@@ -125,32 +259,29 @@ def clean_html(dirty_html, strip_tags=False):
 
     - strip_tags: true will strip everything, false will escape.
     """
-    if strip_tags:
-        return bleach.clean(dirty_html, strip=True)
-
-    css_sanitizer = CSSSanitizer(allowed_css_properties=denylist.ALLOWED_CSS_STYLES)
-    return bleach.clean(
-        dirty_html,
-        tags=denylist.ALLOWED_HTML_ELEMENTS,
-        attributes=denylist.ALLOWED_HTML_ATTRS,
-        css_sanitizer=css_sanitizer,
-    )
+    return get_renderer().clean(dirty_html, strip_tags)
 
 
 def md_to_html(markdown_string, strip_tags=False):
     """Return HTML formatted string, given a markdown one."""
     if not markdown_string:
         return ""
-    dirty_html = markdown.markdown(
-        syntax_highlight(markdown_string),
-        extensions=[
-            "markdown.extensions.fenced_code",
-            "markdown.extensions.tables",
-            "markdown.extensions.footnotes",
-            "markdown.extensions.toc",
-        ],
+
+    key = (
+        hashlib.blake2b(markdown_string.encode(), digest_size=16).digest(),
+        strip_tags,
+        MARKDOWN_VERSION,
     )
-    return clean_html(dirty_html, strip_tags)
+    html = md_cache.get(key)
+    if html is None:
+        html = render_markdown(markdown_string, strip_tags)
+        md_cache.set(key, html, size=sys.getsizeof(html))
+    return html
+
+
+def render_markdown(markdown_string, strip_tags=False):
+    """Render markdown into clean HTML, bypassing md_cache."""
+    return get_renderer().render(markdown_string, strip_tags)
 
 
 def remove_control_chars(text):
@@ -165,6 +296,47 @@ def remove_control_chars(text):
     return control_char_re.sub(" ", text)
 
 
+# eg. https://mataroa.blog/images/896f9b41.png, also variants like .webp?w=800
+IMAGE_URL_RE = re.compile(r"/images/([\w-]+)\.\w+")
+
+
+def get_image_slugs(markdown_string):
+    """Return the slugs of the uploaded images a markdown body links to."""
+    return set(IMAGE_URL_RE.findall(markdown_string or ""))
+
+
+BYTE_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_byte_range(header, size):
+    """
+    Parse a single range Range header, eg. "bytes=0-499", for a content of
+    size bytes. Returns (start, end) with end inclusive, or None to send the
+    full content, which is what missing, invalid and multiple ranges get.
+    Raises ValueError if the range cannot be satisfied.
+    """
+    match = BYTE_RANGE_RE.match((header or "").strip())
+    if not match:
+        return None
+    start, end = match.groups()
+
+    if not start:
+        # suffix range, eg. "bytes=-500" for the last 500 bytes
+        if not end:
+            return None
+        if int(end) == 0:
+            raise ValueError("Empty suffix range.")
+        return max(size - int(end), 0), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size:
+        raise ValueError("Range starts after the end of the content.")
+    if end < start:
+        return None
+    return start, end
+
+
 def get_protocol():
     if settings.DEBUG:
         return "http:"
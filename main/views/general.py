@@ -1,9 +1,11 @@
 import logging
 import uuid
-from collections import defaultdict
+from calendar import timegm
 from datetime import datetime, timedelta
+from functools import partial
 
 import stripe
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import authenticate, login
@@ -14,17 +16,24 @@ from django.contrib.messages.views import SuccessMessageMixin
 from django.contrib.sitemaps.views import sitemap as DjSitemapView
 from django.core import mail
 from django.core.exceptions import PermissionDenied
-from django.db.models import Count, Sum
+from django.core.paginator import InvalidPage, Paginator
+from django.db import transaction
+from django.db.models import CharField, Count, Func, Value
 from django.db.models.functions import Length, TruncDay
 from django.http import (
+    FileResponse,
     Http404,
     HttpResponse,
     HttpResponseBadRequest,
     HttpResponseRedirect,
+    StreamingHttpResponse,
 )
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse, reverse_lazy
 from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.decorators import method_decorator
+from django.utils.http import http_date
 from django.views.generic import (
     CreateView,
     DeleteView,
@@ -35,7 +44,16 @@ from django.views.generic import (
     UpdateView,
 )
 
-from main import denylist, forms, models, util
+from main import (
+    analytics,
+    caching,
+    denylist,
+    forms,
+    images,
+    models,
+    storage,
+    util,
+)
 from main.sitemaps import PageSitemap, PostSitemap, StaticSitemap
 from main.views import billing
 
@@ -66,39 +84,83 @@ def dashboard(request):
     )
 
 
+def get_index_hit(request):
+    return ("page", request.blog_host["id"], "index")
+
+
+def get_index_posts(request, today, **filters):
+    """
+    The posts listed on a blog index, newest first, with only the fields it
+    shows, read from the covering index on (owner, published_at). Scheduled
+    posts are listed only to their owner.
+    """
+    posts = models.Post.objects.filter(
+        owner=request.blog_user, published_at__isnull=False, **filters
+    )
+    if request.user != request.blog_user:
+        posts = posts.filter(published_at__lte=today)
+    return posts.order_by("-published_at", "-created_at").values(
+        "slug", "title", "published_at"
+    )
+
+
+def get_page_or_404(paginator, number):
+    """
+    The page of number, which is None for the first page. Anything but the
+    numbers of existing pages, as linked, is not found, so that the page
+    cache stores no more entries than there are pages.
+    """
+    try:
+        page_obj = paginator.page(number or 1)
+    except InvalidPage as ex:
+        raise Http404() from ex
+    if number is not None and number != str(page_obj.number):
+        raise Http404()
+    return page_obj
+
+
+def get_index_context(request):
+    return {
+        "subdomain": request.subdomain,
+        "blog_user": request.blog_user,
+        "pages": models.Page.objects.filter(
+            owner=request.blog_user, is_hidden=False
+        ).defer("body"),
+        "today": timezone.now().date(),
+    }
+
+
+@caching.conditional_blog_page(get_index_hit)
+@caching.anonymous_page_cache(query_params=["page"])
 def index(request):
     if hasattr(request, "subdomain"):
-        if models.User.objects.filter(username=request.subdomain).exists():
-            drafts = []
+        # set by host_middleware once the blog is resolved
+        if hasattr(request, "blog_host"):
+            context = get_index_context(request)
+            posts = get_index_posts(request, context["today"])
+            context["drafts"] = []
             if request.user.is_authenticated and request.user == request.blog_user:
-                posts = models.Post.objects.filter(owner=request.blog_user).defer(
-                    "body"
-                )
-                drafts = models.Post.objects.filter(
+                context["drafts"] = models.Post.objects.filter(
                     owner=request.blog_user,
                     published_at__isnull=True,
-                ).defer("body")
+                ).values("slug", "title")
             else:
-                models.AnalyticPage.objects.create(user=request.blog_user, path="index")
-                posts = models.Post.objects.filter(
-                    owner=request.blog_user,
-                    published_at__isnull=False,
-                    published_at__lte=timezone.now().date(),
-                ).defer("body")
-
-            return render(
-                request,
-                "main/blog_index.html",
-                {
-                    "subdomain": request.subdomain,
-                    "blog_user": request.blog_user,
-                    "posts": posts,
-                    "drafts": drafts,
-                    "pages": models.Page.objects.filter(
-                        owner=request.blog_user, is_hidden=False
-                    ).defer("body"),
-                },
-            )
+                analytics.record_hit(request, "page", request.blog_user.id, "index")
+
+            # newest posts only, with older ones on further pages and in
+            # yearly archives, so that large blogs render as fast as small ones
+            per_page = request.blog_user.index_posts_per_page
+            page = request.GET.get("page")
+            if not per_page and page is not None:
+                # links from when the blog had pages
+                return redirect(request.path)
+            if per_page:
+                context["page_obj"] = get_page_or_404(Paginator(posts, per_page), page)
+                context["years"] = posts.dates("published_at", "year", order="DESC")
+                posts = context["page_obj"].object_list
+            context["posts"] = posts
+
+            return render(request, "main/blog_index.html", context)
         else:
             return redirect("//" + settings.CANONICAL_HOST + reverse("index"))
 
@@ -108,6 +170,31 @@ def index(request):
     return render(request, "main/landing.html")
 
 
+def get_archive_hit(request, year):
+    return ("page", request.blog_host["id"], "archive")
+
+
+@caching.conditional_blog_page(get_archive_hit)
+@caching.anonymous_page_cache()
+def blog_archive(request, year):
+    if not hasattr(request, "subdomain") or not 1 <= year <= 9999:
+        raise Http404()
+
+    context = get_index_context(request)
+    context["archive_year"] = year
+    context["posts"] = list(
+        get_index_posts(request, context["today"], published_at__year=year)
+    )
+    if not context["posts"]:
+        raise Http404()
+    if request.user != request.blog_user:
+        analytics.record_hit(request, "page", request.blog_user.id, "archive")
+    context["years"] = get_index_posts(request, context["today"]).dates(
+        "published_at", "year", order="DESC"
+    )
+    return render(request, "main/blog_index.html", context)
+
+
 def domain_check(request):
     """
     This view returns 200 if domain given exists as custom domain in any
@@ -116,7 +203,8 @@ def domain_check(request):
     url = request.GET.get("domain")
     if not url:
         raise PermissionDenied()
-    if not models.User.objects.filter(custom_domain=url).exists():
+    # answered from memory, as it is hit for every TLS handshake of unknown hosts
+    if url not in caching.custom_domains:
         raise PermissionDenied()
     return HttpResponse()
 
@@ -180,6 +268,7 @@ class UserUpdate(LoginRequiredMixin, SuccessMessageMixin, UpdateView):
         "footer_note",
         "theme_zialucia",
         "theme_sansserif",
+        "index_posts_per_page",
         "custom_domain",
         "comments_on",
         "notifications_on",
@@ -246,6 +335,19 @@ def post_detail_redir(request, slug):
     return redirect("post_detail", slug=slug, permanent=True)
 
 
+def get_post_hit(request, slug):
+    post_id = (
+        models.Post.objects.filter(owner_id=request.blog_host["id"], slug=slug)
+        .values_list("id", flat=True)
+        .first()
+    )
+    return ("post", post_id) if post_id else None
+
+
+@method_decorator(
+    [caching.conditional_blog_page(get_post_hit), caching.anonymous_page_cache()],
+    name="dispatch",
+)
 class PostDetail(DetailView):
     model = models.Post
 
@@ -273,7 +375,7 @@ class PostDetail(DetailView):
             and self.request.user == self.object.owner
         ):
             return context
-        models.AnalyticPost.objects.create(post=self.object)
+        analytics.record_hit(self.request, "post", self.object.id)
 
         return context
 
@@ -638,11 +740,109 @@ class BlogImport(LoginRequiredMixin, FormView):
         return HttpResponseRedirect(self.get_success_url())
 
 
+# image slugs are never reused, so their content never changes
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
 async def image_raw(request, slug, extension):
-    image = await models.Image.objects.filter(slug=slug).afirst()
-    if not image or extension != image.extension:
+    image = await models.Image.objects.filter(slug=slug).defer("data").afirst()
+    if not image:
         raise Http404()
-    return HttpResponse(image.data, content_type="image/" + image.extension)
+    try:
+        variant = images.get_variant_options(
+            image.extension, extension, request.GET.get("w")
+        )
+    except ValueError as error:
+        raise Http404() from error
+
+    if image.digest:
+        digest = image.digest
+    else:
+        # not yet moved to the image storage, so hash and measure the bytes
+        # in the database rather than loading them
+        digest, size = await (
+            models.Image.objects.filter(id=image.id)
+            .annotate(
+                data_digest=Func(
+                    Func("data", function="sha256"),
+                    Value("hex"),
+                    function="encode",
+                    output_field=CharField(),
+                ),
+                data_size=Length("data"),
+            )
+            .values_list("data_digest", "data_size")
+            .aget()
+        )
+
+    key = images.get_variant_key(digest, *variant) if variant else digest
+    etag = f'"{key}"'
+    last_modified = timegm(image.uploaded_at.utctimetuple())
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        content_type = "image/" + extension
+        if variant:
+            try:
+                path = await sync_to_async(images.get_variant)(image, digest, *variant)
+            except ValueError as error:
+                raise Http404() from error
+            response = get_image_response(
+                request, content_type, path.stat().st_size, etag, path=path
+            )
+        elif image.digest:
+            path = storage.image_storage.path(digest)
+            response = get_image_response(
+                request, content_type, path.stat().st_size, etag, path=path
+            )
+        else:
+            response = get_image_response(
+                request, content_type, size, etag, iter_data=image.iter_data
+            )
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    response["Cache-Control"] = IMAGE_CACHE_CONTROL
+    return response
+
+
+def get_image_response(request, content_type, size, etag, path=None, iter_data=None):
+    """
+    Response streaming the whole image, or the requested byte range of it,
+    from the file at path or else from iter_data(start, end), without loading
+    it in memory.
+    """
+    # ranges of another version of the image are not combinable with this one
+    if_range = request.headers.get("If-Range")
+    byte_range = None
+    if if_range is None or if_range == etag:
+        try:
+            byte_range = util.parse_byte_range(request.headers.get("Range"), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+
+    if path is not None:
+        iter_data = partial(storage.iter_file, path)
+
+    if byte_range is None:
+        if path is not None:
+            # served with sendfile where the server supports wsgi.file_wrapper
+            response = FileResponse(path.open("rb"), content_type=content_type)
+            response.block_size = storage.CHUNK_SIZE
+        else:
+            response = StreamingHttpResponse(iter_data(), content_type=content_type)
+            response["Content-Length"] = size
+        response["Accept-Ranges"] = "bytes"
+        return response
+
+    start, end = byte_range
+    response = StreamingHttpResponse(
+        iter_data(start, end + 1), status=206, content_type=content_type
+    )
+    response["Content-Length"] = end - start + 1
+    response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    response["Accept-Ranges"] = "bytes"
+    return response
 
 
 class ImageList(LoginRequiredMixin, FormView):
@@ -653,14 +853,13 @@ class ImageList(LoginRequiredMixin, FormView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context["images"] = models.Image.objects.filter(owner=self.request.user)
+        context["unused_images"] = context["images"].filter(
+            posts__isnull=True, pages__isnull=True
+        )
 
         # Total quota in MB (decimal, 1MB = 1,000,000 bytes)
-        total_bytes = (
-            models.Image.objects.filter(owner=self.request.user)
-            .aggregate(total=Sum(Length("data")))
-            .get("total")
-            or 0
-        )
+        usage = models.ImageUsage.objects.filter(user=self.request.user).first()
+        total_bytes = usage.size_bytes if usage else 0
         context["total_quota"] = round(total_bytes / 1_000_000, 2)
         return context
 
@@ -669,46 +868,47 @@ class ImageList(LoginRequiredMixin, FormView):
         form = self.get_form(form_class)
         files = request.FILES.getlist("file")
         if form.is_valid():
-            # calculate current total storage used by user
-            user_total_bytes = (
-                models.Image.objects.filter(owner=self.request.user)
-                .aggregate(total=Sum(Length("data")))
-                .get("total")
-                or 0
-            )
-
-            for f in files:
-                name_ext_parts = f.name.rsplit(".", 1)
-                name = name_ext_parts[0].replace(".", "-")
-                self.extension = name_ext_parts[1].casefold()
-                if self.extension == "jpg":
-                    self.extension = "jpeg"
-                data = f.read()
-
-                # check for file limit
-                if len(data) > 1.1 * 1000 * 1000:
-                    form.add_error("file", "File too big. Limit is 1MB.")
-                    return self.form_invalid(form)
-
-                # quota limit 1GB total per user
-                if user_total_bytes + len(data) > 1_000_000_000:
-                    current_usage_mb = user_total_bytes / 1_000_000
-                    form.add_error(
-                        "file",
-                        f"Storage limit exceeded. Limit is 1GB. Currently using {current_usage_mb:.2f}MB.",
-                    )
-                    return self.form_invalid(form)
-
-                self.slug = str(uuid.uuid4())[:8]
-                models.Image.objects.create(
-                    name=name,
-                    data=data,
-                    extension=self.extension,
-                    owner=request.user,
-                    slug=self.slug,
+            with transaction.atomic():
+                # lock the current total storage used by user, so that
+                # concurrent uploads cannot both fit under the quota
+                usage, _ = models.ImageUsage.objects.select_for_update().get_or_create(
+                    user=request.user
                 )
-                # increment running total for multiple-file uploads
-                user_total_bytes += len(data)
+                user_total_bytes = usage.size_bytes
+
+                for f in files:
+                    name_ext_parts = f.name.rsplit(".", 1)
+                    name = name_ext_parts[0].replace(".", "-")
+                    self.extension = name_ext_parts[1].casefold()
+                    if self.extension == "jpg":
+                        self.extension = "jpeg"
+                    data = f.read()
+
+                    # check for file limit
+                    if len(data) > 1.1 * 1000 * 1000:
+                        form.add_error("file", "File too big. Limit is 1MB.")
+                        return self.form_invalid(form)
+
+                    # quota limit 1GB total per user
+                    if user_total_bytes + len(data) > 1_000_000_000:
+                        current_usage_mb = user_total_bytes / 1_000_000
+                        form.add_error(
+                            "file",
+                            f"Storage limit exceeded. Limit is 1GB. Currently using {current_usage_mb:.2f}MB.",
+                        )
+                        return self.form_invalid(form)
+
+                    self.slug = str(uuid.uuid4())[:8]
+                    models.Image.objects.create(
+                        name=name,
+                        digest=storage.image_storage.save(data),
+                        size_bytes=len(data),
+                        extension=self.extension,
+                        owner=request.user,
+                        slug=self.slug,
+                    )
+                    # increment running total for multiple-file uploads
+                    user_total_bytes += len(data)
             return self.form_valid(form)
         else:
             return self.form_invalid(form)
@@ -741,10 +941,9 @@ class ImageDetail(LoginRequiredMixin, DetailView):
         context = super().get_context_data(**kwargs)
 
         # find posts that use this image
-        context["used_by_posts"] = []
-        for post in models.Post.objects.filter(owner=self.request.user):
-            if "/images/" + self.object.filename in post.body:
-                context["used_by_posts"].append(post)
+        context["used_by_posts"] = self.object.posts.filter(
+            owner=self.request.user
+        ).only("title", "slug")
 
         return context
 
@@ -807,6 +1006,14 @@ class PageCreate(LoginRequiredMixin, SuccessMessageMixin, CreateView):
         return HttpResponseRedirect(self.get_success_url())
 
 
+def get_page_hit(request, slug):
+    return ("page", request.blog_host["id"], request.path.strip("/"))
+
+
+@method_decorator(
+    [caching.conditional_blog_page(get_page_hit), caching.anonymous_page_cache()],
+    name="dispatch",
+)
 class PageDetail(DetailView):
     model = models.Page
 
@@ -828,8 +1035,11 @@ class PageDetail(DetailView):
             and self.request.user == self.object.owner
         ):
             return context
-        models.AnalyticPage.objects.create(
-            user=self.request.blog_user, path=self.request.path.strip("/")
+        analytics.record_hit(
+            self.request,
+            "page",
+            self.request.blog_user.id,
+            self.request.path.strip("/"),
         )
 
         return context
@@ -917,20 +1127,13 @@ class AnalyticList(LoginRequiredMixin, TemplateView):
         return context
 
 
-def populate_analytics_context(context, date_25d_ago, current_date, day_counts):
+def populate_analytics_context(context, date_25d_ago, current_date, count_per_day):
     context["date_25d_ago"] = date_25d_ago
     context["analytics_per_day"] = {}
     current_x_offset = 0
 
-    # transform day_counts into dict with date as key
-    count_per_day = defaultdict(int)
-    highest_day_count = 1
-    for item in day_counts:
-        count_per_day[item["created_at"].date()] += item["id__count"]
-
-        # find day with the most analytics counts (i.e. visits)
-        if highest_day_count < count_per_day[item["created_at"].date()]:
-            highest_day_count = count_per_day[item["created_at"].date()]
+    # find day with the most analytics counts (i.e. visits)
+    highest_day_count = max([1, *count_per_day.values()])
 
     # calculate analytics count and percentages for each day
     while date_25d_ago <= current_date:
@@ -970,19 +1173,18 @@ class AnalyticPostDetail(LoginRequiredMixin, DetailView):
         date_25d_ago = timezone.now().date() - timedelta(days=24)
 
         # get all counts for the last 25 days
-        day_counts = (
-            models.AnalyticPost.objects.filter(
-                post=self.object, created_at__gt=date_25d_ago
-            )
-            .values("created_at")
-            .annotate(Count("id"))
+        count_per_day = analytics.count_per_day(
+            models.AnalyticPost,
+            models.AnalyticPostDay,
+            since=date_25d_ago,
+            post=self.object,
         )
 
         return populate_analytics_context(
             context=context,
             date_25d_ago=date_25d_ago,
             current_date=current_date,
-            day_counts=day_counts,
+            count_per_day=count_per_day,
         )
 
 
@@ -990,16 +1192,14 @@ class AnalyticPageDetail(LoginRequiredMixin, DetailView):
     template_name = "main/analytic_detail.html"
 
     def get_object(self):
-        # our object is annotated with counts for the last 25 days
+        # our object is the hit counts per day for the last 25 days
         date_25d_ago = timezone.now().date() - timedelta(days=24)
-        return (
-            models.AnalyticPage.objects.filter(
-                user=self.request.user,
-                path=self.kwargs["page_path"],
-                created_at__gt=date_25d_ago,
-            )
-            .values("created_at")
-            .annotate(Count("id"))
+        return analytics.count_per_day(
+            models.AnalyticPage,
+            models.AnalyticPageDay,
+            since=date_25d_ago,
+            user=self.request.user,
+            path=self.kwargs["page_path"],
         )
 
     def get_context_data(self, **kwargs):
@@ -1014,7 +1214,7 @@ class AnalyticPageDetail(LoginRequiredMixin, DetailView):
             context=context,
             date_25d_ago=date_25d_ago,
             current_date=current_date,
-            day_counts=self.object,
+            count_per_day=self.object,
         )
 
 
@@ -1266,6 +1466,7 @@ def transparency(request):
     )
 
 
+@caching.conditional_blog_page()
 def sitemap(request):
     if not hasattr(request, "subdomain"):
         raise Http404()
@@ -1286,7 +1487,14 @@ def guides_markdown(request):
 
 
 def guides_images(request):
-    return render(request, "main/guides_images.html")
+    return render(
+        request,
+        "main/guides_images.html",
+        {
+            "widths": settings.IMAGE_VARIANT_WIDTHS,
+            "max_megapixels": settings.IMAGE_VARIANT_MAX_PIXELS // 1_000_000,
+        },
+    )
 
 
 def guides_comments(request):
@@ -4,7 +4,6 @@ from urllib.parse import urlencode
 from django.conf import settings
 from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
 from django.db.models import Avg, Count, F, Max, Q, Sum
-from django.db.models.expressions import Func
 from django.db.models.functions import (
     Coalesce,
     Length,
@@ -16,7 +15,7 @@ from django.http import Http404, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.utils import timezone
 
-from main import models
+from main import analytics, caching, images, models, util
 
 
 def index(request):
@@ -211,10 +210,10 @@ def images_leaderboard(request):
     sort_by_mb = "bymb" in current_modes
     reverse = "reverse" in current_modes
 
-    users_with_counts = models.User.objects.annotate(
-        image_count=Count("image"),
-        image_bytes=Sum(Func(F("image__data"), function="octet_length")),
-    ).filter(image_count__gt=0)
+    users_with_counts = models.User.objects.filter(image_usage__count__gt=0).annotate(
+        image_count=F("image_usage__count"),
+        image_bytes=F("image_usage__size_bytes"),
+    )
 
     if sort_by_mb:
         ordering = ["image_bytes", "id"] if reverse else ["-image_bytes", "-id"]
@@ -442,9 +441,8 @@ def stats(request):
     total_pages = models.Page.objects.count()
 
     # Images
-    image_stats = models.Image.objects.aggregate(
-        count=Count("id"),
-        total_bytes=Sum(Func(F("data"), function="octet_length")),
+    image_stats = models.ImageUsage.objects.aggregate(
+        count=Sum("count"), total_bytes=Sum("size_bytes")
     )
     total_images = image_stats["count"] or 0
     total_image_megabytes = round((image_stats["total_bytes"] or 0) / (1024 * 1024), 2)
@@ -456,7 +454,9 @@ def stats(request):
     # Notifications (subscribers) and sends
     total_subscribers = models.Notification.objects.count()
     active_subscribers = models.Notification.objects.filter(is_active=True).count()
-    total_sends = models.NotificationRecord.objects.count()
+    total_sends = models.NotificationRecord.objects.filter(
+        status=models.NotificationRecord.Status.SENT
+    ).count()
 
     # Snapshots
     total_snapshots = models.Snapshot.objects.count()
@@ -492,6 +492,15 @@ def stats(request):
         "latest": {
             "last_post_date": latest_post_date["last"],
         },
+        # in-process counters, only for the worker serving this request
+        "worker": {
+            "md_cache": util.md_cache.info(),
+            "analytics": analytics.buffer.info(),
+            "custom_domains": caching.custom_domains.info(),
+            "page_cache": caching.anonymous_page_cache.info(),
+            "conditional": caching.conditional_blog_page.info(),
+            "image_variants": images.variant_cache.info(),
+        },
         # leave heavy sections to dedicated pages for performance
     }
 
@@ -746,19 +755,22 @@ def summary(request, date_str: str):
         .order_by("-created_at")
     )
 
-    post_visits_count = models.AnalyticPost.objects.filter(
-        created_at__date=target_date
-    ).count()
-    top_posts_by_visits_qs = (
-        models.Post.objects.filter(analyticpost__created_at__date=target_date)
-        .annotate(
-            visit_count=Count(
-                "analyticpost", filter=Q(analyticpost__created_at__date=target_date)
-            )
-        )
-        .select_related("owner")
-        .order_by("-visit_count", "-id")
+    # read from the daily rollups, as raw hits of past days may be pruned
+    post_counts = analytics.counts_on(
+        models.AnalyticPost, models.AnalyticPostDay, target_date, "post"
+    )
+    page_counts = analytics.counts_on(
+        models.AnalyticPage, models.AnalyticPageDay, target_date, "user"
+    )
+    top_post_ids = sorted(
+        post_counts, key=lambda post_id: (post_counts[post_id], post_id), reverse=True
+    )[:20]
+    top_posts_by_visits = list(
+        models.Post.objects.filter(id__in=top_post_ids).select_related("owner")
     )
+    for post in top_posts_by_visits:
+        post.visit_count = post_counts[post.id]
+    top_posts_by_visits.sort(key=lambda post: (post.visit_count, post.id), reverse=True)
 
     context = {
         "target_date": target_date,
@@ -769,13 +781,14 @@ def summary(request, date_str: str):
             "posts": new_posts_qs.count(),
             "pages": new_pages_qs.count(),
             "comments": new_comments_qs.count(),
-            "post_visits": post_visits_count,
+            "post_visits": sum(post_counts.values()),
+            "page_visits": sum(page_counts.values()),
         },
         "new_users": list(new_users_qs),
         "new_posts": list(new_posts_qs),
         "new_pages": list(new_pages_qs),
         "new_comments": list(new_comments_qs),
-        "top_posts_by_visits": list(top_posts_by_visits_qs[:20]),
+        "top_posts_by_visits": top_posts_by_visits,
     }
 
     return render(request, "main/moderation_summary.html", context)
@@ -168,6 +168,81 @@ STORAGES = {
 }
 
 
+# Image storage
+# Uploaded image bytes, stored by content hash, see main.storage
+
+IMAGES_ROOT = Path(os.getenv("IMAGES_ROOT", BASE_DIR / "images"))
+
+# Resized and converted variants of images, generated on request, see
+# main.images. Derived, so least recently used ones are deleted once over
+# the size limit, and they need no backup.
+IMAGE_VARIANTS_ROOT = Path(
+    os.getenv("IMAGE_VARIANTS_ROOT", BASE_DIR / "image-variants")
+)
+IMAGE_VARIANTS_MAX_BYTES = int(os.getenv("IMAGE_VARIANTS_MAX_BYTES", 1_000_000_000))
+IMAGE_VARIANT_WIDTHS = [320, 640, 800, 1280, 1600]
+# larger images, once decoded, get no variants, as decoding them takes this
+# many times 4 bytes of memory, on requests anyone can make
+IMAGE_VARIANT_MAX_PIXELS = int(os.getenv("IMAGE_VARIANT_MAX_PIXELS", 25_000_000))
+
+# Blog exports, built by the processexports command and deleted by
+# expireexports once EXPORTS_EXPIRE_HOURS have passed, see main.exports
+EXPORTS_ROOT = Path(os.getenv("EXPORTS_ROOT", BASE_DIR / "exports"))
+EXPORTS_EXPIRE_HOURS = int(os.getenv("EXPORTS_EXPIRE_HOURS", 24))
+# running exports not finished by then are assumed crashed, and built again
+EXPORTS_TIMEOUT_MINUTES = int(os.getenv("EXPORTS_TIMEOUT_MINUTES", 60))
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Per-process by default; a shared backend also shares invalidations.
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "mataroa",
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    }
+}
+
+# host to blog resolution in host_middleware, see main.caching
+BLOG_HOST_CACHE_TIMEOUT = 60  # seconds
+BLOG_HOST_CACHE_NEGATIVE_TIMEOUT = 30  # seconds, for unknown hosts
+
+# custom domains set for Caddy's on-demand TLS domain_check, see main.caching
+CUSTOM_DOMAINS_REFRESH_INTERVAL = 60  # seconds
+
+# rendered blog pages for anonymous visitors, see main.caching
+PAGE_CACHE_TIMEOUT = 60  # seconds
+# per-process memory cap for them, kept apart from the default cache
+PAGE_CACHE_MAX_BYTES = int(
+    os.getenv("PAGE_CACHE_MAX_BYTES", 32 * 1024 * 1024)  # 32 MiB
+)
+# larger pages are rendered on every request
+PAGE_CACHE_MAX_ITEM_BYTES = int(
+    os.getenv("PAGE_CACHE_MAX_ITEM_BYTES", 512 * 1024)  # 512 KiB
+)
+
+
+# Markdown rendering
+# Per-process memory cap for rendered markdown fragments, see main.util.md_cache
+
+MARKDOWN_CACHE_MAX_BYTES = int(
+    os.getenv("MARKDOWN_CACHE_MAX_BYTES", 8 * 1024 * 1024)  # 8 MiB
+)
+
+
+# Analytics
+# Hits are buffered per process and written in batches, see main.analytics.
+# A buffer size of 1 writes every hit immediately. Otherwise, pending hits are
+# written within ANALYTICS_BUFFER_MAX_AGE seconds even if the worker goes idle,
+# which bounds the hits lost if it is killed.
+
+ANALYTICS_BUFFER_SIZE = int(os.getenv("ANALYTICS_BUFFER_SIZE", 1))
+ANALYTICS_BUFFER_MAX_AGE = int(os.getenv("ANALYTICS_BUFFER_MAX_AGE", 10))  # seconds
+ANALYTICS_BUFFER_MAX_PENDING = 10000  # hits kept while the database is unavailable
+
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 